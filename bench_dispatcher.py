@@ -0,0 +1,328 @@
+"""
+Нагрузочный тест обработчиков без Telegram и без HTTP
+Собирает настоящий Dispatcher с handlers.router и подает ему синтетические
+обновления: быстрый ввод сумм, нажатия кнопок и полный сценарий операции
+с выбором категории. Бот работает через сессию-заглушку
+Показывает задержки каждого обработчика (p50/p95/p99), время в БД и
+пропускную способность. Результат можно сохранить и сравнить с прошлым:
+python bench_dispatcher.py --updates 5000 --save before.json
+python bench_dispatcher.py --updates 5000 --baseline before.json
+С --workers N чаты делятся между N процессами так же, как в main.py --workers N,
+и процессы работают с общим файлом БД: так проверяется рост пропускной
+способности с числом ядер
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextvars import ContextVar
+from functools import wraps
+from typing import Dict, List, Optional
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+from aiogram import Dispatcher
+
+import database as db
+import handlers
+from benchtools import UpdateFactory, make_bot
+from sharding import shard_of
+from storage import SQLiteStorage
+
+# Кнопки, которые нажимают пользователи в сценарии "клик"
+CALLBACKS = ("balance", "history", "refresh", "unit_economics", "summary_table", "categories_menu")
+
+# Категорий каждого типа в чате
+CATEGORIES_PER_TYPE = 5
+
+# Время в БД текущего обновления и признак "идет вызов database",
+# заполняется обертками функций database
+_db_time: ContextVar[Optional[list]] = ContextVar("bench_db_time", default=None)
+
+
+def instrument_database():
+    """Обертки над асинхронными функциями database, которые вызывают обработчики:
+    время ожидания БД (включая очередь групповой записи) идет в счетчик обновления"""
+    for name in dir(db):
+        func = getattr(db, name)
+        if name.startswith("_") or not asyncio.iscoroutinefunction(func):
+            continue
+
+        def timed(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                spent = _db_time.get()
+                # Вложенные вызовы (функции database вызывают друг друга) уже учтены
+                if spent is None or spent[1]:
+                    return await func(*args, **kwargs)
+                spent[1] = 1
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    spent[0] += time.perf_counter() - started
+                    spent[1] = 0
+            return wrapper
+
+        setattr(db, name, timed(func))
+
+
+class HandlerTimer:
+    """Внутренний middleware: время работы и время в БД каждого обработчика"""
+
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.db_time: Dict[str, List[float]] = defaultdict(list)
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        spent = [0.0, 0]
+        token = _db_time.set(spent)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.latency[name].append(time.perf_counter() - started)
+            self.db_time[name].append(spent[0])
+            _db_time.reset(token)
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """Доли сценариев: "text=70,click=20,flow=10" """
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ("text", "click", "flow"):
+            raise argparse.ArgumentTypeError(f"неизвестный сценарий: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+async def setup_categories(chats: List[int]) -> Dict[int, Dict[str, List[int]]]:
+    """Категории в каждом чате для сценария с выбором категории"""
+    categories = {}
+    for chat_id in chats:
+        ids = {"add": [], "subtract": []}
+        for i in range(CATEGORIES_PER_TYPE):
+            ids["add"].append(await db.create_category(chat_id, f"Источник {i}", "income_source"))
+            ids["subtract"].append(await db.create_category(chat_id, f"Расход {i}", "expense_category"))
+        categories[chat_id] = ids
+    return categories
+
+
+async def run(args, db_path: str, shard: int = 0, shards: int = 1) -> dict:
+    """Прогон на чатах одного исполнителя. Возвращает сырые замеры"""
+    instrument_database()
+    await db.open_pool(db_path)
+    await db.init_db()
+    storage = SQLiteStorage(ttl=3600, cache_size=10000)
+    storage.start()
+    dp = Dispatcher(storage=storage)
+    dp.include_router(handlers.router)
+    timer = HandlerTimer()
+    dp.message.middleware(timer)
+    dp.callback_query.middleware(timer)
+    bot = make_bot(args.latency)
+
+    factory = UpdateFactory(args.chats, args.users, seed=args.seed)
+    # Свои чаты и пользователи у каждого исполнителя, нагрузка делится поровну
+    chats = [chat_id for chat_id in factory.chats if shard_of(chat_id, shards) == shard]
+    users = factory.users[shard::shards]
+    concurrency = max(1, args.concurrency // shards)
+    categories = await setup_categories(chats)
+    rnd = random.Random(args.seed + shard)
+    scenarios = list(args.mix)
+    weights = [args.mix[name] for name in scenarios]
+    remaining = args.updates // shards
+    update_latency: Dict[str, List[float]] = defaultdict(list)
+
+    async def feed(kind: str, update: dict):
+        started = time.perf_counter()
+        await dp.feed_raw_update(bot, update)
+        update_latency[kind].append(time.perf_counter() - started)
+
+    async def worker(users: List[int]):
+        # Сценарии одного пользователя идут по очереди, как в жизни:
+        # состояние FSM у него одно
+        nonlocal remaining
+        while remaining > 0:
+            kind = rnd.choices(scenarios, weights)[0] if users else "text"
+            user_id = rnd.choice(users) if users else None
+            chat_id = rnd.choice(chats)
+            if kind == "text":
+                remaining -= 1
+                await feed(kind, factory.amount(chat_id, user_id))
+            elif kind == "click":
+                remaining -= 1
+                await feed(kind, factory.callback(rnd.choice(CALLBACKS), chat_id, user_id))
+            else:
+                remaining -= 3
+                operation = rnd.choice(("add", "subtract"))
+                payment = rnd.choice(("cash", "card"))
+                category_id = rnd.choice(categories[chat_id][operation])
+                await feed(kind, factory.callback(f"{operation}_{payment}", chat_id, user_id))
+                await feed(kind, factory.callback(f"select_cat_{category_id}", chat_id, user_id))
+                await feed(kind, factory.text(
+                    f"{rnd.randint(100, 5000)} кол {rnd.randint(1, 10)} цена {rnd.randint(10, 500)}",
+                    chat_id, user_id
+                ))
+
+    try:
+        # Время по общим часам: процессы стартуют не одновременно
+        started = time.time()
+        await asyncio.gather(*(worker(users[i::concurrency]) for i in range(concurrency)))
+        finished = time.time()
+    finally:
+        await storage.close()
+        await db.close_pool()
+
+    return {
+        "started": started,
+        "finished": finished,
+        "latency": dict(timer.latency),
+        "db_time": dict(timer.db_time),
+        "scenarios": dict(update_latency),
+        "api_calls": dict(bot.session.calls),
+    }
+
+
+def _run_shard(args, db_path: str, shard: int, shards: int) -> dict:
+    """Точка входа процесса-исполнителя нагрузочного теста"""
+    return asyncio.run(run(args, db_path, shard, shards))
+
+
+def run_workers(args) -> List[dict]:
+    """Прогон в одном процессе или в args.workers процессах с общей БД"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        if args.workers == 1:
+            return [asyncio.run(run(args, db_path))]
+        # Схема создается заранее, чтобы процессы не создавали ее наперегонки
+        asyncio.run(_init_db(db_path))
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(args.workers, mp_context=context) as pool:
+            futures = [pool.submit(_run_shard, args, db_path, shard, args.workers)
+                       for shard in range(args.workers)]
+            return [future.result() for future in futures]
+
+
+async def _init_db(db_path: str):
+    await db.open_pool(db_path)
+    try:
+        await db.init_db()
+    finally:
+        await db.close_pool()
+
+
+def summarize(shards: List[dict]) -> dict:
+    """Общие задержки по всем исполнителям. Время прогона - от начала работы
+    первого процесса до конца работы последнего"""
+    latency: Dict[str, List[float]] = defaultdict(list)
+    db_time: Dict[str, List[float]] = defaultdict(list)
+    update_latency: Dict[str, List[float]] = defaultdict(list)
+    api_calls: Counter = Counter()
+    for shard in shards:
+        for name, values in shard["latency"].items():
+            latency[name].extend(values)
+        for name, values in shard["db_time"].items():
+            db_time[name].extend(values)
+        for kind, values in shard["scenarios"].items():
+            update_latency[kind].extend(values)
+        api_calls.update(shard["api_calls"])
+    elapsed = max(shard["finished"] for shard in shards) - min(shard["started"] for shard in shards)
+    processed = sum(len(values) for values in update_latency.values())
+    return {
+        "workers": len(shards),
+        "updates": processed,
+        "elapsed": elapsed,
+        "throughput": processed / elapsed,
+        "handlers": {
+            name: {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "db": sum(db_time[name]) / len(values),
+            }
+            for name, values in latency.items()
+        },
+        "scenarios": {
+            kind: {"count": len(values), "p50": percentile(values, 50), "p95": percentile(values, 95)}
+            for kind, values in update_latency.items()
+        },
+        "api_calls": dict(api_calls),
+    }
+
+
+def print_results(args, results: dict, baseline: Optional[dict] = None):
+    print(f"Обновлений: {results['updates']}, чатов: {args.chats}, пользователей: {args.users}, "
+          f"одновременно: {args.concurrency}, процессов: {args.workers}")
+    line = f"Обработаны за {results['elapsed']:.2f} с ({results['throughput']:.0f} обновлений/с)"
+    if baseline:
+        change = results['throughput'] / baseline['throughput'] * 100 - 100
+        line += f", к базовому замеру {change:+.1f}%"
+    print(line)
+    print()
+    print(f"{'Обработчик':<32} {'вызовов':>8} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'БД, мс':>8}")
+    handler_stats = sorted(results["handlers"].items(), key=lambda item: -item[1]["count"])
+    for name, stats in handler_stats:
+        row = (f"{name:<32} {stats['count']:>8} {stats['p50'] * 1000:>9.2f} "
+               f"{stats['p95'] * 1000:>9.2f} {stats['p99'] * 1000:>9.2f} {stats['db'] * 1000:>8.2f}")
+        base = (baseline or {}).get("handlers", {}).get(name)
+        if base:
+            row += f"   p95 {(stats['p95'] / base['p95'] - 1) * 100:+.0f}%"
+        print(row)
+    print()
+    for kind, stats in results["scenarios"].items():
+        print(f"Сценарий {kind}: обновлений {stats['count']}, от получения до ответа "
+              f"p50 {stats['p50'] * 1000:.2f} мс, p95 {stats['p95'] * 1000:.2f} мс")
+    print(f"Вызовы API: {results['api_calls']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков через Dispatcher")
+    parser.add_argument("--updates", type=int, default=3000, help="количество обновлений")
+    parser.add_argument("--chats", type=int, default=50, help="количество чатов")
+    parser.add_argument("--users", type=int, default=200, help="количество пользователей")
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="одновременно работающих пользователей")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("text=70,click=20,flow=10"),
+                        help="доли сценариев: text - ввод суммы, click - кнопка, "
+                             "flow - операция с выбором категории (3 обновления)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="имитация задержки ответа Telegram API, секунд")
+    parser.add_argument("--seed", type=int, default=0, help="зерно генератора обновлений")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="число процессов, между которыми делятся чаты (как main.py --workers)")
+    parser.add_argument("--save", help="сохранить результат в JSON-файл")
+    parser.add_argument("--baseline", help="сравнить с результатом из JSON-файла")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = summarize(run_workers(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(args, results, baseline)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Микробенчмарк разбора текста операций (parsing.py): однопроходный разбор
+против прежней реализации на корпусе реальных форматов сообщений.
+Корпус и проверка совпадения результатов - в tests/test_parsing.py
+Используйте: python bench_parser.py --number 5000
+"""
+import argparse
+import re
+import timeit
+
+from parsing import parse_amount, parse_text, parse_unit_data
+from tests.test_parsing import (
+    CHATTER, CORPUS, OPERATIONS, legacy_parse_amount, legacy_parse_unit_data
+)
+
+
+def legacy_parse_operation(text: str):
+    """Прежний путь обработчика суммы операции: findall и отдельные regex юнит-данных"""
+    numbers = re.findall(r'\d+[.,]?\d*', text.strip())
+    amount = float(numbers[0].replace(',', '.')) if numbers else None
+    return amount, legacy_parse_unit_data(text)
+
+
+def parse_operation(text: str):
+    parsed = parse_text(text)
+    return parsed.amount, (parsed.quantity, parsed.unit_price, parsed.cost)
+
+
+def _per_call_us(func, texts, number: int) -> float:
+    seconds = min(timeit.repeat(lambda: [func(text) for text in texts], number=number, repeat=5))
+    return seconds / number / len(texts) * 1e6
+
+
+def bench(number: int):
+    """Время одного вызова в микросекундах, прежняя реализация против новой"""
+    cases = [
+        ("parse_amount", "операции", OPERATIONS, legacy_parse_amount, parse_amount),
+        ("parse_amount", "переписка", CHATTER, legacy_parse_amount, parse_amount),
+        ("parse_amount", "весь корпус", CORPUS, legacy_parse_amount, parse_amount),
+        ("parse_unit_data", "операции", OPERATIONS, legacy_parse_unit_data, parse_unit_data),
+        ("сумма + юнит-данные", "операции", OPERATIONS, legacy_parse_operation, parse_operation),
+    ]
+    print(f"{'функция':<22}{'сообщения':<14}{'прежняя, мкс':>14}{'новая, мкс':>12}{'ускорение':>11}")
+    for name, corpus_name, corpus, legacy, current in cases:
+        texts = [row[0] for row in corpus]
+        before = _per_call_us(legacy, texts, number)
+        after = _per_call_us(current, texts, number)
+        print(f"{name:<22}{corpus_name:<14}{before:>14.2f}{after:>12.2f}{before / after:>10.1f}x")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Микробенчмарк разбора текста операций")
+    parser.add_argument("--number", type=int, default=500, help="проходов по корпусу на замер")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    bench(parse_args().number)
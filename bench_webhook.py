@@ -0,0 +1,93 @@
+"""
+Нагрузочный тест режима вебхука без Telegram
+Поднимает приложение вебхука на localhost с ботом-заглушкой и отправляет
+ему синтетические обновления POST-запросами, как это делает Telegram
+Используйте: python bench_webhook.py --updates 5000 --chats 50 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+from aiogram import Dispatcher
+from aiohttp import ClientSession, web
+
+import database as db
+import handlers
+from benchtools import UpdateFactory, make_bot
+from storage import SQLiteStorage
+from webhook import build_app
+
+WEBHOOK_PATH = "/webhook"
+SECRET = "bench-secret"
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        await db.open_pool(os.path.join(tmp, "bench.db"))
+        await db.init_db()
+        storage = SQLiteStorage(ttl=3600, cache_size=10000)
+        storage.start()
+        dp = Dispatcher(storage=storage)
+        dp.include_router(handlers.router)
+        bot = make_bot(args.latency)
+
+        app = build_app(bot, dp, WEBHOOK_PATH, SECRET, args.max_concurrent_updates, drain_timeout=600)
+        handler = app["webhook_handler"]
+        runner = web.AppRunner(app, handle_signals=False)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        url = f"http://{host}:{port}{WEBHOOK_PATH}"
+
+        factory = UpdateFactory(args.chats, args.users)
+        updates = [factory.amount() for _ in range(args.updates)]
+        queue: asyncio.Queue = asyncio.Queue()
+        for update in updates:
+            queue.put_nowait(update)
+
+        async def sender(session: ClientSession):
+            while not queue.empty():
+                update = queue.get_nowait()
+                async with session.post(
+                    url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}
+                ) as response:
+                    response.raise_for_status()
+
+        try:
+            started = time.perf_counter()
+            async with ClientSession() as session:
+                await asyncio.gather(*(sender(session) for _ in range(args.concurrency)))
+            accepted = time.perf_counter() - started
+            while handler.pending:
+                await asyncio.sleep(0.01)
+            finished = time.perf_counter() - started
+        finally:
+            await runner.cleanup()
+            await db.close_pool()
+
+    print(f"Обновлений: {args.updates}, чатов: {args.chats}, пользователей: {args.users}")
+    print(f"Приняты за {accepted:.2f} с ({args.updates / accepted:.0f} запросов/с)")
+    print(f"Обработаны за {finished:.2f} с ({args.updates / finished:.0f} обновлений/с)")
+    print(f"Вызовы API: {dict(bot.session.calls)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест режима вебхука")
+    parser.add_argument("--updates", type=int, default=2000, help="количество обновлений")
+    parser.add_argument("--chats", type=int, default=50, help="количество чатов")
+    parser.add_argument("--users", type=int, default=200, help="количество пользователей")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных HTTP-запросов")
+    parser.add_argument("--max-concurrent-updates", type=int, default=100,
+                        help="лимит одновременно обрабатываемых обновлений")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="имитация задержки ответа Telegram API, секунд")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,130 @@
+"""
+Общие инструменты для нагрузочных тестов без обращения к Telegram:
+сессия-заглушка для Bot и генераторы синтетических обновлений
+"""
+import asyncio
+import itertools
+import random
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetChatAdministrators, GetMe
+from aiogram.types import Chat, ChatMemberOwner, Message, User
+
+BENCH_TOKEN = "123456:BENCH"
+BENCH_ADMIN_ID = 1
+
+
+class StubSession(BaseSession):
+    """Сессия, которая не ходит в сеть, а записывает вызовы API
+    и возвращает правдоподобные ответы"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method, timeout: Optional[int] = None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._fake_result(bot, method)
+
+    def _fake_result(self, bot: Bot, method) -> Any:
+        if isinstance(method, GetMe):
+            return User(id=bot.id, is_bot=True, first_name="Bench", username="bench_bot")
+        if isinstance(method, GetChatAdministrators):
+            admin = User(id=BENCH_ADMIN_ID, is_bot=False, first_name="Admin")
+            return [ChatMemberOwner(user=admin, is_anonymous=False)]
+        if type(method).__name__.startswith("Send"):
+            chat_id = getattr(method, "chat_id", 0)
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(timezone.utc),
+                chat=Chat(id=chat_id, type="group" if chat_id < 0 else "private"),
+                text=getattr(method, "text", None)
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536,
+                             raise_for_status=True):
+        raise NotImplementedError("StubSession не скачивает файлы")
+        yield b""  # pragma: no cover
+
+    async def close(self):
+        pass
+
+
+def make_bot(latency: float = 0.0) -> Bot:
+    """Бот с сессией-заглушкой"""
+    return Bot(token=BENCH_TOKEN, session=StubSession(latency))
+
+
+class UpdateFactory:
+    """Генератор сырых обновлений Telegram (словарей, как в JSON от API)"""
+
+    def __init__(self, chats: int, users: int, seed: int = 0):
+        self.chats = [-(1000 + i) for i in range(chats)]
+        self.users = [BENCH_ADMIN_ID + 1 + i for i in range(users)]
+        self._random = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _chat_user(self, chat_id: Optional[int], user_id: Optional[int]):
+        chat_id = chat_id if chat_id is not None else self._random.choice(self.chats)
+        user_id = user_id if user_id is not None else self._random.choice(self.users)
+        return chat_id, user_id
+
+    def _chat(self, chat_id: int) -> Dict[str, Any]:
+        if chat_id < 0:
+            return {"id": chat_id, "type": "group", "title": f"Bench {chat_id}"}
+        return {"id": chat_id, "type": "private", "first_name": "Bench"}
+
+    def _user(self, user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}",
+                "username": f"user{user_id}"}
+
+    def text(self, text: str, chat_id: Optional[int] = None,
+             user_id: Optional[int] = None) -> Dict[str, Any]:
+        chat_id, user_id = self._chat_user(chat_id, user_id)
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(datetime.now(timezone.utc).timestamp()),
+                "chat": self._chat(chat_id),
+                "from": self._user(user_id),
+                "text": text,
+            },
+        }
+
+    def callback(self, data: str, chat_id: Optional[int] = None,
+                 user_id: Optional[int] = None) -> Dict[str, Any]:
+        chat_id, user_id = self._chat_user(chat_id, user_id)
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "chat_instance": str(chat_id),
+                "from": self._user(user_id),
+                "data": data,
+                "message": {
+                    "message_id": next(self._message_ids),
+                    "date": int(datetime.now(timezone.utc).timestamp()),
+                    "chat": self._chat(chat_id),
+                    "from": {"id": 123456, "is_bot": True, "first_name": "Bench"},
+                    "text": "Bench",
+                },
+            },
+        }
+
+    def amount(self, chat_id: Optional[int] = None, user_id: Optional[int] = None) -> Dict[str, Any]:
+        """Сообщение с суммой в формате быстрого ввода, например '+1500 нал'"""
+        sign = self._random.choice(["", "+", "+", "-"])
+        value = self._random.randint(1, 50000)
+        payment = self._random.choice(["нал", "карт", "наличными", "card"])
+        return self.text(f"{sign}{value} {payment}", chat_id, user_id)
@@ -8,3 +8,58 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не найден в переменных окружения")
 
+# Кэш проверки прав администратора (секунды)
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "300"))
+ADMIN_CACHE_NEGATIVE_TTL = int(os.getenv("ADMIN_CACHE_NEGATIVE_TTL", "60"))
+
+# Хранилище состояний FSM
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "3600"))  # секунд простоя до сброса диалога
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+
+# Кэш готовых отчетов (юнит-экономика, сводная таблица, категории): сколько отчетов держать
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "5000"))
+
+# Режим вебхука (python main.py --mode webhook)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес бота, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "100"))
+WEBHOOK_DRAIN_TIMEOUT = int(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))  # секунд на завершение обработки при остановке
+
+# Шардирование чатов по процессам (python main.py --workers N): число исполнителей
+# и сколько обновлений может ждать в очереди одного исполнителя
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "1"))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "10000"))
+
+# Лимиты исходящих сообщений (Telegram: ~20 в минуту в группу, ~1 в секунду в личный чат, ~30 в секунду всего)
+SEND_GROUP_RATE_PER_MINUTE = float(os.getenv("SEND_GROUP_RATE_PER_MINUTE", "20"))
+SEND_GROUP_BURST = float(os.getenv("SEND_GROUP_BURST", "5"))
+SEND_PRIVATE_RATE = float(os.getenv("SEND_PRIVATE_RATE", "1"))
+SEND_PRIVATE_BURST = float(os.getenv("SEND_PRIVATE_BURST", "3"))
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Живой баланс: через сколько секунд после первой из серии транзакций обновлять сообщение
+LIVE_BALANCE_DEBOUNCE = float(os.getenv("LIVE_BALANCE_DEBOUNCE", "3"))
+
+# Метрики Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (0 - не запускать сервер)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Журнал медленных SQL-запросов: порог в миллисекундах (0 - не писать) и размер сводки по SIGUSR1 и /queries
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+QUERY_REPORT_TOP = int(os.getenv("QUERY_REPORT_TOP", "20"))
+
+# Архив старых транзакций: переносить транзакции старше ARCHIVE_AFTER_DAYS дней
+# (0 - не переносить) раз в ARCHIVE_INTERVAL секунд
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "86400"))
+
+# Ежедневный Z-отчет (/zreport): часовой пояс чатов по умолчанию (часы от UTC),
+# окно в секундах, по которому разносятся отчеты чатов с одинаковым временем,
+# и сколько отчетов считать в секунду
+ZREPORT_UTC_OFFSET = float(os.getenv("ZREPORT_UTC_OFFSET", "3"))
+ZREPORT_WINDOW = int(os.getenv("ZREPORT_WINDOW", "600"))
+ZREPORT_RATE = float(os.getenv("ZREPORT_RATE", "5"))
@@ -0,0 +1,385 @@
+"""
+CSV-формат транзакций: импорт выгрузок из других систем и выгрузка
+Файлы читаются и пишутся потоково пачками в отдельном потоке, чтобы не
+держать их в памяти и не останавливать обработку сообщений
+"""
+import asyncio
+import codecs
+import csv
+import gzip
+import logging
+import math
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+# Колонки файла в порядке по умолчанию
+CSV_COLUMNS = (
+    'date', 'operation', 'payment', 'amount', 'category',
+    'quantity', 'unit_price', 'cost', 'description', 'username'
+)
+
+# Русские названия колонок для заголовка файла
+CSV_COLUMN_TITLES = {
+    'date': 'дата',
+    'operation': 'операция',
+    'payment': 'оплата',
+    'amount': 'сумма',
+    'category': 'категория',
+    'quantity': 'количество',
+    'unit_price': 'цена',
+    'cost': 'расходы',
+    'description': 'описание',
+    'username': 'пользователь',
+}
+
+# Разделитель при выгрузке: так файл открывается в Excel с русской локалью
+EXPORT_DELIMITER = ';'
+
+# Строк в одной транзакции БД при импорте
+IMPORT_BATCH_SIZE = 50000
+# Сколько ошибок в строках показывать в отчете и какой длины
+MAX_REPORTED_ERRORS = 10
+MAX_ERROR_LENGTH = 100
+# Длина названия категории, как при создании через бота
+MAX_CATEGORY_NAME = 50
+
+# Объем начала файла для определения кодировки и разделителя
+_SAMPLE_SIZE = 64 * 1024
+# Начало файла, сжатого gzip
+_GZIP_MAGIC = b'\x1f\x8b'
+
+_HEADER_ALIASES = {column: column for column in CSV_COLUMNS}
+_HEADER_ALIASES.update({title: column for column, title in CSV_COLUMN_TITLES.items()})
+_HEADER_ALIASES.update({
+    'created_at': 'date', 'дата и время': 'date', 'время': 'date',
+    'operation_type': 'operation', 'тип': 'operation', 'тип операции': 'operation',
+    'payment_type': 'payment', 'тип оплаты': 'payment', 'способ оплаты': 'payment',
+    'сумма, ₽': 'amount', 'сумма, руб': 'amount',
+    'категория/источник': 'category', 'источник': 'category',
+    'кол-во': 'quantity', 'кол': 'quantity', 'qty': 'quantity',
+    'цена за единицу': 'unit_price', 'price': 'unit_price',
+    'себестоимость': 'cost', 'расход': 'cost', 'expense': 'cost',
+    'комментарий': 'description', 'comment': 'description',
+    'user': 'username',
+})
+
+_OPERATIONS = {
+    '+': 'add', 'add': 'add', 'income': 'add', 'доход': 'add',
+    'приход': 'add', 'пополнение': 'add', 'добавить': 'add',
+    '-': 'subtract', 'subtract': 'subtract', 'expense': 'subtract', 'расход': 'subtract',
+    'списание': 'subtract', 'вычесть': 'subtract', 'вычет': 'subtract',
+}
+# Порядок важен: "безнал" и "cashless" начинаются как наличные
+_PAYMENT_PREFIXES = (
+    ('безнал', 'card'), ('cashless', 'card'), ('карт', 'card'), ('card', 'card'),
+    ('нал', 'cash'), ('cash', 'cash'),
+)
+_CATEGORY_TYPES = {'add': 'income_source', 'subtract': 'expense_category'}
+
+_DATE_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d.%m.%Y')
+
+
+class ImportedRow(NamedTuple):
+    """Проверенная строка файла, суммы в рублях"""
+    created_at: str
+    operation_type: str
+    payment_type: str
+    amount: float
+    category: Optional[str]
+    quantity: Optional[float]
+    unit_price: Optional[float]
+    cost: Optional[float]
+    description: Optional[str]
+    username: Optional[str]
+
+
+class ImportResult:
+    """Итоги импорта"""
+
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.skipped = 0
+        self.categories_created = 0
+        self.errors: List[Tuple[int, str]] = []
+
+    def add_error(self, line: int, error: str):
+        self.skipped += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, error[:MAX_ERROR_LENGTH]))
+
+
+def _detect_encoding(sample: bytes) -> str:
+    """UTF-8 (в том числе с BOM из Excel) или, если не декодируется, cp1251"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # Последний символ может быть разрезан границей выборки
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'cp1251'
+
+
+def _detect_dialect(sample: str):
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        return csv.excel
+
+
+def _parse_number(value: str) -> Optional[float]:
+    try:
+        number = float(value)
+    except ValueError:
+        # "1 234,50" из таблиц с русской локалью
+        cleaned = value.replace('\xa0', '').replace(' ', '').replace(',', '.')
+        if not cleaned:
+            return None
+        try:
+            number = float(cleaned)
+        except ValueError:
+            raise ValueError(f"неверное число '{value.strip()}'") from None
+    if not math.isfinite(number):
+        raise ValueError(f"неверное число '{value.strip()}'")
+    return number
+
+
+def _parse_date(value: str, now: str) -> str:
+    """Дата в формате created_at (UTC). Время без часового пояса считается UTC"""
+    value = value.strip()
+    if not value:
+        return now
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        for date_format in _DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(value, date_format)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(f"непонятная дата '{value}'")
+    else:
+        if parsed.tzinfo is None and _is_stored_timestamp(value):
+            # Уже в формате хранения (так выгружает /export)
+            return value
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc)
+    return parsed.strftime(db.TIMESTAMP_FORMAT)
+
+
+def _is_stored_timestamp(value: str) -> bool:
+    """Строка в формате created_at ('2024-01-05 10:00:00'), годная без преобразования"""
+    return (len(value) == 19 and value[4] == '-' and value[7] == '-' and value[10] == ' '
+            and value[13] == ':' and value[16] == ':')
+
+
+def _parse_payment(value: str) -> str:
+    value = value.strip().lower()
+    for prefix, payment_type in _PAYMENT_PREFIXES:
+        if value.startswith(prefix):
+            return payment_type
+    raise ValueError(f"непонятный тип оплаты '{value}'")
+
+
+def _parse_operation(value: str) -> Optional[str]:
+    value = value.strip().lower()
+    if not value:
+        return None
+    operation_type = _OPERATIONS.get(value)
+    if operation_type is None:
+        raise ValueError(f"непонятная операция '{value}'")
+    return operation_type
+
+
+class _RowParser:
+    """Проверка и преобразование строк файла по его заголовку.
+    Значения оплаты и операции в файле повторяются, их разбор запоминается"""
+
+    def __init__(self, header: List[str]):
+        columns = [_HEADER_ALIASES.get(title.strip().lower()) for title in header]
+        if 'amount' not in columns or 'payment' not in columns:
+            raise ValueError(
+                "В первой строке файла должны быть названия колонок, "
+                "обязательны 'сумма' и 'оплата'"
+            )
+        self.width = len(columns)
+        # Индекс колонки в строке; отсутствующие колонки читаются из пустой ячейки в конце
+        self.index = {column: columns.index(column) if column in columns else self.width
+                      for column in CSV_COLUMNS}
+        self.now = datetime.now(timezone.utc).strftime(db.TIMESTAMP_FORMAT)
+        self._payments = {}
+        self._operations = {}
+
+    def _cached(self, cache: dict, parse, value: str):
+        result = cache.get(value)
+        if result is None:
+            result = parse(value)
+            if len(cache) < 1000:
+                cache[value] = result
+        return result
+
+    def parse(self, values: List[str]) -> ImportedRow:
+        if len(values) != self.width:
+            values = (values + [''] * self.width)[:self.width]
+        values.append('')
+        index = self.index
+
+        amount = _parse_number(values[index['amount']])
+        if amount is None:
+            raise ValueError("не указана сумма")
+        operation = values[index['operation']]
+        operation_type = self._cached(self._operations, _parse_operation, operation) if operation else None
+        if operation_type is None:
+            operation_type = 'subtract' if amount < 0 else 'add'
+        amount = abs(amount)
+        if amount == 0:
+            raise ValueError("нулевая сумма")
+
+        category = values[index['category']].strip() or None
+        if category is not None and len(category) > MAX_CATEGORY_NAME:
+            raise ValueError(f"название категории длиннее {MAX_CATEGORY_NAME} символов")
+        quantity = values[index['quantity']]
+        unit_price = values[index['unit_price']]
+        cost = values[index['cost']]
+
+        return ImportedRow(
+            _parse_date(values[index['date']], self.now),
+            operation_type,
+            self._cached(self._payments, _parse_payment, values[index['payment']]),
+            amount,
+            category,
+            _parse_number(quantity) if quantity else None,
+            _parse_number(unit_price) if unit_price else None,
+            _parse_number(cost) if cost else None,
+            values[index['description']].strip() or None,
+            values[index['username']].strip() or None,
+        )
+
+
+def _read_batches(path: str, batch_size: int) -> Iterator[List[Tuple[int, object]]]:
+    """Пачки строк файла: (номер строки, ImportedRow или текст ошибки).
+    Файл может быть сжат gzip, как выгрузка /export"""
+    with open(path, 'rb') as f:
+        compressed = f.read(len(_GZIP_MAGIC)) == _GZIP_MAGIC
+    opener = gzip.open if compressed else open
+
+    with opener(path, 'rb') as f:
+        sample = f.read(_SAMPLE_SIZE)
+    encoding = _detect_encoding(sample)
+    text_sample = sample.decode(encoding, errors='ignore')
+
+    with opener(path, 'rt', encoding=encoding, newline='') as f:
+        reader = csv.reader(f, _detect_dialect(text_sample))
+        header = next(reader, None)
+        if header is None:
+            raise ValueError("Файл пустой")
+        parser = _RowParser(header)
+
+        batch = []
+        for values in reader:
+            if not any(values):
+                continue
+            try:
+                item = parser.parse(values)
+            except ValueError as e:
+                item = str(e)
+            batch.append((reader.line_num, item))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+async def import_transactions(
+    path: str,
+    chat_id: int,
+    user_id: Optional[int] = None,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    progress: Optional[Callable[[ImportResult], Awaitable[None]]] = None
+) -> ImportResult:
+    """Импорт транзакций чата из CSV-файла. Каждая пачка записывается одной
+    транзакцией БД вместе с балансами и дневными агрегатами; между пачками
+    писатель свободен для обычных операций"""
+    result = ImportResult()
+    category_ids = await db.ensure_categories(chat_id, ())
+    batches = _read_batches(path, batch_size)
+    try:
+        while True:
+            # Чтение и разбор пачки - в отдельном потоке
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            await _import_batch(batch, chat_id, user_id, category_ids, result)
+            if progress is not None:
+                await progress(result)
+    finally:
+        batches.close()
+
+    logger.info(f"Импорт в чат {chat_id}: {result.imported} строк, пропущено {result.skipped}")
+    return result
+
+
+async def _import_batch(batch: list, chat_id: int, user_id: Optional[int],
+                        category_ids: dict, result: ImportResult):
+    """Запись пачки: недостающие категории создаются одним запросом,
+    строки с ошибками попадают в отчет"""
+    result.rows += len(batch)
+
+    rows = []
+    for line, item in batch:
+        if isinstance(item, str):
+            result.add_error(line, item)
+        else:
+            rows.append(item)
+
+    missing = {
+        (_CATEGORY_TYPES[row.operation_type], row.category)
+        for row in rows
+        if row.category is not None
+        and (_CATEGORY_TYPES[row.operation_type], row.category.lower()) not in category_ids
+    }
+    if missing:
+        known = len(category_ids)
+        category_ids.update(await db.ensure_categories(chat_id, missing))
+        result.categories_created += len(category_ids) - known
+
+    # В хронологическом порядке id идут по времени, а вставки в индексы
+    # по created_at ложатся в соседние страницы
+    rows.sort(key=lambda row: row.created_at)
+    await db.add_transactions([
+        (chat_id, row.amount, row.payment_type, row.operation_type, row.description,
+         user_id, row.username,
+         category_ids[(_CATEGORY_TYPES[row.operation_type], row.category.lower())]
+         if row.category is not None else None,
+         row.quantity, row.unit_price, row.cost, row.created_at)
+        for row in rows
+    ])
+    result.imported += len(rows)
+
+
+async def export_transactions(path: str, chat_id: int, days: Optional[int] = None) -> int:
+    """Выгрузка транзакций чата в CSV, сжатый gzip, в формате импорта.
+    Строки читаются из БД пачками и сразу дописываются в файл, поэтому
+    память не растет с размером выгрузки. Возвращает количество строк"""
+    count = 0
+    # BOM нужен Excel, чтобы распознать UTF-8; импорт его понимает
+    with gzip.open(path, 'wt', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f, delimiter=EXPORT_DELIMITER)
+        writer.writerow([CSV_COLUMN_TITLES[column] for column in CSV_COLUMNS])
+        chunks = db.iter_transactions(chat_id, days)
+        try:
+            async for chunk in chunks:
+                # Форматирование и сжатие - в отдельном потоке
+                await asyncio.to_thread(writer.writerows, chunk)
+                count += len(chunk)
+        finally:
+            await chunks.aclose()
+    return count
@@ -1,54 +1,706 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+try:
+    import fcntl
+except ImportError:
+    # Windows: отметка работающего бота не ведется (claim_database)
+    fcntl = None
 import aiosqlite
-from datetime import datetime
-from typing import Optional, Tuple
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Optional, Tuple
+from cache import LRUCache
+from querylog import InstrumentedConnection
+
+logger = logging.getLogger(__name__)
 
 DB_NAME = "casse.db"
 
+# Формат CURRENT_TIMESTAMP в SQLite, в нем хранится created_at
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Параметры пула соединений
+READER_POOL_SIZE = 4
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KB = 16000
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Сколько чатов держать в кэше категорий
+CATEGORY_CACHE_SIZE = 1024
+
+# Сколько чатов держать в кэше настроек
+CHAT_SETTINGS_CACHE_SIZE = 4096
+
+# Параметры групповой записи транзакций
+WRITE_BATCH_DELAY = 0.005
+WRITE_BATCH_MAX = 500
+
+# Денежные суммы хранятся целым числом копеек
+KOPECKS_PER_RUBLE = 100
+
+# Сколько строк читать с курсора за раз при выгрузке
+EXPORT_CHUNK_SIZE = 5000
+
+# Параметры перевода старой БД (суммы в рублях, REAL) в копейки
+MIGRATION_CHUNK_SIZE = 5000
+MIGRATION_PAUSE = 0.05
+
+# Раздельные файлы БД (см. PartitionSet): сколько разделов держать открытыми
+# и сколько читателей в пуле раздела
+MAX_OPEN_PARTITIONS = 64
+PARTITION_READERS = 1
+PARTITION_LAYOUT_FILE = "layout.json"
+# Сколько чатов переносить одним запросом при разделении БД
+SPLIT_CHATS_PER_QUERY = 500
+
+# Перенос старых транзакций в архив: строк за одну транзакцию записи, пауза
+# между пачками и сколько страниц файла освобождать за один шаг очистки
+ARCHIVE_CHUNK_SIZE = 200
+ARCHIVE_PAUSE = 0.05
+VACUUM_PAGES_PER_STEP = 256
+
+# Фоновое удаление транзакций, скрытых сбросом: строк за одну транзакцию
+# записи и пауза между пачками
+PURGE_CHUNK_SIZE = 200
+PURGE_PAUSE = 0.05
+
+
+async def _connect(path: str, readonly: bool = False) -> aiosqlite.Connection:
+    """Открытие соединения с настроенными PRAGMA"""
+    conn = await aiosqlite.connect(path)
+    if not readonly:
+        # Новые файлы создаются с постраничным возвратом места (см. reclaim_space),
+        # существующие переходят на него после VACUUM
+        await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL позволяет читателям работать параллельно с писателем
+        await conn.execute("PRAGMA journal_mode = WAL")
+    await conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    await conn.execute("PRAGMA synchronous = NORMAL")
+    await conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+    await conn.execute("PRAGMA temp_store = MEMORY")
+    await conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    if readonly:
+        await conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+class TransactionBatcher:
+    """Очередь записи транзакций: вставки за несколько миллисекунд
+    записываются одним executemany и одним commit"""
+
+    def __init__(self, pool: "ConnectionPool", delay: float = WRITE_BATCH_DELAY,
+                 max_batch: int = WRITE_BATCH_MAX):
+        self._pool = pool
+        self._delay = delay
+        self._max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.rows = 0
+        self.last_batch_size = 0
+
+    @property
+    def depth(self) -> int:
+        """Количество транзакций, ожидающих записи"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Запись всех ожидающих транзакций и остановка очереди"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, row: tuple):
+        """Поставить транзакцию в очередь и дождаться ее фиксации в БД"""
+        if self._task is None:
+            raise RuntimeError("Очередь записи транзакций остановлена")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((row, future))
+        await future
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            # Одиночную запись не задерживаем; если за ней сразу идут
+            # другие, ждем окно в несколько миллисекунд и пишем их вместе
+            await asyncio.sleep(0)
+            if self._delay and not self._queue.empty():
+                await asyncio.sleep(self._delay)
+            while len(batch) < self._max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+        # Остановка: дописываем все, что успело попасть в очередь
+        rest = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                rest.append(item)
+        if rest:
+            await self._flush(rest)
+
+    async def _flush(self, batch: list):
+        try:
+            async with self._pool.write() as db:
+                await _insert_transactions(db, [row for row, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        _bump_data_versions({row[0] for row, _ in batch})
+        self.batches += 1
+        self.rows += len(batch)
+        self.last_batch_size = len(batch)
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+
+class ConnectionPool:
+    """Долгоживущие соединения с файлом БД: один писатель и несколько читателей.
+    Все выражения через пул замеряются (см. querylog)"""
+
+    def __init__(self, path: str, readers: int = READER_POOL_SIZE):
+        self.path = path
+        self.size = readers
+        self._writer: Optional[InstrumentedConnection] = None
+        self._readers: list = []
+        self._idle: Optional[asyncio.Queue] = None
+        self._write_lock = asyncio.Lock()
+        self.batcher = TransactionBatcher(self)
+
+    async def open(self):
+        """Открытие всех соединений пула"""
+        self._writer = InstrumentedConnection(await _connect(self.path))
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            conn = InstrumentedConnection(await _connect(self.path, readonly=True))
+            self._readers.append(conn)
+            self._idle.put_nowait(conn)
+        self.batcher.start()
+
+    async def close(self):
+        """Закрытие всех соединений пула"""
+        await self.batcher.close()
+        for conn in self._readers:
+            await conn.close()
+        self._readers.clear()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def write(self):
+        """Соединение на запись; транзакция фиксируется при выходе без ошибок"""
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            else:
+                await self._writer.commit()
+
+    @asynccontextmanager
+    async def read(self):
+        """Свободное соединение на чтение из пула"""
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+
+class _Partition:
+    __slots__ = ('pool', 'users')
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self.users = 0
+
+
+class PartitionSet:
+    """Раздельные файлы БД: транзакции, категории, балансы и дневные агрегаты
+    каждого чата (или корзины чатов по chat_id) лежат в своем файле, и запись
+    в разные файлы не ждет общей блокировки. Пулы файлов открываются при первом
+    обращении; сверх max_open закрываются давно не использованные простаивающие.
+    Раскладка хранится в layout.json каталога и задается при разделении БД"""
+
+    def __init__(self, directory: str, layout: dict, max_open: int = MAX_OPEN_PARTITIONS,
+                 readers: int = PARTITION_READERS):
+        self.directory = directory
+        self.per_chat = layout['mode'] == 'chat'
+        self.buckets = layout.get('buckets', 0)
+        self.max_open = max_open
+        self.readers = readers
+        self._open: "OrderedDict[str, _Partition]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # Счетчики групповой записи уже закрытых разделов
+        self.closed_batches = 0
+        self.closed_rows = 0
+
+    def name_of(self, chat_id: int) -> str:
+        if self.per_chat:
+            return f"chat_{chat_id}"
+        return f"bucket_{chat_id % self.buckets:04d}"
+
+    def path_of(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.db")
+
+    def names(self) -> list:
+        """Все существующие файлы-разделы"""
+        return sorted(entry[:-3] for entry in os.listdir(self.directory) if entry.endswith(".db"))
+
+    async def _open_partition(self, name: str) -> _Partition:
+        pool = ConnectionPool(self.path_of(name), self.readers)
+        await pool.open()
+        async with pool.write() as db:
+            await _create_partition_schema(db)
+            pending = await _pending_purges(db)
+        partition = self._open[name] = _Partition(pool)
+        # Лишние закрываются после открытия нового, пока он еще не занят
+        partition.users += 1
+        try:
+            await self._evict()
+        finally:
+            partition.users -= 1
+        # Очистка после сброса, прерванная остановкой бота, продолжается при открытии
+        if pending:
+            _schedule_purge(pending)
+        return partition
+
+    async def _evict(self):
+        while len(self._open) > self.max_open:
+            name = next((name for name, part in self._open.items() if not part.users), None)
+            if name is None:
+                return
+            await self._close(self._open.pop(name))
+            self._locks.pop(name, None)
+
+    async def _close(self, partition: _Partition):
+        await partition.pool.close()
+        self.closed_batches += partition.pool.batcher.batches
+        self.closed_rows += partition.pool.batcher.rows
+
+    @asynccontextmanager
+    async def pool(self, chat_id: Optional[int] = None, name: Optional[str] = None):
+        """Пул раздела чата (или раздела по имени); пока блок выполняется,
+        раздел не закрывается"""
+        name = name or self.name_of(chat_id)
+        partition = self._open.get(name)
+        if partition is None:
+            async with self._locks.setdefault(name, asyncio.Lock()):
+                partition = self._open.get(name) or await self._open_partition(name)
+        partition.users += 1
+        self._open.move_to_end(name)
+        try:
+            yield partition.pool
+        finally:
+            partition.users -= 1
+
+    @asynccontextmanager
+    async def write(self, chat_id: int):
+        async with self.pool(chat_id) as pool:
+            async with pool.write() as db:
+                yield db
+
+    @asynccontextmanager
+    async def read(self, chat_id: int):
+        async with self.pool(chat_id) as pool:
+            async with pool.read() as db:
+                yield db
+
+    async def drop(self, chat_id: int):
+        """Удаление файла чата целиком (раскладка по чатам). Новые обращения
+        к чату ждут удаления и получают пустой файл, в котором нумерация
+        транзакций и категорий продолжается: кнопки старых сообщений ссылаются
+        на прежние id и не должны попасть на новые строки"""
+        name = self.name_of(chat_id)
+        async with self._locks.setdefault(name, asyncio.Lock()):
+            partition = self._open.pop(name, None)
+            if partition is not None:
+                # Дожидаемся начатых до сброса запросов и записей
+                while partition.users:
+                    await asyncio.sleep(0.01)
+                await self._close(partition)
+            path = self.path_of(name)
+            sequences = []
+            if os.path.exists(path):
+                async with aiosqlite.connect(path) as db:
+                    cursor = await db.execute("SELECT name, seq FROM sqlite_sequence")
+                    sequences = await cursor.fetchall()
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(path + suffix)
+                except FileNotFoundError:
+                    pass
+            if sequences:
+                partition = await self._open_partition(name)
+                async with partition.pool.write() as db:
+                    await db.executemany(
+                        "INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", sequences
+                    )
+
+    def stats(self) -> dict:
+        batchers = [partition.pool.batcher for partition in self._open.values()]
+        return {
+            'open': len(self._open),
+            'depth': sum(batcher.depth for batcher in batchers),
+            'batches': self.closed_batches + sum(batcher.batches for batcher in batchers),
+            'rows': self.closed_rows + sum(batcher.rows for batcher in batchers),
+        }
+
+    async def close(self):
+        while self._open:
+            _, partition = self._open.popitem()
+            await self._close(partition)
+
+
+_pool: Optional[ConnectionPool] = None
+# Файлы-разделы, если БД разделена (python maintenance.py split-db)
+_partitions: Optional[PartitionSet] = None
+
+
+def _partition_dir(path: str) -> str:
+    """Каталог файлов-разделов рядом с основным файлом: casse.db -> casse.parts"""
+    return os.path.splitext(path)[0] + ".parts"
+
+
+def _read_layout(directory: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(directory, PARTITION_LAYOUT_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# Отметка работающего бота: блокировка файла рядом с БД держится, пока жив
+# процесс, и снимается системой даже при аварийном завершении
+_claim = None
+
+
+def claim_database(path: str = DB_NAME) -> bool:
+    """Отметка, что с файлом БД работает этот процесс (бот или служебная
+    команда, которой нужен остановленный бот). False - файл уже занят другим
+    процессом. Без fcntl (Windows) отметка не ведется"""
+    global _claim
+    if fcntl is None or _claim is not None:
+        return True
+    handle = open(path + ".lock", "w")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _claim = handle
+    return True
+
+
+def release_database():
+    global _claim
+    handle, _claim = _claim, None
+    if handle is not None:
+        handle.close()
+
+
+async def open_pool(path: str = DB_NAME, readers: int = READER_POOL_SIZE):
+    """Открытие пула соединений (один раз при запуске бота).
+    Если БД разделена, файлы-разделы открываются по мере обращения к чатам"""
+    global _pool, _partitions
+    if _pool is not None:
+        return
+    pool = ConnectionPool(path, readers)
+    await pool.open()
+    _pool = pool
+    directory = _partition_dir(path)
+    layout = _read_layout(directory)
+    if layout is not None:
+        _partitions = PartitionSet(directory, layout)
+
+
+async def close_pool():
+    """Закрытие пула соединений при остановке бота"""
+    global _pool, _partitions
+    if _pool is None:
+        return
+    await _stop_purge()
+    pool, _pool = _pool, None
+    partitions, _partitions = _partitions, None
+    if partitions is not None:
+        await partitions.close()
+    await pool.close()
+
+
+def _get_pool() -> ConnectionPool:
+    if _pool is None:
+        raise RuntimeError("Пул соединений с БД не открыт, вызовите open_pool()")
+    return _pool
+
+
+def _write(chat_id: Optional[int] = None):
+    """Соединение на запись: файла-раздела чата, если БД разделена, иначе основного файла"""
+    if chat_id is not None and _partitions is not None:
+        return _partitions.write(chat_id)
+    return _get_pool().write()
+
+
+def _read(chat_id: Optional[int] = None):
+    """Соединение на чтение: файла-раздела чата, если БД разделена, иначе основного файла"""
+    if chat_id is not None and _partitions is not None:
+        return _partitions.read(chat_id)
+    return _get_pool().read()
+
+
+def get_write_queue_stats() -> dict:
+    """Состояние очереди групповой записи транзакций"""
+    batcher = _get_pool().batcher
+    stats = {
+        'depth': batcher.depth,
+        'batches': batcher.batches,
+        'rows': batcher.rows,
+        'last_batch_size': batcher.last_batch_size
+    }
+    if _partitions is not None:
+        partitions = _partitions.stats()
+        stats['depth'] += partitions['depth']
+        stats['batches'] += partitions['batches']
+        stats['rows'] += partitions['rows']
+        stats['open_partitions'] = partitions['open']
+    return stats
+
+
+async def _table_exists(db: aiosqlite.Connection, name: str) -> bool:
+    cursor = await db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+    )
+    row = await cursor.fetchone()
+    await cursor.close()
+    return row is not None
+
+
+# Денежные суммы (amount, unit_price, cost) - в копейках, количество - дробное
+_TRANSACTIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        payment_type TEXT NOT NULL,
+        operation_type TEXT NOT NULL,
+        description TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        user_id INTEGER,
+        username TEXT,
+        category_id INTEGER,
+        quantity REAL,
+        unit_price INTEGER,
+        cost INTEGER
+    )
+"""
+
+_CATEGORIES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        description TEXT,
+        type TEXT NOT NULL DEFAULT 'income_source',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(chat_id, name, type)
+    )
+"""
+
+# Текущий баланс чата в копейках, обновляется вместе с каждой транзакцией
+_BALANCES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        chat_id INTEGER PRIMARY KEY,
+        cash INTEGER NOT NULL DEFAULT 0,
+        card INTEGER NOT NULL DEFAULT 0
+    )
+"""
+
+# Дневные агрегаты для отчетов за период
+_DAILY_ROLLUPS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        chat_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        category_id INTEGER NOT NULL DEFAULT 0,
+        payment_type TEXT NOT NULL,
+        operation_type TEXT NOT NULL,
+        amount_sum INTEGER NOT NULL DEFAULT 0,
+        quantity_sum REAL NOT NULL DEFAULT 0,
+        cost_sum INTEGER NOT NULL DEFAULT 0,
+        tx_count INTEGER NOT NULL DEFAULT 0,
+        unit_price_sum INTEGER NOT NULL DEFAULT 0,
+        unit_price_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, day, category_id, payment_type, operation_type)
+    ) WITHOUT ROWID
+"""
+
+
+async def _create_transaction_indexes(db: aiosqlite.Connection, table: str):
+    """Индексы таблицы транзакций (имена не зависят от имени таблицы,
+    чтобы пережить переименование при переводе сумм в копейки)"""
+    await db.execute(f"CREATE INDEX IF NOT EXISTS idx_tx_created ON {table}(created_at)")
+    # История и отчеты по чату за период
+    await db.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_tx_chat_created
+        ON {table}(chat_id, created_at)
+    """)
+    # История по категории с постраничным переходом по (created_at, id);
+    # rowid неявно идет последней колонкой любого индекса, поэтому этот индекс
+    # и idx_tx_chat_created упорядочены ровно по ключу страниц
+    await db.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_tx_chat_category_created
+        ON {table}(chat_id, category_id, created_at)
+    """)
+    # Покрывающий индекс для отчетов по категориям за период
+    await db.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_tx_chat_category_op_created
+        ON {table}(chat_id, category_id, operation_type, created_at,
+                   amount, quantity, unit_price, cost)
+    """)
+
+
+# Итоги перенесенных в архив транзакций по чату, категории, способу оплаты и типу
+# операции: из них складывается переходящий остаток при пересчете балансов
+_ARCHIVE_SNAPSHOTS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS archive_snapshots (
+        chat_id INTEGER NOT NULL,
+        category_id INTEGER NOT NULL DEFAULT 0,
+        payment_type TEXT NOT NULL,
+        operation_type TEXT NOT NULL,
+        amount_sum INTEGER NOT NULL DEFAULT 0,
+        quantity_sum REAL NOT NULL DEFAULT 0,
+        cost_sum INTEGER NOT NULL DEFAULT 0,
+        tx_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, category_id, payment_type, operation_type)
+    ) WITHOUT ROWID
+"""
+
+
+# Поколения данных чатов: сброс начинает новое поколение, и транзакции с id
+# меньше first_id сразу перестают быть видны, а удаляются потом в фоне
+_CHAT_GENERATIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS chat_generations (
+        chat_id INTEGER PRIMARY KEY,
+        generation INTEGER NOT NULL DEFAULT 0,
+        first_id INTEGER NOT NULL DEFAULT 0,
+        purge_pending INTEGER NOT NULL DEFAULT 0
+    )
+"""
+
+# Первый id текущего поколения чата (параметр - chat_id); условие
+# id >= этого значения должно быть во всех чтениях transactions и архива
+_GENERATION_START_SQL = "COALESCE((SELECT first_id FROM chat_generations WHERE chat_id = ?), 0)"
+
+
+async def _create_archive_tables(db: aiosqlite.Connection):
+    """Архив старых транзакций (та же схема, один индекс для выгрузки) и его итоги"""
+    await db.execute(_TRANSACTIONS_TABLE_SQL.format(table='transactions_archive'))
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tx_archive_chat_created
+        ON transactions_archive(chat_id, created_at)
+    """)
+    await db.execute(_ARCHIVE_SNAPSHOTS_TABLE_SQL)
+
+
+async def _create_rollup_indexes(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_daily_rollups_chat_category_op_day
+        ON daily_rollups(chat_id, category_id, operation_type, day)
+    """)
+
+
+# Таблицы с данными чатов, которые живут в файлах-разделах
+_PARTITIONED_TABLES = ('categories', 'transactions', 'balances', 'daily_rollups',
+                       'transactions_archive', 'archive_snapshots', 'chat_generations')
+
+
+async def _create_partition_schema(db: aiosqlite.Connection):
+    """Таблицы файла-раздела (суммы сразу в копейках)"""
+    await db.execute(_TRANSACTIONS_TABLE_SQL.format(table='transactions'))
+    await _create_transaction_indexes(db, 'transactions')
+    await db.execute(_CATEGORIES_TABLE_SQL)
+    await db.execute(_BALANCES_TABLE_SQL.format(table='balances'))
+    await db.execute(_DAILY_ROLLUPS_TABLE_SQL.format(table='daily_rollups'))
+    await _create_rollup_indexes(db)
+    await _create_archive_tables(db)
+    await db.execute(_CHAT_GENERATIONS_TABLE_SQL)
+
+
+async def _column_type(db: aiosqlite.Connection, table: str, column: str) -> Optional[str]:
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    columns = await cursor.fetchall()
+    for col in columns:
+        if col[1] == column:
+            return col[2].upper()
+    return None
+
 
 async def init_db():
     """Инициализация базы данных"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Создаем основную таблицу транзакций
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                amount REAL NOT NULL,
-                payment_type TEXT NOT NULL,
-                operation_type TEXT NOT NULL,
-                description TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                user_id INTEGER,
-                username TEXT
-            )
-        """)
-        
-        # Проверяем и добавляем новые поля для юнит-экономики (миграция)
-        cursor = await db.execute("PRAGMA table_info(transactions)")
-        columns = await cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        
-        if 'category_id' not in column_names:
-            await db.execute("ALTER TABLE transactions ADD COLUMN category_id INTEGER")
-        if 'quantity' not in column_names:
-            await db.execute("ALTER TABLE transactions ADD COLUMN quantity REAL")
-        if 'unit_price' not in column_names:
-            await db.execute("ALTER TABLE transactions ADD COLUMN unit_price REAL")
-        if 'cost' not in column_names:
-            await db.execute("ALTER TABLE transactions ADD COLUMN cost REAL")
+    global _money_scale, _money_migration_pending
+    async with _write() as db:
+        # Старая БД хранит суммы в рублях (REAL) до завершения migrate_money_to_kopecks()
+        legacy = await _column_type(db, 'transactions', 'amount') == 'REAL'
+        _money_scale = 1 if legacy else KOPECKS_PER_RUBLE
+        _money_migration_pending = legacy or await _table_exists(db, 'transactions_legacy')
+
+        if legacy:
+            # Проверяем и добавляем новые поля для юнит-экономики (миграция)
+            cursor = await db.execute("PRAGMA table_info(transactions)")
+            columns = await cursor.fetchall()
+            column_names = [col[1] for col in columns]
+            
+            if 'category_id' not in column_names:
+                await db.execute("ALTER TABLE transactions ADD COLUMN category_id INTEGER")
+            if 'quantity' not in column_names:
+                await db.execute("ALTER TABLE transactions ADD COLUMN quantity REAL")
+            if 'unit_price' not in column_names:
+                await db.execute("ALTER TABLE transactions ADD COLUMN unit_price REAL")
+            if 'cost' not in column_names:
+                await db.execute("ALTER TABLE transactions ADD COLUMN cost REAL")
+
+            # Индексы старой таблицы, нужны до окончания перевода в копейки
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_transactions_created 
+                ON transactions(created_at)
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_transactions_chat_created
+                ON transactions(chat_id, created_at)
+            """)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_transactions_chat_category_op_created
+                ON transactions(chat_id, category_id, operation_type, created_at,
+                                amount, quantity, unit_price, cost)
+            """)
+            await db.execute("DROP INDEX IF EXISTS idx_transactions_chat_category")
+        else:
+            # Создаем основную таблицу транзакций
+            await db.execute(_TRANSACTIONS_TABLE_SQL.format(table='transactions'))
+            await _create_transaction_indexes(db, 'transactions')
         
         # Таблица категорий для юнит-экономики (источники дохода и категории расходов)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS categories (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                name TEXT NOT NULL,
-                description TEXT,
-                type TEXT NOT NULL DEFAULT 'income_source',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(chat_id, name, type)
-            )
-        """)
+        await db.execute(_CATEGORIES_TABLE_SQL)
         
         # Добавляем поле type, если таблица уже существовала
         cursor = await db.execute("PRAGMA table_info(categories)")
@@ -56,18 +708,727 @@ async def init_db():
         column_names = [col[1] for col in columns]
         if 'type' not in column_names:
             await db.execute("ALTER TABLE categories ADD COLUMN type TEXT NOT NULL DEFAULT 'income_source'")
-        
-        # Индексы для оптимизации запросов
+
+        # Архив старых транзакций; его итоги входят в пересчет балансов
+        await _create_archive_tables(db)
+        # Поколения данных чатов (сброс без удаления транзакций)
+        await db.execute(_CHAT_GENERATIONS_TABLE_SQL)
+
+        # Текущий баланс чата, обновляется вместе с каждой транзакцией
+        balances_existed = await _table_exists(db, 'balances')
+        await db.execute(_BALANCES_TABLE_SQL.format(table='balances'))
+        if not balances_existed:
+            await _rebuild_balances(db)
+
+        # Дневные агрегаты для отчетов за период
+        rollups_existed = await _table_exists(db, 'daily_rollups')
+        await db.execute(_DAILY_ROLLUPS_TABLE_SQL.format(table='daily_rollups'))
+        await _create_rollup_indexes(db)
+
+        # Состояния FSM (незавершенные диалоги пользователей)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                updated_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
         await db.execute("""
-            CREATE INDEX IF NOT EXISTS idx_transactions_chat_category 
-            ON transactions(chat_id, category_id)
+            CREATE INDEX IF NOT EXISTS idx_fsm_states_updated
+            ON fsm_states(updated_at)
         """)
+
+        # Настройки чатов
         await db.execute("""
-            CREATE INDEX IF NOT EXISTS idx_transactions_created 
-            ON transactions(created_at)
+            CREATE TABLE IF NOT EXISTS chat_settings (
+                chat_id INTEGER PRIMARY KEY,
+                live_balance INTEGER NOT NULL DEFAULT 0,
+                balance_message_id INTEGER
+            )
         """)
-        
-        await db.commit()
+        # Ежедневный Z-отчет: время отправки (ЧЧ:ММ, NULL - выключен), смещение
+        # часового пояса чата в минутах и последний отправленный день
+        cursor = await db.execute("PRAGMA table_info(chat_settings)")
+        column_names = [col[1] for col in await cursor.fetchall()]
+        if 'report_time' not in column_names:
+            await db.execute("ALTER TABLE chat_settings ADD COLUMN report_time TEXT")
+        if 'utc_offset' not in column_names:
+            await db.execute("ALTER TABLE chat_settings ADD COLUMN utc_offset INTEGER NOT NULL DEFAULT 0")
+        if 'last_report_day' not in column_names:
+            await db.execute("ALTER TABLE chat_settings ADD COLUMN last_report_day TEXT")
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_chat_settings_report_time
+            ON chat_settings(report_time) WHERE report_time IS NOT NULL
+        """)
+        # Счетчики пересчетов (maintenance.py выполняет их отдельным процессом):
+        # по ним запущенный бот узнает, что готовые отчеты устарели. chat_id 0 - все чаты
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS rebuild_versions (
+                chat_id INTEGER PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        # Сбросы, очистка после которых не закончилась до остановки бота
+        pending = await _pending_purges(db)
+
+    if _partitions is not None and _money_migration_pending:
+        # Файлы-разделы создаются сразу в копейках, основной файл переводится до разделения
+        raise RuntimeError("БД разделена, но основной файл хранит суммы в рублях: "
+                           "выполните python maintenance.py migrate-money")
+    if not rollups_existed:
+        await rebuild_rollups()
+    if pending:
+        _schedule_purge(pending)
+
+
+# Во сколько раз хранимое значение больше суммы в рублях: в старой БД до
+# перевода в копейки - 1, после - KOPECKS_PER_RUBLE. Определяется в init_db()
+_money_scale = KOPECKS_PER_RUBLE
+_money_migration_pending = False
+
+
+def _to_stored(rubles: Optional[float]):
+    """Сумма в рублях -> хранимое значение (целые копейки)"""
+    if rubles is None or _money_scale == 1:
+        return rubles
+    return int(round(rubles * _money_scale))
+
+
+def _from_stored(value) -> Optional[float]:
+    """Хранимое значение -> сумма в рублях"""
+    if value is None:
+        return None
+    return value / _money_scale
+
+
+def _stored_row(row: tuple) -> tuple:
+    """Перевод сумм транзакции (amount, unit_price, cost) в хранимые значения"""
+    row = list(row)
+    for i in (1, 9, 10):
+        row[i] = _to_stored(row[i])
+    return tuple(row)
+
+
+# Вклад операции в баланс: пополнение увеличивает, списание уменьшает
+_BALANCE_SIGN = {'add': 1, 'subtract': -1}
+
+
+_TRANSACTION_COLUMNS = (
+    "chat_id, amount, payment_type, operation_type, description, user_id, username, "
+    "category_id, quantity, unit_price, cost, created_at"
+)
+
+
+async def _insert_transactions(db: aiosqlite.Connection, rows: list):
+    """Вставка пачки транзакций вместе с изменением балансов и дневных агрегатов.
+    Суммы в строках - в рублях, в БД они пишутся в копейках"""
+    rows = [_stored_row(row) for row in rows]
+    await db.executemany(f"""
+        INSERT INTO transactions ({_TRANSACTION_COLUMNS})
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    await _apply_rollups(db, rows)
+
+    deltas = {}
+    for chat_id, amount, payment_type, operation_type, *_ in rows:
+        delta = amount * _BALANCE_SIGN.get(operation_type, 0)
+        cash_card = deltas.setdefault(chat_id, [0, 0])
+        if payment_type == 'cash':
+            cash_card[0] += delta
+        elif payment_type == 'card':
+            cash_card[1] += delta
+    await db.executemany("""
+        INSERT INTO balances (chat_id, cash, card)
+        VALUES (?, ?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET
+            cash = cash + excluded.cash,
+            card = card + excluded.card
+    """, [(chat_id, cash, card) for chat_id, (cash, card) in deltas.items()])
+
+
+async def _apply_rollups(db: aiosqlite.Connection, rows: list):
+    """Добавление пачки транзакций в дневные агрегаты"""
+    rollups = {}
+    for row in rows:
+        (chat_id, amount, payment_type, operation_type, _, _, _,
+         category_id, quantity, unit_price, cost, created_at) = row
+        key = (chat_id, created_at[:10], category_id or 0, payment_type, operation_type)
+        acc = rollups.setdefault(key, [0, 0, 0, 0, 0, 0])
+        acc[0] += amount
+        acc[1] += quantity or 0
+        acc[2] += cost or 0
+        acc[3] += 1
+        if quantity and quantity > 0 and unit_price is not None:
+            acc[4] += unit_price
+            acc[5] += 1
+    await db.executemany("""
+        INSERT INTO daily_rollups (
+            chat_id, day, category_id, payment_type, operation_type,
+            amount_sum, quantity_sum, cost_sum, tx_count, unit_price_sum, unit_price_count
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(chat_id, day, category_id, payment_type, operation_type) DO UPDATE SET
+            amount_sum = amount_sum + excluded.amount_sum,
+            quantity_sum = quantity_sum + excluded.quantity_sum,
+            cost_sum = cost_sum + excluded.cost_sum,
+            tx_count = tx_count + excluded.tx_count,
+            unit_price_sum = unit_price_sum + excluded.unit_price_sum,
+            unit_price_count = unit_price_count + excluded.unit_price_count
+    """, [key + tuple(acc) for key, acc in rollups.items()])
+
+
+async def _rebuild_rollups(db: aiosqlite.Connection, chat_id: int):
+    """Пересчет дневных агрегатов чата по транзакциям, включая архивные"""
+    await db.execute("DELETE FROM daily_rollups WHERE chat_id = ?", (chat_id,))
+    await db.execute(f"""
+        INSERT INTO daily_rollups (
+            chat_id, day, category_id, payment_type, operation_type,
+            amount_sum, quantity_sum, cost_sum, tx_count, unit_price_sum, unit_price_count
+        )
+        SELECT
+            chat_id,
+            date(created_at),
+            COALESCE(category_id, 0),
+            payment_type,
+            operation_type,
+            SUM(amount),
+            SUM(COALESCE(quantity, 0)),
+            SUM(COALESCE(cost, 0)),
+            COUNT(*),
+            SUM(CASE WHEN quantity > 0 THEN COALESCE(unit_price, 0) ELSE 0 END),
+            COUNT(CASE WHEN quantity > 0 THEN unit_price END)
+        FROM (
+            SELECT chat_id, created_at, category_id, payment_type, operation_type,
+                   amount, quantity, unit_price, cost
+            FROM transactions WHERE chat_id = ? AND id >= {_GENERATION_START_SQL}
+            UNION ALL
+            SELECT chat_id, created_at, category_id, payment_type, operation_type,
+                   amount, quantity, unit_price, cost
+            FROM transactions_archive WHERE chat_id = ? AND id >= {_GENERATION_START_SQL}
+        )
+        GROUP BY date(created_at), COALESCE(category_id, 0), payment_type, operation_type
+    """, (chat_id,) * 4)
+
+
+async def rebuild_rollups(chat_id: Optional[int] = None):
+    """Пересчет дневных агрегатов (для всех чатов или одного).
+    Каждый чат пересчитывается отдельной транзакцией, чтобы не блокировать запись надолго"""
+    if chat_id is not None:
+        chat_ids = [chat_id]
+    else:
+        chat_ids = await _all_chat_ids()
+    for chat_id in chat_ids:
+        async with _write(chat_id) as db:
+            await _rebuild_rollups(db, chat_id)
+        await _bump_rebuild_version(chat_id)
+        _bump_data_versions((chat_id,))
+
+
+async def _all_chat_ids() -> list:
+    """Чаты с транзакциями (в том числе архивными): в основном файле
+    или во всех файлах-разделах"""
+    sql = "SELECT chat_id FROM transactions UNION SELECT chat_id FROM archive_snapshots"
+    if _partitions is None:
+        async with _read() as db:
+            cursor = await db.execute(sql)
+            return [row[0] for row in await cursor.fetchall()]
+    chat_ids = []
+    for name in _partitions.names():
+        async with _partitions.pool(name=name) as pool:
+            async with pool.read() as db:
+                cursor = await db.execute(sql)
+                chat_ids.extend(row[0] for row in await cursor.fetchall())
+    return chat_ids
+
+
+async def _rebuild_balances(db: aiosqlite.Connection, chat_id: Optional[int] = None):
+    """Пересчет таблицы balances по таблице transactions и переходящему остатку
+    архивных транзакций (archive_snapshots)"""
+    chat_filter = "WHERE chat_id = ?" if chat_id is not None else ""
+    params = (chat_id,) if chat_id is not None else ()
+    # Транзакции прошлых поколений (до сброса) не учитываются
+    transactions_filter = ("WHERE t.id >= COALESCE((SELECT first_id FROM chat_generations g "
+                           "WHERE g.chat_id = t.chat_id), 0)")
+    if chat_id is not None:
+        transactions_filter += " AND t.chat_id = ?"
+    await db.execute(f"DELETE FROM balances {chat_filter}", params)
+    await db.execute(f"""
+        INSERT INTO balances (chat_id, cash, card)
+        SELECT
+            chat_id,
+            COALESCE(SUM(CASE WHEN payment_type = 'cash' THEN
+                CASE operation_type WHEN 'add' THEN amount WHEN 'subtract' THEN -amount ELSE 0 END
+            ELSE 0 END), 0),
+            COALESCE(SUM(CASE WHEN payment_type = 'card' THEN
+                CASE operation_type WHEN 'add' THEN amount WHEN 'subtract' THEN -amount ELSE 0 END
+            ELSE 0 END), 0)
+        FROM (
+            SELECT chat_id, payment_type, operation_type, amount
+            FROM transactions t {transactions_filter}
+            UNION ALL
+            SELECT chat_id, payment_type, operation_type, amount_sum
+            FROM archive_snapshots {chat_filter}
+        )
+        GROUP BY chat_id
+    """, params * 2)
+
+
+async def rebuild_balances(chat_id: Optional[int] = None):
+    """Пересчет балансов из истории транзакций (для всех чатов или одного)"""
+    if chat_id is not None or _partitions is None:
+        async with _write(chat_id) as db:
+            await _rebuild_balances(db, chat_id)
+    else:
+        for name in _partitions.names():
+            async with _partitions.pool(name=name) as pool:
+                async with pool.write() as db:
+                    await _rebuild_balances(db)
+    await _bump_rebuild_version(chat_id)
+    if chat_id is not None:
+        _bump_data_versions((chat_id,))
+    else:
+        _bump_all_data_versions()
+
+
+async def split_into_partitions(per_chat: bool, buckets: int = 0, progress=None) -> int:
+    """Перенос данных чатов из основного файла в файлы-разделы: по файлу на чат
+    (per_chat) или на корзину chat_id % buckets. Бот должен быть остановлен.
+    Возвращает количество перенесенных чатов"""
+    if _partitions is not None:
+        raise RuntimeError("БД уже разделена")
+    if _money_migration_pending:
+        raise RuntimeError("Сначала переведите суммы в копейки: python maintenance.py migrate-money")
+    if not per_chat and buckets < 1:
+        raise ValueError("Число корзин должно быть положительным")
+    directory = _partition_dir(_get_pool().path)
+    os.makedirs(directory, exist_ok=True)
+    layout = {'mode': 'chat'} if per_chat else {'mode': 'bucket', 'buckets': buckets}
+    partitions = PartitionSet(directory, layout, max_open=1)
+    # Файлы, оставшиеся от прерванного разделения, заполняются заново
+    for name in partitions.names():
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(partitions.path_of(name) + suffix)
+            except FileNotFoundError:
+                pass
+
+    async with _read() as db:
+        cursor = await db.execute("""
+            SELECT chat_id FROM transactions
+            UNION SELECT chat_id FROM categories
+            UNION SELECT chat_id FROM balances
+            UNION SELECT chat_id FROM archive_snapshots
+        """)
+        chat_ids = [row[0] for row in await cursor.fetchall()]
+    by_name: Dict[str, list] = {}
+    for chat_id in chat_ids:
+        by_name.setdefault(partitions.name_of(chat_id), []).append(chat_id)
+
+    for name, chats in by_name.items():
+        # Таблицы раздела создаются при его открытии
+        async with partitions.pool(name=name):
+            pass
+        await partitions.close()
+        # ATTACH и DETACH нельзя выполнять внутри транзакции
+        async with _write() as db:
+            await db.execute("ATTACH DATABASE ? AS part", (partitions.path_of(name),))
+        try:
+            async with _write() as db:
+                for table in _PARTITIONED_TABLES:
+                    cursor = await db.execute(f"PRAGMA main.table_info({table})")
+                    columns = ", ".join(row[1] for row in await cursor.fetchall())
+                    # id сохраняются: на них ссылаются транзакции и кнопки в старых сообщениях
+                    for start in range(0, len(chats), SPLIT_CHATS_PER_QUERY):
+                        part = chats[start:start + SPLIT_CHATS_PER_QUERY]
+                        await db.execute(f"""
+                            INSERT INTO part.{table} ({columns})
+                            SELECT {columns} FROM main.{table}
+                            WHERE chat_id IN ({", ".join("?" * len(part))})
+                        """, part)
+                # Новые id раздела продолжают общую нумерацию: first_id поколений
+                # чатов, взятый из основного файла, остается верным
+                await db.execute("DELETE FROM part.sqlite_sequence WHERE name = 'transactions'")
+                await db.execute("""
+                    INSERT INTO part.sqlite_sequence (name, seq)
+                    SELECT name, seq FROM main.sqlite_sequence WHERE name = 'transactions'
+                """)
+        finally:
+            async with _write() as db:
+                await db.execute("DETACH DATABASE part")
+        if progress is not None:
+            progress(name, len(chats))
+
+    # С этого момента бот работает с разделами; данные основного файла удаляются
+    layout_path = os.path.join(directory, PARTITION_LAYOUT_FILE)
+    with open(layout_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(layout, f)
+    os.replace(layout_path + ".tmp", layout_path)
+    async with _write() as db:
+        for table in _PARTITIONED_TABLES:
+            await db.execute(f"DELETE FROM {table}")
+    async with _write() as db:
+        await db.execute("VACUUM")
+    _bump_all_data_versions()
+    return len(chat_ids)
+
+
+# Архив старых транзакций: строки старше горизонта переносятся из transactions
+# в transactions_archive того же файла небольшими транзакциями, а их суммы
+# накапливаются в archive_snapshots. Баланс и дневные агрегаты при переносе
+# не меняются, поэтому отчеты и get_balance его не замечают. Горячая таблица
+# и ее индексы остаются размером в горизонт, у архива индекс один
+_ARCHIVE_COLUMNS = (
+    "id, chat_id, amount, payment_type, operation_type, description, created_at, "
+    "user_id, username, category_id, quantity, unit_price, cost"
+)
+
+
+async def _archive_chunk(db: aiosqlite.Connection, chat_id: int, before: str,
+                         chunk_size: int) -> int:
+    """Перенос в архив до chunk_size самых старых транзакций чата раньше before
+    (скрытые сбросом удаляются фоновой очисткой, а не переносятся)"""
+    cursor = await db.execute(f"""
+        SELECT id FROM transactions
+        WHERE chat_id = ? AND created_at < ? AND id >= {_GENERATION_START_SQL}
+        ORDER BY created_at, id LIMIT ?
+    """, (chat_id, before, chat_id, chunk_size))
+    ids = [row[0] for row in await cursor.fetchall()]
+    if not ids:
+        return 0
+    placeholders = ", ".join("?" * len(ids))
+    await db.execute(f"""
+        INSERT INTO transactions_archive ({_ARCHIVE_COLUMNS})
+        SELECT {_ARCHIVE_COLUMNS} FROM transactions WHERE id IN ({placeholders})
+    """, ids)
+    await db.execute(f"""
+        INSERT INTO archive_snapshots (
+            chat_id, category_id, payment_type, operation_type,
+            amount_sum, quantity_sum, cost_sum, tx_count
+        )
+        SELECT
+            chat_id,
+            COALESCE(category_id, 0),
+            payment_type,
+            operation_type,
+            SUM(amount),
+            SUM(COALESCE(quantity, 0)),
+            SUM(COALESCE(cost, 0)),
+            COUNT(*)
+        FROM transactions
+        WHERE id IN ({placeholders})
+        GROUP BY chat_id, COALESCE(category_id, 0), payment_type, operation_type
+        ON CONFLICT(chat_id, category_id, payment_type, operation_type) DO UPDATE SET
+            amount_sum = amount_sum + excluded.amount_sum,
+            quantity_sum = quantity_sum + excluded.quantity_sum,
+            cost_sum = cost_sum + excluded.cost_sum,
+            tx_count = tx_count + excluded.tx_count
+    """, ids)
+    await db.execute(f"DELETE FROM transactions WHERE id IN ({placeholders})", ids)
+    return len(ids)
+
+
+async def archive_old_transactions(days: int, chunk_size: int = ARCHIVE_CHUNK_SIZE,
+                                   pause: float = ARCHIVE_PAUSE, progress=None) -> int:
+    """Перенос в архив транзакций старше days календарных дней (UTC) и возврат
+    освободившегося места. Запись блокируется только на время одной пачки
+    из chunk_size строк. Возвращает количество перенесенных транзакций"""
+    if _money_migration_pending:
+        raise RuntimeError("Сначала переведите суммы в копейки: python maintenance.py migrate-money")
+    if days < 1:
+        raise ValueError("Горизонт архивации должен быть положительным")
+    before = _period_start_day(days)
+    total = 0
+    for chat_id in await _all_chat_ids():
+        moved = 0
+        while True:
+            async with _write(chat_id) as db:
+                count = await _archive_chunk(db, chat_id, before, chunk_size)
+            moved += count
+            if count < chunk_size:
+                break
+            # Между пачками проходят ожидающие записи бота
+            await asyncio.sleep(pause)
+        if moved:
+            total += moved
+            if progress is not None:
+                progress(chat_id, moved)
+    if total:
+        await reclaim_space(pause=pause)
+    return total
+
+
+async def has_archived_transactions(chat_id: int) -> bool:
+    """Есть ли у чата транзакции в архиве (история их не показывает)"""
+    async with _read(chat_id) as db:
+        cursor = await db.execute(
+            "SELECT EXISTS(SELECT 1 FROM archive_snapshots WHERE chat_id = ?)", (chat_id,)
+        )
+        return bool((await cursor.fetchone())[0])
+
+
+async def _pragma_value(db: aiosqlite.Connection, name: str) -> int:
+    cursor = await db.execute(f"PRAGMA {name}")
+    row = await cursor.fetchone()
+    await cursor.close()
+    return row[0]
+
+
+async def _reclaim_pool_space(pool: ConnectionPool, pages: int, pause: float) -> int:
+    """Возврат свободных страниц файла пула по pages за шаг"""
+    # Читатели могут помнить режим файла до VACUUM, поэтому спрашивается писатель.
+    # 2 - INCREMENTAL; у старых файлов режим меняется только полным VACUUM
+    async with pool.write() as db:
+        if await _pragma_value(db, "auto_vacuum") != 2:
+            return 0
+    freed = 0
+    while True:
+        async with pool.write() as db:
+            free = await _pragma_value(db, "freelist_count")
+            if free:
+                cursor = await db.execute(f"PRAGMA incremental_vacuum({pages})")
+                # Страницы освобождаются по мере чтения результата
+                await cursor.fetchall()
+                left = await _pragma_value(db, "freelist_count")
+        if not free or left >= free:
+            return freed
+        freed += free - left
+        await asyncio.sleep(pause)
+
+
+async def reclaim_space(pages: int = VACUUM_PAGES_PER_STEP, pause: float = ARCHIVE_PAUSE) -> int:
+    """Возврат свободного места файлам БД (основному или всем разделам) без
+    долгой блокировки записи. Возвращает количество освобожденных страниц"""
+    if _partitions is None:
+        return await _reclaim_pool_space(_get_pool(), pages, pause)
+    freed = 0
+    for name in _partitions.names():
+        async with _partitions.pool(name=name) as pool:
+            freed += await _reclaim_pool_space(pool, pages, pause)
+    return freed
+
+
+async def incremental_vacuum_enabled() -> bool:
+    """Поддерживает ли основной файл БД постраничный возврат места"""
+    async with _write() as db:
+        return await _pragma_value(db, "auto_vacuum") == 2
+
+
+async def _vacuum(pool: ConnectionPool):
+    async with pool.write() as db:
+        await db.execute("VACUUM")
+
+
+async def enable_incremental_vacuum():
+    """Перевод файлов БД на постраничный возврат места: полный VACUUM
+    каждого файла. Блокирует запись надолго, бот должен быть остановлен"""
+    await _vacuum(_get_pool())
+    if _partitions is not None:
+        for name in _partitions.names():
+            async with _partitions.pool(name=name) as pool:
+                await _vacuum(pool)
+
+
+# Перевод старой БД (суммы в рублях, REAL) в копейки без долгих блокировок записи:
+# строки копируются в transactions_new небольшими транзакциями, изменения старой
+# таблицы во время копирования переносятся триггерами, позиция копирования
+# хранится в schema_migrations и переживает перезапуск
+_MONEY_MIGRATION = 'money_kopecks'
+
+_TRANSACTION_COPY_COLUMNS = (
+    "id, chat_id, amount, payment_type, operation_type, description, created_at, "
+    "user_id, username, category_id, quantity, unit_price, cost"
+)
+
+
+def _kopecks_sql(expr: str) -> str:
+    return f"CAST(ROUND({expr} * {KOPECKS_PER_RUBLE}) AS INTEGER)"
+
+
+def _copy_values_sql(prefix: str = "") -> str:
+    """Значения строки старой таблицы с суммами, переведенными в копейки"""
+    p = prefix
+    return (
+        f"{p}id, {p}chat_id, {_kopecks_sql(p + 'amount')}, {p}payment_type, {p}operation_type, "
+        f"{p}description, {p}created_at, {p}user_id, {p}username, {p}category_id, "
+        f"{p}quantity, {_kopecks_sql(p + 'unit_price')}, {_kopecks_sql(p + 'cost')}"
+    )
+
+
+def money_migration_pending() -> bool:
+    """Нужно ли переводить суммы в копейки (по результатам init_db)"""
+    return _money_migration_pending
+
+
+async def _migration_cursor(db: aiosqlite.Connection) -> int:
+    cursor = await db.execute(
+        "SELECT cursor FROM schema_migrations WHERE name = ?", (_MONEY_MIGRATION,)
+    )
+    row = await cursor.fetchone()
+    await cursor.close()
+    return row[0]
+
+
+async def _start_money_migration(db: aiosqlite.Connection):
+    """Новая таблица и триггеры переноса изменений (повторный вызов ничего не меняет)"""
+    await db.execute("BEGIN IMMEDIATE")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            finished_at TIMESTAMP
+        )
+    """)
+    await db.execute(
+        "INSERT OR IGNORE INTO schema_migrations (name) VALUES (?)", (_MONEY_MIGRATION,)
+    )
+    await db.execute(_TRANSACTIONS_TABLE_SQL.format(table='transactions_new'))
+    # Индексы строятся на пустой таблице и дальше обновляются вместе с пачками
+    await _create_transaction_indexes(db, 'transactions_new')
+    for event in ('INSERT', 'UPDATE'):
+        await db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS transactions_money_{event.lower()}
+            AFTER {event} ON transactions
+            BEGIN
+                INSERT OR REPLACE INTO transactions_new ({_TRANSACTION_COPY_COLUMNS})
+                VALUES ({_copy_values_sql('NEW.')});
+            END
+        """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS transactions_money_delete
+        AFTER DELETE ON transactions
+        BEGIN
+            DELETE FROM transactions_new WHERE id = OLD.id;
+        END
+    """)
+
+
+async def _copy_money_chunk(db: aiosqlite.Connection, chunk_size: int) -> Tuple[int, int]:
+    """Копирование следующей пачки строк; возвращает (скопировано, позиция)"""
+    position = await _migration_cursor(db)
+    cursor = await db.execute("""
+        SELECT COUNT(*), MAX(id)
+        FROM (SELECT id FROM transactions WHERE id > ? ORDER BY id LIMIT ?)
+    """, (position, chunk_size))
+    count, last_id = await cursor.fetchone()
+    await cursor.close()
+    if not count:
+        return 0, position
+    # Строки, уже перенесенные триггером, актуальнее - их не трогаем
+    await db.execute(f"""
+        INSERT OR IGNORE INTO transactions_new ({_TRANSACTION_COPY_COLUMNS})
+        SELECT {_copy_values_sql()} FROM transactions WHERE id > ? AND id <= ?
+    """, (position, last_id))
+    await db.execute(
+        "UPDATE schema_migrations SET cursor = ? WHERE name = ?", (last_id, _MONEY_MIGRATION)
+    )
+    return count, last_id
+
+
+async def _convert_table(db: aiosqlite.Connection, table: str, create_sql: str,
+                         columns: str, values: str):
+    """Пересоздание небольшой производной таблицы с суммами в копейках"""
+    await db.execute(create_sql.format(table=f"{table}_new"))
+    await db.execute(f"INSERT INTO {table}_new ({columns}) SELECT {values} FROM {table}")
+    await db.execute(f"DROP TABLE {table}")
+    await db.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
+async def _swap_money_tables(db: aiosqlite.Connection):
+    """Подмена таблиц одной транзакцией: старая таблица транзакций остается
+    как transactions_legacy и удаляется позже по частям"""
+    await db.execute("BEGIN IMMEDIATE")
+    position = await _migration_cursor(db)
+    await db.execute(f"""
+        INSERT OR IGNORE INTO transactions_new ({_TRANSACTION_COPY_COLUMNS})
+        SELECT {_copy_values_sql()} FROM transactions WHERE id > ?
+    """, (position,))
+    for event in ('insert', 'update', 'delete'):
+        await db.execute(f"DROP TRIGGER IF EXISTS transactions_money_{event}")
+    await db.execute("ALTER TABLE transactions RENAME TO transactions_legacy")
+    await db.execute("ALTER TABLE transactions_new RENAME TO transactions")
+    # AUTOINCREMENT не должен выдать id удаленных из старой таблицы строк
+    await db.execute("""
+        UPDATE sqlite_sequence
+        SET seq = (SELECT MAX(seq) FROM sqlite_sequence
+                   WHERE name IN ('transactions', 'transactions_legacy'))
+        WHERE name = 'transactions'
+    """)
+
+    await _convert_table(
+        db, 'balances', _BALANCES_TABLE_SQL, "chat_id, cash, card",
+        f"chat_id, {_kopecks_sql('cash')}, {_kopecks_sql('card')}"
+    )
+    await _convert_table(
+        db, 'daily_rollups', _DAILY_ROLLUPS_TABLE_SQL,
+        "chat_id, day, category_id, payment_type, operation_type, amount_sum, quantity_sum, "
+        "cost_sum, tx_count, unit_price_sum, unit_price_count",
+        f"chat_id, day, category_id, payment_type, operation_type, {_kopecks_sql('amount_sum')}, "
+        f"quantity_sum, {_kopecks_sql('cost_sum')}, tx_count, {_kopecks_sql('unit_price_sum')}, "
+        f"unit_price_count"
+    )
+    await _create_rollup_indexes(db)
+    await db.execute(
+        "UPDATE schema_migrations SET finished_at = CURRENT_TIMESTAMP WHERE name = ?",
+        (_MONEY_MIGRATION,)
+    )
+
+
+async def _drop_legacy_chunk(db: aiosqlite.Connection, chunk_size: int) -> int:
+    """Удаление пачки строк старой таблицы; пустая таблица удаляется целиком"""
+    cursor = await db.execute("""
+        DELETE FROM transactions_legacy
+        WHERE id IN (SELECT id FROM transactions_legacy ORDER BY id LIMIT ?)
+    """, (chunk_size,))
+    if cursor.rowcount:
+        return cursor.rowcount
+    await db.execute("DROP TABLE transactions_legacy")
+    return 0
+
+
+async def migrate_money_to_kopecks(chunk_size: int = MIGRATION_CHUNK_SIZE,
+                                   pause: float = MIGRATION_PAUSE, progress=None):
+    """Перевод сумм в копейки на работающей БД. Каждая пачка из chunk_size строк -
+    отдельная короткая транзакция, между пачками пауза pause секунд для остальной
+    записи. Прерванная миграция продолжается с сохраненной позиции.
+    progress(position) вызывается после каждой скопированной пачки"""
+    global _money_scale, _money_migration_pending
+    if _money_scale != KOPECKS_PER_RUBLE:
+        async with _write() as db:
+            await _start_money_migration(db)
+        while True:
+            async with _write() as db:
+                copied, position = await _copy_money_chunk(db, chunk_size)
+            if progress is not None and copied:
+                progress(position)
+            if copied < chunk_size:
+                break
+            await asyncio.sleep(pause)
+        async with _write() as db:
+            await _swap_money_tables(db)
+        # Сразу после фиксации подмены: следующая запись уже пойдет в копейках
+        _money_scale = KOPECKS_PER_RUBLE
+
+    async with _write() as db:
+        legacy_exists = await _table_exists(db, 'transactions_legacy')
+    if legacy_exists:
+        # Балансы и агрегаты при подмене умножены на 100 как есть, а сумма
+        # округленных копеек транзакций может отличаться от округленной суммы
+        # рублей: пересчет по чатам, каждый отдельной транзакцией
+        for chat_id in await _all_chat_ids():
+            async with _write(chat_id) as db:
+                await _rebuild_balances(db, chat_id)
+                await _rebuild_rollups(db, chat_id)
+            _bump_data_versions((chat_id,))
+            await asyncio.sleep(pause)
+    while legacy_exists:
+        async with _write() as db:
+            deleted = await _drop_legacy_chunk(db, chunk_size)
+        if not deleted:
+            break
+        await asyncio.sleep(pause)
+    _money_migration_pending = False
 
 
 async def add_transaction(
@@ -83,105 +1444,405 @@ async def add_transaction(
     unit_price: Optional[float] = None,
     cost: Optional[float] = None
 ):
-    """Добавление транзакции"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("""
-            INSERT INTO transactions 
-            (chat_id, amount, payment_type, operation_type, description, user_id, username,
-             category_id, quantity, unit_price, cost)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (chat_id, amount, payment_type, operation_type, description, user_id, username,
-              category_id, quantity, unit_price, cost))
-        await db.commit()
+    """Добавление транзакции (возвращается после фиксации записи в БД)"""
+    created_at = datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+    row = (chat_id, amount, payment_type, operation_type, description, user_id, username,
+           category_id, quantity, unit_price, cost, created_at)
+    if _partitions is None:
+        await _get_pool().batcher.submit(row)
+    else:
+        # У каждого файла-раздела своя очередь групповой записи
+        async with _partitions.pool(chat_id) as pool:
+            await pool.batcher.submit(row)
+
+
+async def add_transactions(rows: list):
+    """Запись пачки транзакций одной транзакцией БД, минуя очередь (импорт).
+    Строки - в порядке _TRANSACTION_COLUMNS, суммы в рублях. В разделенной БД -
+    отдельной транзакцией для каждого чата"""
+    if _partitions is None:
+        async with _write() as db:
+            await _insert_transactions(db, rows)
+        _bump_data_versions({row[0] for row in rows})
+        return
+    # Разделенная БД: одна транзакция на каждый чат
+    by_chat: Dict[int, list] = {}
+    for row in rows:
+        by_chat.setdefault(row[0], []).append(row)
+    for chat_id, chat_rows in by_chat.items():
+        async with _write(chat_id) as db:
+            await _insert_transactions(db, chat_rows)
+        _bump_data_versions((chat_id,))
 
 
 async def get_balance(chat_id: int) -> Tuple[float, float]:
     """Получение баланса наличных и безналичных средств"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("""
-            SELECT 
-                SUM(CASE WHEN payment_type = 'cash' AND operation_type = 'add' THEN amount ELSE 0 END) -
-                SUM(CASE WHEN payment_type = 'cash' AND operation_type = 'subtract' THEN amount ELSE 0 END) as cash,
-                SUM(CASE WHEN payment_type = 'card' AND operation_type = 'add' THEN amount ELSE 0 END) -
-                SUM(CASE WHEN payment_type = 'card' AND operation_type = 'subtract' THEN amount ELSE 0 END) as card
-            FROM transactions
-            WHERE chat_id = ?
-        """, (chat_id,))
+    async with _read(chat_id) as db:
+        cursor = await db.execute(
+            "SELECT cash, card FROM balances WHERE chat_id = ?", (chat_id,)
+        )
         row = await cursor.fetchone()
-        cash_balance = row[0] if row[0] else 0.0
-        card_balance = row[1] if row[1] else 0.0
-        return cash_balance, card_balance
+        await cursor.close()
+        if not row:
+            return 0.0, 0.0
+        return _from_stored(row[0] or 0), _from_stored(row[1] or 0)
 
 
 async def get_recent_transactions(chat_id: int, limit: int = 10):
     """Получение последних транзакций"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("""
-            SELECT amount, payment_type, operation_type, description, created_at, username
+    async with _read(chat_id) as db:
+        cursor = await db.execute(_RECENT_TRANSACTIONS_SQL, (chat_id, chat_id, limit))
+        rows = await cursor.fetchall()
+    return [(_from_stored(row[0]),) + tuple(row[1:]) for row in rows]
+
+
+async def get_transactions_page(
+    chat_id: int,
+    cursor: Optional[Tuple[str, int]] = None,
+    older: bool = True,
+    limit: int = 10,
+    payment_type: Optional[str] = None,
+    operation_type: Optional[str] = None,
+    category_id: Optional[int] = None
+):
+    """Страница истории транзакций, от новых к старым.
+    cursor - (created_at, id) крайней транзакции соседней страницы: older=True
+    дает транзакции старше нее, older=False - новее. Переход по ключу, а не
+    OFFSET, поэтому дальние страницы читаются так же быстро, как первая.
+    Возвращает (строки, есть ли старше, есть ли новее)"""
+    conditions = ["chat_id = ?", f"id >= {_GENERATION_START_SQL}"]
+    params = [chat_id, chat_id]
+    # Фильтр по категории идет по idx_tx_chat_category_created, по оплате и
+    # операции (по два значения) - остаточным условием при обходе idx_tx_chat_created
+    for column, value in (('category_id', category_id), ('payment_type', payment_type),
+                          ('operation_type', operation_type)):
+        if value is not None:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    if cursor is not None:
+        conditions.append(f"(created_at, id) {'<' if older else '>'} (?, ?)")
+        params.extend(cursor)
+    order = "DESC" if older else "ASC"
+    params.append(limit + 1)
+
+    async with _read(chat_id) as db:
+        db_cursor = await db.execute(f"""
+            SELECT {_HISTORY_COLUMNS}
             FROM transactions
-            WHERE chat_id = ?
-            ORDER BY created_at DESC
+            WHERE {' AND '.join(conditions)}
+            ORDER BY created_at {order}, id {order}
             LIMIT ?
-        """, (chat_id, limit))
-        return await cursor.fetchall()
+        """, params)
+        rows = await db_cursor.fetchall()
+
+    has_more = len(rows) > limit
+    rows = [(row[0], _from_stored(row[1])) + tuple(row[2:]) for row in rows[:limit]]
+    if older:
+        return rows, has_more, cursor is not None
+    rows.reverse()
+    return rows, True, has_more
+
+
+async def iter_transactions(chat_id: int, days: Optional[int] = None,
+                            chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Транзакции чата в хронологическом порядке, пачками по chunk_size строк.
+    Строки идут в порядке колонок CSV (csv_io.CSV_COLUMNS), суммы в рублях.
+    Каждая пачка читается отдельным запросом с продолжением после последней
+    строки (created_at, id): соединение читателя возвращается в пул, пока
+    пачка отправляется, и несколько выгрузок не занимают все соединения"""
+    since = _period_start_day(days) if days else ''
+    # Архивные транзакции старше оставшихся в transactions, поэтому идут первыми
+    for sql in (_EXPORT_ARCHIVED_TRANSACTIONS_SQL, _EXPORT_TRANSACTIONS_SQL):
+        # id положительны: с (since, 0) начинаются все строки начиная с since
+        after = (since, 0)
+        while True:
+            async with _read(chat_id) as db:
+                cursor = await db.execute(sql, (chat_id, *after, chat_id, chunk_size))
+                rows = await cursor.fetchall()
+            if not rows:
+                break
+            yield [
+                (created_at, operation_type, payment_type, _from_stored(amount), category,
+                 quantity, _from_stored(unit_price), _from_stored(cost), description, username)
+                for (_, created_at, operation_type, payment_type, amount, category,
+                     quantity, unit_price, cost, description, username) in rows
+            ]
+            if len(rows) < chunk_size:
+                break
+            after = (rows[-1][1], rows[-1][0])
+
+
+async def _start_generation(db: aiosqlite.Connection, chat_id: int):
+    """Новое поколение данных чата: все уже записанные транзакции чата скрываются.
+    AUTOINCREMENT не выдает id повторно, поэтому новые транзакции получат id
+    не меньше first_id"""
+    await db.execute("""
+        INSERT INTO chat_generations (chat_id, generation, first_id, purge_pending)
+        VALUES (?, 1, (SELECT COALESCE(MAX(seq), 0) + 1 FROM sqlite_sequence
+                       WHERE name = 'transactions'), 1)
+        ON CONFLICT(chat_id) DO UPDATE SET
+            generation = generation + 1,
+            first_id = excluded.first_id,
+            purge_pending = 1
+    """, (chat_id,))
 
 
 async def reset_balance(chat_id: int):
-    """Сброс баланса (удаление всех транзакций для чата)"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("DELETE FROM transactions WHERE chat_id = ?", (chat_id,))
-        await db.commit()
+    """Сброс баланса (удаление всех транзакций для чата).
+    Транзакции скрываются сменой поколения и удаляются в фоне, поэтому сброс
+    не зависит от размера истории; сразу удаляются только баланс и агрегаты"""
+    async with _write(chat_id) as db:
+        await _start_generation(db, chat_id)
+        await db.execute("DELETE FROM balances WHERE chat_id = ?", (chat_id,))
+        await db.execute("DELETE FROM daily_rollups WHERE chat_id = ?", (chat_id,))
+        await db.execute("DELETE FROM archive_snapshots WHERE chat_id = ?", (chat_id,))
+    _bump_data_versions((chat_id,))
+    _schedule_purge((chat_id,))
 
 
 async def reset_all_data(chat_id: int):
     """Полное обнуление всех данных (транзакции + категории)"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("DELETE FROM transactions WHERE chat_id = ?", (chat_id,))
-        await db.execute("DELETE FROM categories WHERE chat_id = ?", (chat_id,))
-        await db.commit()
+    if _partitions is not None and _partitions.per_chat:
+        # Все данные чата - в его файле: удаляется файл, без долгих DELETE
+        await _partitions.drop(chat_id)
+    else:
+        async with _write(chat_id) as db:
+            await _start_generation(db, chat_id)
+            await db.execute("DELETE FROM balances WHERE chat_id = ?", (chat_id,))
+            await db.execute("DELETE FROM daily_rollups WHERE chat_id = ?", (chat_id,))
+            await db.execute("DELETE FROM archive_snapshots WHERE chat_id = ?", (chat_id,))
+            await db.execute("DELETE FROM categories WHERE chat_id = ?", (chat_id,))
+        _schedule_purge((chat_id,))
+    _invalidate_categories(chat_id)
 
 
-async def reset_all_data(chat_id: int):
-    """Полное обнуление всех данных (транзакции + категории)"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("DELETE FROM transactions WHERE chat_id = ?", (chat_id,))
-        await db.execute("DELETE FROM categories WHERE chat_id = ?", (chat_id,))
-        await db.commit()
+# Фоновое удаление транзакций прошлых поколений: одна задача на процесс
+# обходит чаты, сброшенные с ее запуска, и удаляет их строки небольшими
+# пачками с паузами, чтобы запись бота не ждала дольше одной пачки
+_purge_chats: set = set()
+_purge_task: Optional[asyncio.Task] = None
+# Чаты этого процесса при шардировании (chat_id % _shards == _shard, как в
+# sharding.shard_of): остальные очищает процесс, который их обслуживает
+_shard = 0
+_shards = 1
+
+
+def set_shard(index: int, shards: int):
+    """Процесс обслуживает только чаты своего шарда (вызывается до init_db)"""
+    global _shard, _shards
+    _shard, _shards = index, shards
+
+
+async def _pending_purges(db: aiosqlite.Connection) -> list:
+    cursor = await db.execute("SELECT chat_id FROM chat_generations WHERE purge_pending = 1")
+    return [row[0] for row in await cursor.fetchall()]
+
+
+def _schedule_purge(chat_ids):
+    global _purge_task
+    chat_ids = [chat_id for chat_id in chat_ids if chat_id % _shards == _shard]
+    if not chat_ids:
+        return
+    _purge_chats.update(chat_ids)
+    if _purge_task is None or _purge_task.done():
+        _purge_task = asyncio.create_task(_purge_loop())
+
+
+async def _purge_loop():
+    while _purge_chats:
+        chat_id = _purge_chats.pop()
+        try:
+            await purge_superseded(chat_id)
+        except Exception as e:
+            # Пометка purge_pending остается: очистка повторится при следующем запуске
+            logger.error(f"Ошибка очистки транзакций чата {chat_id} после сброса: {e}", exc_info=True)
+
+
+async def _stop_purge():
+    """Остановка фоновой очистки (продолжится при следующем запуске)"""
+    global _purge_task
+    task, _purge_task = _purge_task, None
+    _purge_chats.clear()
+    if task is not None and not task.done():
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+async def purge_superseded(chat_id: int, chunk_size: int = PURGE_CHUNK_SIZE,
+                           pause: float = PURGE_PAUSE) -> int:
+    """Удаление транзакций чата (в том числе архивных), скрытых сбросом,
+    пачками по chunk_size строк. Возвращает количество удаленных строк"""
+    deleted = 0
+    while True:
+        async with _write(chat_id) as db:
+            count = 0
+            for table in ('transactions', 'transactions_archive'):
+                cursor = await db.execute(f"""
+                    DELETE FROM {table} WHERE id IN (
+                        SELECT id FROM {table}
+                        WHERE chat_id = ? AND id < {_GENERATION_START_SQL}
+                        LIMIT ?
+                    )
+                """, (chat_id, chat_id, chunk_size - count))
+                count += cursor.rowcount
+                if count >= chunk_size:
+                    break
+            if count < chunk_size:
+                # Строк прошлых поколений не осталось - в той же транзакции,
+                # чтобы не потерять пометку от сброса, случившегося между пачками
+                await db.execute(
+                    "UPDATE chat_generations SET purge_pending = 0 WHERE chat_id = ?", (chat_id,)
+                )
+        deleted += count
+        if count < chunk_size:
+            return deleted
+        await asyncio.sleep(pause)
+
+
+# Версии данных чатов для кэшей отчетов: после каждой зафиксированной записи
+# (транзакции, категории, сброс) версия чата получает следующее значение
+# общего счетчика. Версии только растут, поэтому отчет, посчитанный при старой
+# версии, никогда не совпадет с новой. Чаты без записей с запуска процесса
+# имеют базовую версию, которая растет при пересчетах по всем чатам
+_version_counter = itertools.count(1)
+_base_version = 0
+_data_versions: dict = {}
+
+
+def get_data_version(chat_id: int) -> int:
+    """Текущая версия данных чата"""
+    return _data_versions.get(chat_id, _base_version)
+
+
+def _bump_data_versions(chat_ids):
+    """Новая версия данных чатов (вызывается после фиксации записи)"""
+    version = next(_version_counter)
+    for chat_id in chat_ids:
+        _data_versions[chat_id] = version
+
+
+def _bump_all_data_versions():
+    """Новая версия данных всех чатов"""
+    global _base_version
+    _base_version = next(_version_counter)
+    _data_versions.clear()
+
+
+_REBUILD_VERSION_SQL = """
+    SELECT COALESCE(SUM(version), 0) FROM rebuild_versions WHERE chat_id IN (?, 0)
+"""
+
+
+async def _bump_rebuild_version(chat_id: Optional[int]):
+    """Отметка пересчета данных чата (None - всех чатов) в БД: ее видят и
+    другие процессы, работающие с тем же файлом"""
+    async with _write() as db:
+        await db.execute("""
+            INSERT INTO rebuild_versions (chat_id, version) VALUES (?, 1)
+            ON CONFLICT(chat_id) DO UPDATE SET version = version + 1
+        """, (chat_id or 0,))
+
+
+async def get_rebuild_version(chat_id: int) -> int:
+    """Сколько раз данные чата пересчитывались, в том числе другими процессами.
+    Вместе с get_data_version() определяет, не устарел ли готовый отчет"""
+    async with _read() as db:
+        cursor = await db.execute(_REBUILD_VERSION_SQL, (chat_id,))
+        return (await cursor.fetchone())[0]
 
 
 # Функции для работы с категориями и юнит-экономикой
+class _ChatCategories:
+    """Категории одного чата с индексами по id и по (тип, имя в нижнем регистре)"""
+
+    def __init__(self, rows: list):
+        self.rows = rows
+        self.by_id = {row[0]: row for row in rows}
+        self.by_key = {(row[3], row[1].lower()): row for row in rows}
+
+
+_category_cache = LRUCache(CATEGORY_CACHE_SIZE)
+# Увеличивается при каждой инвалидации, чтобы загрузка, начатая до изменения
+# категорий, не положила в кэш устаревшие данные
+_category_epoch = 0
+
+
+def _invalidate_categories(chat_id: int):
+    global _category_epoch
+    _category_epoch += 1
+    _category_cache.pop(chat_id)
+    _bump_data_versions((chat_id,))
+
+
+async def _load_categories(chat_id: int) -> _ChatCategories:
+    entry = _category_cache.get(chat_id)
+    if entry is not None:
+        return entry
+    epoch = _category_epoch
+    async with _read(chat_id) as db:
+        cursor = await db.execute("""
+            SELECT id, name, description, type, created_at
+            FROM categories
+            WHERE chat_id = ?
+            ORDER BY type, name
+        """, (chat_id,))
+        entry = _ChatCategories(await cursor.fetchall())
+    if epoch == _category_epoch:
+        _category_cache.set(chat_id, entry)
+    return entry
+
+
+def get_category_cache_stats() -> dict:
+    """Размер кэша категорий и счетчики попаданий/промахов"""
+    return _category_cache.stats()
+
+
 async def create_category(chat_id: int, name: str, category_type: str = 'income_source', description: Optional[str] = None) -> Optional[int]:
     """Создание новой категории (источник дохода или категория расхода)"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        try:
+    try:
+        async with _write(chat_id) as db:
             cursor = await db.execute("""
                 INSERT INTO categories (chat_id, name, description, type)
                 VALUES (?, ?, ?, ?)
             """, (chat_id, name, description, category_type))
-            await db.commit()
-            return cursor.lastrowid
-        except aiosqlite.IntegrityError:
-            return None
+    except aiosqlite.IntegrityError:
+        return None
+    _invalidate_categories(chat_id)
+    return cursor.lastrowid
+
+
+async def ensure_categories(chat_id: int, keys) -> dict:
+    """Создание недостающих категорий по набору (тип, имя).
+    Возвращает id всех категорий чата по (тип, имя в нижнем регистре)"""
+    entry = await _load_categories(chat_id)
+    missing = {}
+    for category_type, name in keys:
+        key = (category_type, name.lower())
+        if key not in entry.by_key:
+            missing.setdefault(key, (chat_id, name, category_type))
+    if missing:
+        async with _write(chat_id) as db:
+            await db.executemany("""
+                INSERT OR IGNORE INTO categories (chat_id, name, type)
+                VALUES (?, ?, ?)
+            """, list(missing.values()))
+        _invalidate_categories(chat_id)
+        entry = await _load_categories(chat_id)
+    return {key: row[0] for key, row in entry.by_key.items()}
 
 
 async def get_categories(chat_id: int, category_type: Optional[str] = None):
     """Получение категорий для чата (опционально по типу)"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        if category_type:
-            cursor = await db.execute("""
-                SELECT id, name, description, type, created_at
-                FROM categories
-                WHERE chat_id = ? AND type = ?
-                ORDER BY name
-            """, (chat_id, category_type))
-        else:
-            cursor = await db.execute("""
-                SELECT id, name, description, type, created_at
-                FROM categories
-                WHERE chat_id = ?
-                ORDER BY type, name
-            """, (chat_id,))
-        return await cursor.fetchall()
+    entry = await _load_categories(chat_id)
+    if category_type:
+        return [row for row in entry.rows if row[3] == category_type]
+    return list(entry.rows)
+
+
+async def get_category(chat_id: int, category_id: int) -> Optional[Tuple[int, str, Optional[str], str, str]]:
+    """Получение категории чата по id"""
+    entry = await _load_categories(chat_id)
+    return entry.by_id.get(category_id)
 
 
 async def get_income_sources(chat_id: int):
@@ -196,95 +1857,284 @@ async def get_expense_categories(chat_id: int):
 
 async def get_category_by_name(chat_id: int, name: str, category_type: Optional[str] = None) -> Optional[Tuple[int, str, Optional[str], str]]:
     """Получение категории по имени"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        if category_type:
-            cursor = await db.execute("""
-                SELECT id, name, description, type
-                FROM categories
-                WHERE chat_id = ? AND LOWER(name) = LOWER(?) AND type = ?
-            """, (chat_id, name, category_type))
-        else:
-            cursor = await db.execute("""
-                SELECT id, name, description, type
-                FROM categories
-                WHERE chat_id = ? AND LOWER(name) = LOWER(?)
-            """, (chat_id, name))
-        row = await cursor.fetchone()
-        return row if row else None
+    entry = await _load_categories(chat_id)
+    key = name.lower()
+    if category_type:
+        row = entry.by_key.get((category_type, key))
+    else:
+        row = next((r for r in entry.rows if r[1].lower() == key), None)
+    return row[:4] if row else None
 
 
 async def delete_category(chat_id: int, category_id: int):
     """Удаление категории"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with _write(chat_id) as db:
         await db.execute("DELETE FROM categories WHERE id = ? AND chat_id = ?", (category_id, chat_id))
-        await db.commit()
+    _invalidate_categories(chat_id)
+
+
+# Функции для настроек чатов
+_DEFAULT_CHAT_SETTINGS = {'live_balance': False, 'balance_message_id': None,
+                          'report_time': None, 'utc_offset': 0, 'last_report_day': None}
+_chat_settings_cache = LRUCache(CHAT_SETTINGS_CACHE_SIZE)
+
+
+async def get_chat_settings(chat_id: int) -> dict:
+    """Получение настроек чата"""
+    settings = _chat_settings_cache.get(chat_id)
+    if settings is not None:
+        return dict(settings)
+    async with _read() as db:
+        cursor = await db.execute("""
+            SELECT live_balance, balance_message_id, report_time, utc_offset, last_report_day
+            FROM chat_settings WHERE chat_id = ?
+        """, (chat_id,))
+        row = await cursor.fetchone()
+        await cursor.close()
+    settings = dict(_DEFAULT_CHAT_SETTINGS)
+    if row:
+        settings['live_balance'] = bool(row[0])
+        settings['balance_message_id'] = row[1]
+        settings['report_time'] = row[2]
+        settings['utc_offset'] = row[3]
+        settings['last_report_day'] = row[4]
+    _chat_settings_cache.set(chat_id, settings)
+    return dict(settings)
+
+
+async def update_chat_settings(chat_id: int, **changes):
+    """Изменение настроек чата (live_balance, balance_message_id,
+    report_time, utc_offset, last_report_day)"""
+    unknown = set(changes) - set(_DEFAULT_CHAT_SETTINGS)
+    if unknown:
+        raise ValueError(f"Неизвестные настройки чата: {', '.join(sorted(unknown))}")
+    settings = await get_chat_settings(chat_id)
+    settings.update(changes)
+    async with _write() as db:
+        await db.execute("""
+            INSERT INTO chat_settings (
+                chat_id, live_balance, balance_message_id, report_time, utc_offset, last_report_day
+            )
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                live_balance = excluded.live_balance,
+                balance_message_id = excluded.balance_message_id,
+                report_time = excluded.report_time,
+                utc_offset = excluded.utc_offset,
+                last_report_day = excluded.last_report_day
+        """, (chat_id, int(settings['live_balance']), settings['balance_message_id'],
+              settings['report_time'], settings['utc_offset'], settings['last_report_day']))
+    _chat_settings_cache.set(chat_id, settings)
+
+
+async def get_report_schedules() -> list:
+    """Чаты с включенным Z-отчетом: [(chat_id, report_time, utc_offset, last_report_day)]"""
+    async with _read() as db:
+        cursor = await db.execute("""
+            SELECT chat_id, report_time, utc_offset, last_report_day
+            FROM chat_settings
+            WHERE report_time IS NOT NULL
+        """)
+        return await cursor.fetchall()
+
+
+# Функции для хранилища состояний FSM
+async def load_fsm_record(key: str) -> Optional[Tuple[Optional[str], str, float]]:
+    """Получение состояния FSM: (state, data в JSON, время последнего изменения)"""
+    async with _read() as db:
+        cursor = await db.execute(
+            "SELECT state, data, updated_at FROM fsm_states WHERE key = ?", (key,)
+        )
+        row = await cursor.fetchone()
+        await cursor.close()
+        return row
+
+
+async def save_fsm_records(upserts: list, deletes: list):
+    """Запись пачки состояний FSM одной транзакцией.
+    upserts: (key, chat_id, state, data, updated_at), deletes: ключи"""
+    async with _write() as db:
+        if upserts:
+            await db.executemany("""
+                INSERT INTO fsm_states (key, chat_id, state, data, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    updated_at = excluded.updated_at
+            """, upserts)
+        if deletes:
+            await db.executemany(
+                "DELETE FROM fsm_states WHERE key = ?", [(key,) for key in deletes]
+            )
+
+
+async def delete_expired_fsm_records(before: float) -> int:
+    """Удаление состояний FSM, не менявшихся с момента before"""
+    async with _write() as db:
+        cursor = await db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (before,))
+        return cursor.rowcount
+
+
+async def count_fsm_states(since: float, exclude: Iterable[str] = ()) -> dict:
+    """Количество незавершенных диалогов по состояниям, менявшихся после since.
+    Записи с ключами из exclude не считаются: их актуальная версия еще в памяти"""
+    async with _read() as db:
+        cursor = await db.execute("""
+            SELECT state, COUNT(*) FROM fsm_states
+            WHERE updated_at >= ? AND state IS NOT NULL
+              AND key NOT IN (SELECT value FROM json_each(?))
+            GROUP BY state
+        """, (since, json.dumps(list(exclude))))
+        return dict(await cursor.fetchall())
+
+
+def _period_start_day(days: int) -> str:
+    """Первый день периода из days календарных дней, включая сегодняшний (UTC)"""
+    start = datetime.now(timezone.utc).date() - timedelta(days=max(days, 1) - 1)
+    return start.isoformat()
+
+
+# Отчеты за период читают дневные агрегаты, а не исходные транзакции:
+# не больше одной строки на день для каждой категории и типа операции
+# Средние считаются в REAL: целочисленное деление копеек отбрасывает дробную часть
+_UNIT_ECONOMICS_COLUMNS = """
+    c.id as category_id,
+    c.name as category_name,
+    SUM(r.tx_count) as transactions_count,
+    SUM(CASE WHEN r.operation_type = 'add' THEN r.quantity_sum ELSE 0 END) as total_quantity,
+    COALESCE(
+        CAST(SUM(CASE WHEN r.operation_type = 'add' THEN r.unit_price_sum ELSE 0 END) AS REAL)
+        / NULLIF(SUM(CASE WHEN r.operation_type = 'add' THEN r.unit_price_count ELSE 0 END), 0),
+    0) as avg_unit_price,
+    SUM(CASE WHEN r.operation_type = 'add' THEN r.amount_sum ELSE -r.amount_sum END) as total_revenue,
+    SUM(CASE WHEN r.operation_type = 'subtract' THEN r.cost_sum ELSE 0 END) as total_cost,
+    COALESCE(
+        CAST(SUM(CASE WHEN r.operation_type = 'add' THEN r.amount_sum ELSE 0 END) AS REAL)
+        / NULLIF(SUM(CASE WHEN r.operation_type = 'add' THEN r.tx_count ELSE 0 END), 0),
+    0) as avg_transaction_amount
+"""
+
+_UNIT_ECONOMICS_BY_CATEGORY_SQL = f"""
+    SELECT {_UNIT_ECONOMICS_COLUMNS}
+    FROM daily_rollups r
+    LEFT JOIN categories c ON r.category_id = c.id
+    WHERE r.chat_id = ?
+        AND r.category_id = ?
+        AND r.operation_type = 'add'
+        AND r.day >= ?
+    GROUP BY c.id, c.name
+    ORDER BY total_revenue DESC
+"""
+
+_UNIT_ECONOMICS_ALL_CATEGORIES_SQL = f"""
+    SELECT {_UNIT_ECONOMICS_COLUMNS}
+    FROM daily_rollups r
+    LEFT JOIN categories c ON r.category_id = c.id
+    WHERE r.chat_id = ?
+        AND r.day >= ?
+        AND r.operation_type = 'add'
+    GROUP BY c.id, c.name
+    ORDER BY total_revenue DESC
+"""
+
+_UNIT_ECONOMICS_SUMMARY_SQL = """
+    SELECT
+        SUM(CASE WHEN r.operation_type = 'add' THEN r.tx_count ELSE 0 END) as total_transactions,
+        SUM(CASE WHEN r.operation_type = 'add' THEN r.quantity_sum ELSE 0 END) as total_units_sold,
+        SUM(CASE WHEN r.operation_type = 'add' THEN r.amount_sum ELSE 0 END) as total_revenue,
+        SUM(CASE WHEN r.operation_type = 'subtract' THEN r.cost_sum ELSE 0 END) as total_cost,
+        CAST(SUM(CASE WHEN r.operation_type = 'add' THEN r.amount_sum ELSE 0 END) AS REAL)
+            / NULLIF(SUM(CASE WHEN r.operation_type = 'add' THEN r.tx_count ELSE 0 END), 0) as avg_check,
+        CAST(SUM(CASE WHEN r.operation_type = 'add' THEN r.unit_price_sum ELSE 0 END) AS REAL)
+            / NULLIF(SUM(CASE WHEN r.operation_type = 'add' THEN r.unit_price_count ELSE 0 END), 0) as avg_unit_price
+    FROM daily_rollups r
+    WHERE r.chat_id = ?
+        AND r.day >= ?
+"""
+
+_SUMMARY_BY_CATEGORIES_SQL = """
+    SELECT
+        c.id as category_id,
+        c.name as category_name,
+        COALESCE(SUM(r.amount_sum), 0) as total,
+        COALESCE(SUM(r.tx_count), 0) as transactions_count
+    FROM categories c
+    LEFT JOIN daily_rollups r ON r.chat_id = ?
+        AND r.category_id = c.id
+        AND r.operation_type = ?
+        AND r.day >= ?
+    WHERE c.chat_id = ? AND c.type = ?
+    GROUP BY c.id, c.name
+    ORDER BY total DESC
+"""
+
+# Итоги произвольного периода для Z-отчета: границы суток чата не совпадают
+# с днями UTC дневных агрегатов, поэтому период считается по транзакциям.
+# Унарный плюс в GROUP BY не дает плану выбрать ради группировки индекс по
+# категориям, который обходит все транзакции чата, вместо диапазона по времени
+_PERIOD_REPORT_SQL = f"""
+    SELECT t.category_id, c.name, t.operation_type,
+           SUM(t.amount), SUM(COALESCE(t.cost, 0)), COUNT(*)
+    FROM transactions t
+    LEFT JOIN categories c ON t.category_id = c.id
+    WHERE t.chat_id = ? AND t.created_at >= ? AND t.created_at < ?
+        AND t.id >= {_GENERATION_START_SQL}
+    GROUP BY +t.category_id, +t.operation_type
+"""
+
+_EXPORT_SQL = """
+    SELECT t.id, t.created_at, t.operation_type, t.payment_type, t.amount, c.name,
+           t.quantity, t.unit_price, t.cost, t.description, t.username
+    FROM {table} t
+    LEFT JOIN categories c ON c.id = t.category_id
+    WHERE t.chat_id = ? AND (t.created_at, t.id) > (?, ?) AND t.id >= {generation_start}
+    ORDER BY t.created_at, t.id
+    LIMIT ?
+"""
+_EXPORT_TRANSACTIONS_SQL = _EXPORT_SQL.format(
+    table='transactions', generation_start=_GENERATION_START_SQL)
+_EXPORT_ARCHIVED_TRANSACTIONS_SQL = _EXPORT_SQL.format(
+    table='transactions_archive', generation_start=_GENERATION_START_SQL)
+
+_HISTORY_COLUMNS = "id, amount, payment_type, operation_type, description, created_at, username"
+
+_RECENT_TRANSACTIONS_SQL = f"""
+    SELECT amount, payment_type, operation_type, description, created_at, username
+    FROM transactions
+    WHERE chat_id = ? AND id >= {_GENERATION_START_SQL}
+    ORDER BY created_at DESC
+    LIMIT ?
+"""
 
 
 async def get_unit_economics_by_category(chat_id: int, category_id: Optional[int] = None, days: int = 30):
     """Расчет юнит-экономики по категориям"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        date_filter = "datetime(t.created_at) >= datetime('now', '-' || ? || ' days')"
+    since = _period_start_day(days)
+    async with _read(chat_id) as db:
         if category_id:
-            cursor = await db.execute(f"""
-                SELECT 
-                    c.id as category_id,
-                    c.name as category_name,
-                    COUNT(DISTINCT t.id) as transactions_count,
-                    COALESCE(SUM(CASE WHEN t.operation_type = 'add' THEN t.quantity ELSE 0 END), 0) as total_quantity,
-                    COALESCE(AVG(CASE WHEN t.operation_type = 'add' AND t.quantity > 0 THEN t.unit_price ELSE NULL END), 0) as avg_unit_price,
-                    COALESCE(SUM(CASE WHEN t.operation_type = 'add' THEN t.amount ELSE -t.amount END), 0) as total_revenue,
-                    COALESCE(SUM(CASE WHEN t.operation_type = 'subtract' THEN COALESCE(t.cost, 0) ELSE 0 END), 0) as total_cost,
-                    COALESCE(AVG(CASE WHEN t.operation_type = 'add' THEN t.amount ELSE NULL END), 0) as avg_transaction_amount
-                FROM transactions t
-                LEFT JOIN categories c ON t.category_id = c.id
-                WHERE t.chat_id = ? 
-                    AND t.category_id = ?
-                    AND {date_filter}
-                    AND t.operation_type = 'add'
-                GROUP BY c.id, c.name
-                ORDER BY total_revenue DESC
-            """, (chat_id, category_id, days))
+            cursor = await db.execute(
+                _UNIT_ECONOMICS_BY_CATEGORY_SQL, (chat_id, category_id, since)
+            )
         else:
-            cursor = await db.execute(f"""
-                SELECT 
-                    c.id as category_id,
-                    c.name as category_name,
-                    COUNT(DISTINCT t.id) as transactions_count,
-                    COALESCE(SUM(CASE WHEN t.operation_type = 'add' THEN t.quantity ELSE 0 END), 0) as total_quantity,
-                    COALESCE(AVG(CASE WHEN t.operation_type = 'add' AND t.quantity > 0 THEN t.unit_price ELSE NULL END), 0) as avg_unit_price,
-                    COALESCE(SUM(CASE WHEN t.operation_type = 'add' THEN t.amount ELSE -t.amount END), 0) as total_revenue,
-                    COALESCE(SUM(CASE WHEN t.operation_type = 'subtract' THEN COALESCE(t.cost, 0) ELSE 0 END), 0) as total_cost,
-                    COALESCE(AVG(CASE WHEN t.operation_type = 'add' THEN t.amount ELSE NULL END), 0) as avg_transaction_amount
-                FROM transactions t
-                LEFT JOIN categories c ON t.category_id = c.id
-                WHERE t.chat_id = ? 
-                    AND {date_filter}
-                    AND t.operation_type = 'add'
-                GROUP BY c.id, c.name
-                ORDER BY total_revenue DESC
-            """, (chat_id, days))
-        return await cursor.fetchall()
+            cursor = await db.execute(_UNIT_ECONOMICS_ALL_CATEGORIES_SQL, (chat_id, since))
+        rows = await cursor.fetchall()
+    # Денежные столбцы: средняя цена, выручка, расходы, средний чек
+    return [
+        tuple(row[:4]) + tuple(_from_stored(value) for value in row[4:])
+        for row in rows
+    ]
 
 
 async def get_unit_economics_summary(chat_id: int, days: int = 30):
     """Общая статистика юнит-экономики"""
-    async with aiosqlite.connect(DB_NAME) as db:
-        cursor = await db.execute("""
-            SELECT 
-                COUNT(DISTINCT CASE WHEN t.operation_type = 'add' THEN t.id END) as total_transactions,
-                COALESCE(SUM(CASE WHEN t.operation_type = 'add' THEN t.quantity ELSE 0 END), 0) as total_units_sold,
-                COALESCE(SUM(CASE WHEN t.operation_type = 'add' THEN t.amount ELSE 0 END), 0) as total_revenue,
-                COALESCE(SUM(CASE WHEN t.operation_type = 'subtract' THEN COALESCE(t.cost, 0) ELSE 0 END), 0) as total_cost,
-                COALESCE(AVG(CASE WHEN t.operation_type = 'add' THEN t.amount ELSE NULL END), 0) as avg_check,
-                COALESCE(AVG(CASE WHEN t.operation_type = 'add' AND t.quantity > 0 THEN t.unit_price ELSE NULL END), 0) as avg_unit_price
-            FROM transactions t
-            WHERE t.chat_id = ? 
-                AND datetime(t.created_at) >= datetime('now', '-' || ? || ' days')
-        """, (chat_id, days))
+    async with _read(chat_id) as db:
+        cursor = await db.execute(_UNIT_ECONOMICS_SUMMARY_SQL, (chat_id, _period_start_day(days)))
         row = await cursor.fetchone()
+        await cursor.close()
         if row:
-            total_revenue = row[2] or 0
-            total_cost = row[3] or 0
+            total_revenue = _from_stored(row[2] or 0)
+            total_cost = _from_stored(row[3] or 0)
             profit = total_revenue - total_cost
             margin = (profit / total_revenue * 100) if total_revenue > 0 else 0
             return {
@@ -294,50 +2144,29 @@ async def get_unit_economics_summary(chat_id: int, days: int = 30):
                 'cost': total_cost,
                 'profit': profit,
                 'margin': margin,
-                'avg_check': row[4] or 0,
-                'avg_unit_price': row[5] or 0
+                'avg_check': _from_stored(row[4] or 0),
+                'avg_unit_price': _from_stored(row[5] or 0)
             }
         return None
 
 
 async def get_summary_by_categories(chat_id: int, days: int = 30):
     """Сводная таблица доходов и расходов по категориям с процентами"""
-    async with aiosqlite.connect(DB_NAME) as db:
+    since = _period_start_day(days)
+    async with _read(chat_id) as db:
         # Доходы по источникам
-        income_cursor = await db.execute("""
-            SELECT 
-                c.id as category_id,
-                c.name as category_name,
-                COALESCE(SUM(t.amount), 0) as total_income,
-                COUNT(t.id) as transactions_count
-            FROM categories c
-            LEFT JOIN transactions t ON c.id = t.category_id 
-                AND t.chat_id = ?
-                AND t.operation_type = 'add'
-                AND datetime(t.created_at) >= datetime('now', '-' || ? || ' days')
-            WHERE c.chat_id = ? AND c.type = 'income_source'
-            GROUP BY c.id, c.name
-            ORDER BY total_income DESC
-        """, (chat_id, days, chat_id))
+        income_cursor = await db.execute(
+            _SUMMARY_BY_CATEGORIES_SQL, (chat_id, 'add', since, chat_id, 'income_source')
+        )
         incomes = await income_cursor.fetchall()
         
         # Расходы по категориям
-        expense_cursor = await db.execute("""
-            SELECT 
-                c.id as category_id,
-                c.name as category_name,
-                COALESCE(SUM(t.amount), 0) as total_expense,
-                COUNT(t.id) as transactions_count
-            FROM categories c
-            LEFT JOIN transactions t ON c.id = t.category_id 
-                AND t.chat_id = ?
-                AND t.operation_type = 'subtract'
-                AND datetime(t.created_at) >= datetime('now', '-' || ? || ' days')
-            WHERE c.chat_id = ? AND c.type = 'expense_category'
-            GROUP BY c.id, c.name
-            ORDER BY total_expense DESC
-        """, (chat_id, days, chat_id))
+        expense_cursor = await db.execute(
+            _SUMMARY_BY_CATEGORIES_SQL, (chat_id, 'subtract', since, chat_id, 'expense_category')
+        )
         expenses = await expense_cursor.fetchall()
+        incomes = [(row[0], row[1], _from_stored(row[2]), row[3]) for row in incomes]
+        expenses = [(row[0], row[1], _from_stored(row[2]), row[3]) for row in expenses]
         
         # Общие суммы
         total_income = sum(row[2] for row in incomes) or 0
@@ -352,3 +2181,77 @@ async def get_summary_by_categories(chat_id: int, days: int = 30):
             'total': total,
             'days': days
         }
+
+
+async def get_period_report(chat_id: int, since: str, until: str) -> dict:
+    """Итоги транзакций с since по until (не включая, время UTC в формате
+    created_at) для Z-отчета: выручка, расходы по себестоимости, прибыль,
+    маржа и источники дохода по убыванию выручки"""
+    async with _read(chat_id) as db:
+        cursor = await db.execute(_PERIOD_REPORT_SQL, (chat_id, since, until, chat_id))
+        rows = await cursor.fetchall()
+    revenue = cost = 0
+    transactions = 0
+    # category_id -> [название, выручка, продаж] по всем способам оплаты
+    by_category: Dict[int, list] = {}
+    for category_id, name, operation_type, amount, row_cost, count in rows:
+        if operation_type == 'add':
+            revenue += amount
+            transactions += count
+            acc = by_category.setdefault(category_id, [name or "Без категории", 0, 0])
+            acc[1] += amount
+            acc[2] += count
+        elif operation_type == 'subtract':
+            cost += row_cost
+    revenue = _from_stored(revenue)
+    cost = _from_stored(cost)
+    profit = revenue - cost
+    categories = sorted(
+        ((name, _from_stored(amount), count) for name, amount, count in by_category.values()),
+        key=lambda item: item[1], reverse=True
+    )
+    return {
+        'since': since,
+        'until': until,
+        'transactions': transactions,
+        'revenue': revenue,
+        'cost': cost,
+        'profit': profit,
+        'margin': (profit / revenue * 100) if revenue > 0 else 0,
+        'categories': categories
+    }
+
+
+# Запросы горячих путей для проверки планов выполнения (maintenance.py check-plans)
+_HOT_QUERIES = {
+    'unit_economics_by_category': (_UNIT_ECONOMICS_BY_CATEGORY_SQL, (0, 0, '')),
+    'unit_economics_all_categories': (_UNIT_ECONOMICS_ALL_CATEGORIES_SQL, (0, '')),
+    'unit_economics_summary': (_UNIT_ECONOMICS_SUMMARY_SQL, (0, '')),
+    'summary_by_categories': (_SUMMARY_BY_CATEGORIES_SQL, (0, 'add', '', 0, 'income_source')),
+    'period_report': (_PERIOD_REPORT_SQL, (0, '', '', 0)),
+    'rebuild_version': (_REBUILD_VERSION_SQL, (0,)),
+    'recent_transactions': (_RECENT_TRANSACTIONS_SQL, (0, 0, 10)),
+    'export_transactions': (_EXPORT_TRANSACTIONS_SQL, (0, '', 0, 0, 1)),
+    'export_archived_transactions': (_EXPORT_ARCHIVED_TRANSACTIONS_SQL, (0, '', 0, 0, 1)),
+    'history_page': (f"""
+        SELECT {_HISTORY_COLUMNS} FROM transactions
+        WHERE chat_id = ? AND id >= {_GENERATION_START_SQL} AND (created_at, id) < (?, ?)
+        ORDER BY created_at DESC, id DESC LIMIT ?
+    """, (0, 0, '', 0, 11)),
+    'history_page_by_category': (f"""
+        SELECT {_HISTORY_COLUMNS} FROM transactions
+        WHERE chat_id = ? AND id >= {_GENERATION_START_SQL} AND category_id = ?
+            AND (created_at, id) < (?, ?)
+        ORDER BY created_at DESC, id DESC LIMIT ?
+    """, (0, 0, 0, '', 0, 11)),
+}
+
+
+async def explain_hot_queries() -> dict:
+    """EXPLAIN QUERY PLAN для запросов горячих путей: {имя: [строки плана]}"""
+    plans = {}
+    async with _read() as db:
+        for name, (sql, params) in _HOT_QUERIES.items():
+            cursor = await db.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            plans[name] = [row[3] for row in await cursor.fetchall()]
+    return plans
@@ -1,11 +1,23 @@
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from typing import Optional, Tuple
-import re
+import config
+import csv_io
 import database as db
+import live_balance
+import sender
+import zreport
+from parsing import parse_amount, parse_text
+from cache import LRUCache, TTLCache
 
 router = Router()
 
@@ -17,32 +29,7 @@ class TransactionStates(StatesGroup):
     waiting_for_category = State()
     waiting_for_category_name = State()
     waiting_for_unit_data = State()  # Ожидание количества, цены, расходов
-
-
-def parse_amount(text: str) -> Tuple[Optional[float], Optional[str]]:
-    """Парсинг суммы и типа операции из текста"""
-    text = text.strip()
-    
-    # Проверка на операцию вычитания
-    is_subtract = text.startswith('-') or 'минус' in text.lower() or 'вычесть' in text.lower()
-    
-    # Извлечение числа
-    numbers = re.findall(r'\d+[.,]?\d*', text)
-    if not numbers:
-        return None, None
-    
-    amount = float(numbers[0].replace(',', '.'))
-    if is_subtract:
-        amount = -amount
-    
-    # Определение типа оплаты
-    payment_type = None
-    if any(word in text.lower() for word in ['нал', 'налич', 'cash']):
-        payment_type = 'cash'
-    elif any(word in text.lower() for word in ['безнал', 'карт', 'card']):
-        payment_type = 'card'
-    
-    return amount, payment_type
+    waiting_for_import_file = State()  # Ожидание CSV-файла для импорта
 
 
 def get_main_keyboard() -> InlineKeyboardMarkup:
@@ -86,7 +73,11 @@ async def cmd_start(message: Message):
         "• Отслеживайте прибыльность по категориям\n\n"
         "Команды:\n"
         "/unit - юнит-экономика\n"
-        "/categories - управление категориями",
+        "/categories - управление категориями\n"
+        "/livebalance - живой баланс в закрепленном сообщении\n"
+        "/zreport 22:00 - ежедневный Z-отчет в заданное время\n"
+        "/import - импорт транзакций из CSV-файла\n"
+        "/export [дней] - выгрузка транзакций в CSV",
         reply_markup=get_main_keyboard()
     )
 
@@ -94,15 +85,7 @@ async def cmd_start(message: Message):
 async def show_balance(chat_id: int, message_or_query) -> None:
     """Показать баланс кассы"""
     cash, card = await db.get_balance(chat_id)
-    total = cash + card
-    
-    response = (
-        f"💰 Баланс кассы:\n\n"
-        f"💵 Наличные: {cash:.2f} ₽\n"
-        f"💳 Безналичные: {card:.2f} ₽\n"
-        f"━━━━━━━━━━━━━━━━━━━━\n"
-        f"📊 Итого: {total:.2f} ₽"
-    )
+    response = live_balance.format_balance(cash, card)
     
     if isinstance(message_or_query, CallbackQuery):
         await message_or_query.message.edit_text(response, reply_markup=get_main_keyboard())
@@ -111,6 +94,18 @@ async def show_balance(chat_id: int, message_or_query) -> None:
         await message_or_query.answer(response, reply_markup=get_main_keyboard())
 
 
+async def show_updated_balance(message: Message) -> None:
+    """Показать баланс после операции: в режиме живого баланса обновляется
+    закрепленное сообщение, иначе отправляется новое"""
+    settings = await db.get_chat_settings(message.chat.id)
+    if settings['live_balance']:
+        live_balance.schedule(message.bot, message.chat.id)
+        return
+    # Новое сообщение уходит после подтверждений в очереди отправки
+    with sender.informational():
+        await show_balance(message.chat.id, message)
+
+
 @router.message(Command("balance"))
 async def cmd_balance(message: Message):
     """Показать баланс кассы"""
@@ -153,38 +148,124 @@ async def cmd_subtract(message: Message, state: FSMContext):
     await state.set_state(TransactionStates.waiting_for_payment_type)
 
 
-async def show_history(chat_id: int, message_or_query) -> None:
-    """Показать историю транзакций"""
-    transactions = await db.get_recent_transactions(chat_id, 10)
-    
-    if not transactions:
-        text = "История транзакций пуста"
-        if isinstance(message_or_query, CallbackQuery):
-            await message_or_query.message.edit_text(text, reply_markup=get_main_keyboard())
-            await message_or_query.answer()
-        else:
-            await message_or_query.answer(text, reply_markup=get_main_keyboard())
-        return
+# Транзакций на странице истории
+HISTORY_PAGE_SIZE = 10
+
+# Фильтры истории в данных кнопок: код -> значение в БД
+_HISTORY_PAYMENT_CODES = {'-': None, 'c': 'cash', 'k': 'card'}
+_HISTORY_OPERATION_CODES = {'-': None, 'a': 'add', 's': 'subtract'}
+# Следующее значение фильтра при нажатии на кнопку
+_NEXT_PAYMENT_CODE = {'-': 'c', 'c': 'k', 'k': '-'}
+_NEXT_OPERATION_CODE = {'-': 'a', 'a': 's', 's': '-'}
+_PAYMENT_FILTER_NAMES = {'-': "все", 'c': "нал", 'k': "карт"}
+_OPERATION_FILTER_NAMES = {'-': "все", 'a': "доходы", 's': "расходы"}
+_TIMESTAMP_SEPARATORS = str.maketrans("", "", "- :")
+
+
+def _history_data(direction: str, filters: str, created_at: str = "", tx_id: int = 0) -> str:
+    """Данные кнопки истории: hist:направление:фильтры:курсор.
+    Курсор - created_at без разделителей и id крайней транзакции страницы"""
+    cursor = f"{created_at.translate(_TIMESTAMP_SEPARATORS)}:{tx_id}" if created_at else ":"
+    return f"hist:{direction}:{filters}:{cursor}"
+
+
+def _parse_history_data(data: str):
+    """Разбор данных кнопки истории: (older, фильтры, курсор)"""
+    _, direction, filters, stamp, tx_id = data.split(":")
+    payment_code, operation_code, category = filters[0], filters[1], filters[2:]
+    if payment_code not in _HISTORY_PAYMENT_CODES or operation_code not in _HISTORY_OPERATION_CODES:
+        raise ValueError(data)
+    cursor = None
+    if stamp:
+        if len(stamp) != 14 or not stamp.isdigit():
+            raise ValueError(data)
+        created_at = (f"{stamp[0:4]}-{stamp[4:6]}-{stamp[6:8]} "
+                      f"{stamp[8:10]}:{stamp[10:12]}:{stamp[12:14]}")
+        cursor = (created_at, int(tx_id))
+    return direction != "n", (payment_code, operation_code, int(category) if category else None), cursor
+
+
+def get_history_keyboard(filters: tuple, first: Optional[tuple], last: Optional[tuple],
+                         has_newer: bool, has_older: bool) -> InlineKeyboardMarkup:
+    """Кнопки листания и фильтров истории"""
+    payment_code, operation_code, category_id = filters
+    category = str(category_id) if category_id is not None else ""
+    codes = f"{payment_code}{operation_code}{category}"
+
+    navigation = []
+    if has_newer and first is not None:
+        navigation.append(InlineKeyboardButton(
+            text="◀ Новее", callback_data=_history_data("n", codes, first[5], first[0])
+        ))
+    if has_older and last is not None:
+        navigation.append(InlineKeyboardButton(
+            text="Старее ▶", callback_data=_history_data("o", codes, last[5], last[0])
+        ))
+
+    payment_next = f"{_NEXT_PAYMENT_CODE[payment_code]}{operation_code}{category}"
+    operation_next = f"{payment_code}{_NEXT_OPERATION_CODE[operation_code]}{category}"
+    rows = [navigation] if navigation else []
+    rows.append([
+        InlineKeyboardButton(text=f"💳 Оплата: {_PAYMENT_FILTER_NAMES[payment_code]}",
+                             callback_data=_history_data("o", payment_next)),
+        InlineKeyboardButton(text=f"🔀 Операции: {_OPERATION_FILTER_NAMES[operation_code]}",
+                             callback_data=_history_data("o", operation_next)),
+    ])
+    if category_id is not None:
+        rows.append([InlineKeyboardButton(text="📁 Все категории",
+                                          callback_data=_history_data("o", f"{payment_code}{operation_code}"))])
+    rows.append([InlineKeyboardButton(text="🏠 На главную", callback_data="main_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+async def show_history(chat_id: int, message_or_query, filters: tuple = ('-', '-', None),
+                       cursor: Optional[tuple] = None, older: bool = True) -> None:
+    """Показать страницу истории транзакций"""
+    payment_code, operation_code, category_id = filters
+    transactions, has_older, has_newer = await db.get_transactions_page(
+        chat_id, cursor, older, HISTORY_PAGE_SIZE,
+        payment_type=_HISTORY_PAYMENT_CODES[payment_code],
+        operation_type=_HISTORY_OPERATION_CODES[operation_code],
+        category_id=category_id
+    )
     
-    response = "📋 Последние транзакции:\n\n"
-    for trans in transactions:
-        amount, payment_type, operation_type, description, created_at, username = trans
-        sign = "+" if operation_type == "add" else "-"
-        payment_emoji = "💵" if payment_type == "cash" else "💳"
-        payment_name = "Нал" if payment_type == "cash" else "Карт"
-        user_info = f" ({username})" if username else ""
-        
-        response += (
-            f"{payment_emoji} {sign}{amount:.2f} ₽ ({payment_name}){user_info}\n"
-            f"   {description or 'Без описания'}\n"
-            f"   {created_at}\n\n"
-        )
+    header = "📋 История транзакций"
+    if category_id is not None:
+        category = await db.get_category(chat_id, category_id)
+        header += f" - {category[1]}" if category else ""
     
+    if not transactions:
+        response = f"{header}\n\nТранзакций не найдено"
+    else:
+        response = f"{header}:\n\n"
+        for trans in transactions:
+            _, amount, payment_type, operation_type, description, created_at, username = trans
+            sign = "+" if operation_type == "add" else "-"
+            payment_emoji = "💵" if payment_type == "cash" else "💳"
+            payment_name = "Нал" if payment_type == "cash" else "Карт"
+            user_info = f" ({username})" if username else ""
+            
+            response += (
+                f"{payment_emoji} {sign}{amount:.2f} ₽ ({payment_name}){user_info}\n"
+                f"   {description or 'Без описания'}\n"
+                f"   {created_at}\n\n"
+            )
+    if not has_older and await db.has_archived_transactions(chat_id):
+        # Самая старая страница: раньше идут только перенесенные в архив транзакции
+        response = (response.rstrip("\n")
+                    + "\n\n🗄 Более старые транзакции перенесены в архив, они есть в выгрузке /export")
+    
+    keyboard = get_history_keyboard(
+        filters,
+        transactions[0] if transactions else None,
+        transactions[-1] if transactions else None,
+        has_newer, has_older
+    )
     if isinstance(message_or_query, CallbackQuery):
-        await message_or_query.message.edit_text(response, reply_markup=get_main_keyboard())
+        await message_or_query.message.edit_text(response, reply_markup=keyboard)
         await message_or_query.answer()
     else:
-        await message_or_query.answer(response, reply_markup=get_main_keyboard())
+        await message_or_query.answer(response, reply_markup=keyboard)
 
 
 @router.message(Command("history"))
@@ -193,14 +274,44 @@ async def cmd_history(message: Message):
     await show_history(message.chat.id, message)
 
 
+# Кэш прав: (chat_id, user_id) -> является ли администратором
+_admin_cache = TTLCache(maxsize=10000)
+# Списки администраторов чатов, по которым отвечаем отказом остальным
+_chat_admins = TTLCache(maxsize=1000)
+
+
+async def prefetch_admins(bot, chat_id: int) -> frozenset:
+    """Загрузка всех администраторов чата одним запросом к API"""
+    admins = await bot.get_chat_administrators(chat_id)
+    admin_ids = frozenset(member.user.id for member in admins)
+    for admin_id in admin_ids:
+        _admin_cache.set((chat_id, admin_id), True, config.ADMIN_CACHE_TTL)
+    # Список нужен для отказов, поэтому живет как отрицательный результат
+    _chat_admins.set(chat_id, admin_ids, config.ADMIN_CACHE_NEGATIVE_TTL)
+    return admin_ids
+
+
 async def check_admin(bot, chat_id: int, user_id: int) -> bool:
     """Проверка прав администратора"""
-    try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        return member.status in ['administrator', 'creator']
-    except Exception:
-        # В личных чатах проверка не работает, разрешаем
+    if chat_id > 0:
+        # Личный чат: администраторов нет, команда доступна собеседнику
         return True
+    is_admin = _admin_cache.get((chat_id, user_id))
+    if is_admin is not None:
+        return is_admin
+    
+    admin_ids = _chat_admins.get(chat_id)
+    if admin_ids is None:
+        try:
+            admin_ids = await prefetch_admins(bot, chat_id)
+        except Exception:
+            # Список администраторов получить не удалось, разрешаем
+            return True
+    
+    is_admin = user_id in admin_ids
+    if not is_admin:
+        _admin_cache.set((chat_id, user_id), False, config.ADMIN_CACHE_NEGATIVE_TTL)
+    return is_admin
 
 
 @router.message(Command("reset"))
@@ -285,6 +396,246 @@ async def callback_confirm_reset_all(callback: CallbackQuery):
         "Начните с создания новых категорий и транзакций.",
         reply_markup=get_main_keyboard()
     )
+    live_balance.schedule(callback.bot, callback.message.chat.id)
+
+
+@router.message(Command("livebalance"))
+async def cmd_live_balance(message: Message):
+    """Включение/выключение живого баланса (только для админов)"""
+    is_admin = await check_admin(message.bot, message.chat.id, message.from_user.id)
+    if not is_admin:
+        await message.answer("❌ Эта команда доступна только администраторам", reply_markup=get_main_keyboard())
+        return
+    
+    settings = await db.get_chat_settings(message.chat.id)
+    args = (message.text or "").split(maxsplit=1)
+    arg = args[1].strip().lower() if len(args) > 1 else ""
+    if arg in ("on", "вкл"):
+        enabled = True
+    elif arg in ("off", "выкл"):
+        enabled = False
+    elif not arg:
+        enabled = not settings['live_balance']
+    else:
+        await message.answer("Используйте: /livebalance on или /livebalance off")
+        return
+    
+    await db.update_chat_settings(message.chat.id, live_balance=enabled)
+    if enabled:
+        await message.answer(
+            "✅ Живой баланс включен\n\n"
+            "Бот закрепит сообщение с балансом и будет обновлять его после операций "
+            "вместо отправки нового сообщения."
+        )
+        await live_balance.refresh(message.bot, message.chat.id)
+    else:
+        await message.answer(
+            "✅ Живой баланс выключен\n\n"
+            "После каждой операции баланс снова отправляется новым сообщением.",
+            reply_markup=get_main_keyboard()
+        )
+
+
+@router.message(Command("zreport"))
+async def cmd_zreport(message: Message):
+    """Настройка ежедневного Z-отчета (только для админов)"""
+    is_admin = await check_admin(message.bot, message.chat.id, message.from_user.id)
+    if not is_admin:
+        await message.answer("❌ Эта команда доступна только администраторам", reply_markup=get_main_keyboard())
+        return
+
+    chat_id = message.chat.id
+    settings = await db.get_chat_settings(chat_id)
+    args = (message.text or "").split()[1:]
+    usage = ("Используйте: /zreport 22:00 [+3] - время отчета и часовой пояс (часы от UTC)\n"
+             "/zreport off - выключить")
+    if not args:
+        if settings['report_time']:
+            status = (f"🧾 Z-отчет приходит ежедневно в {settings['report_time']} "
+                      f"({zreport.format_offset(settings['utc_offset'])})")
+        else:
+            status = "🧾 Z-отчет выключен"
+        await message.answer(f"{status}\n\n{usage}")
+        return
+    if args[0].lower() in ("off", "выкл"):
+        await db.update_chat_settings(chat_id, report_time=None)
+        await message.answer("✅ Z-отчет выключен", reply_markup=get_main_keyboard())
+        return
+
+    report_time = zreport.parse_time(args[0])
+    if len(args) > 1:
+        utc_offset = zreport.parse_offset(args[1])
+    elif settings['report_time']:
+        utc_offset = settings['utc_offset']
+    else:
+        utc_offset = int(config.ZREPORT_UTC_OFFSET * 60)
+    if report_time is None or utc_offset is None or len(args) > 2:
+        await message.answer(usage)
+        return
+
+    # Время отчета за прошедший день уже прошло: первый отчет - в ближайшее время отправки
+    due = zreport.due_day(datetime.now(timezone.utc), chat_id, report_time, utc_offset, None).isoformat()
+    last_report_day = max(due, settings['last_report_day'] or due)
+    await db.update_chat_settings(chat_id, report_time=report_time, utc_offset=utc_offset,
+                                  last_report_day=last_report_day)
+    await message.answer(
+        f"✅ Z-отчет будет приходить ежедневно в {report_time} ({zreport.format_offset(utc_offset)})\n\n"
+        f"В отчете: баланс кассы, выручка, расходы, прибыль, маржа и лучшие источники дохода за день.",
+        reply_markup=get_main_keyboard()
+    )
+
+
+# Bot API не отдает боту файлы больше 20 МБ
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024
+# Как часто обновлять сообщение с ходом импорта, секунд
+IMPORT_PROGRESS_INTERVAL = 2.0
+
+# Чаты, в которые сейчас идет импорт
+_imports_in_progress = set()
+
+
+@router.message(Command("import"))
+async def cmd_import(message: Message, state: FSMContext):
+    """Импорт транзакций из CSV-файла (только для админов)"""
+    is_admin = await check_admin(message.bot, message.chat.id, message.from_user.id)
+    if not is_admin:
+        await message.answer("❌ Эта команда доступна только администраторам", reply_markup=get_main_keyboard())
+        return
+    
+    await state.set_state(TransactionStates.waiting_for_import_file)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_operation")]
+    ])
+    await message.answer(
+        "📥 Импорт транзакций из CSV\n\n"
+        "Отправьте файл документом (до 20 МБ). В первой строке - названия колонок:\n"
+        "дата, операция, оплата, сумма, категория, количество, цена, расходы, описание, пользователь\n\n"
+        "Обязательны только сумма и оплата (нал/карт). Операция - доход/расход или +/-, "
+        "без нее расходом считается отрицательная сумма. Недостающие категории будут созданы.",
+        reply_markup=keyboard
+    )
+
+
+@router.message(TransactionStates.waiting_for_import_file, F.document)
+async def process_import_file(message: Message, state: FSMContext):
+    """Загрузка и импорт CSV-файла"""
+    chat_id = message.chat.id
+    document = message.document
+    if document.file_size and document.file_size > MAX_IMPORT_FILE_SIZE:
+        await message.answer("❌ Файл больше 20 МБ. Разделите его на части и отправьте по очереди.")
+        return
+    if chat_id in _imports_in_progress:
+        await message.answer("⏳ В этот чат уже идет импорт, дождитесь его окончания.")
+        return
+    
+    await state.clear()
+    _imports_in_progress.add(chat_id)
+    status = await message.answer("⏳ Загрузка файла...")
+    last_update = time.monotonic()
+    
+    async def progress(result: csv_io.ImportResult):
+        nonlocal last_update
+        now = time.monotonic()
+        if now - last_update < IMPORT_PROGRESS_INTERVAL:
+            return
+        last_update = now
+        with sender.informational():
+            try:
+                await status.edit_text(
+                    f"⏳ Импорт: обработано строк {result.rows}, записано {result.imported}"
+                )
+            except TelegramBadRequest:
+                pass
+    
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "import.csv")
+            await message.bot.download(document, destination=path)
+            result = await csv_io.import_transactions(
+                path, chat_id, message.from_user.id, progress=progress
+            )
+    except ValueError as e:
+        await status.edit_text(f"❌ Не удалось импортировать файл: {e}", reply_markup=get_main_keyboard())
+        return
+    finally:
+        _imports_in_progress.discard(chat_id)
+    
+    report = (
+        f"✅ Импорт завершен\n\n"
+        f"Записано транзакций: {result.imported}\n"
+        f"Создано категорий: {result.categories_created}\n"
+        f"Пропущено строк: {result.skipped}"
+    )
+    if result.errors:
+        report += "\n\nОшибки:\n" + "\n".join(
+            f"• строка {line}: {error}" for line, error in result.errors
+        )
+        if result.skipped > len(result.errors):
+            report += f"\n• ... и еще {result.skipped - len(result.errors)}"
+    await status.edit_text(report, reply_markup=get_main_keyboard())
+    
+    if result.imported:
+        await show_updated_balance(message)
+
+
+# Периоды выгрузки словами, в днях
+EXPORT_PERIODS = {
+    'день': 1, 'сегодня': 1, 'day': 1,
+    'неделя': 7, 'week': 7,
+    'месяц': 30, 'month': 30,
+    'год': 365, 'year': 365,
+}
+
+# Чаты, из которых сейчас идет выгрузка
+_exports_in_progress = set()
+
+
+@router.message(Command("export"))
+async def cmd_export(message: Message):
+    """Выгрузка транзакций в CSV (только для админов)"""
+    is_admin = await check_admin(message.bot, message.chat.id, message.from_user.id)
+    if not is_admin:
+        await message.answer("❌ Эта команда доступна только администраторам", reply_markup=get_main_keyboard())
+        return
+    
+    args = (message.text or "").split(maxsplit=1)
+    arg = args[1].strip().lower() if len(args) > 1 else ""
+    if not arg or arg in ("все", "all"):
+        days = None
+    elif arg.isdigit() and int(arg) > 0:
+        days = int(arg)
+    elif arg in EXPORT_PERIODS:
+        days = EXPORT_PERIODS[arg]
+    else:
+        await message.answer(
+            "Используйте: /export - все транзакции, /export 30 - за 30 дней, "
+            "/export неделя, /export месяц, /export год"
+        )
+        return
+    
+    chat_id = message.chat.id
+    if chat_id in _exports_in_progress:
+        await message.answer("⏳ Выгрузка из этого чата уже идет, дождитесь файла.")
+        return
+    
+    _exports_in_progress.add(chat_id)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+            filename = f"transactions_{today}.csv.gz"
+            path = os.path.join(tmp, filename)
+            count = await csv_io.export_transactions(path, chat_id, days)
+            if not count:
+                await message.answer("📋 За этот период транзакций нет", reply_markup=get_main_keyboard())
+                return
+            period_text = f"за {days} дн." if days else "за все время"
+            await message.answer_document(
+                FSInputFile(path, filename=filename),
+                caption=f"📤 Транзакции {period_text}: {count}\n"
+                        f"CSV в архиве gzip, формат подходит для /import"
+            )
+    finally:
+        _exports_in_progress.discard(chat_id)
 
 
 def get_unit_economics_hint(operation: str) -> str:
@@ -301,78 +652,21 @@ def get_unit_economics_hint(operation: str) -> str:
         )
 
 
-def parse_unit_data(text: str) -> Tuple[Optional[float], Optional[float], Optional[float]]:
-    """Парсинг юнит-данных: количество, цена за единицу, расходы"""
-    quantity = None
-    unit_price = None
-    cost = None
-    
-    text_lower = text.lower()
-    
-    # Парсинг количества (кол-во, кол, qty, количество)
-    quantity_patterns = [
-        r'кол[-\s]?([0-9]+[.,]?[0-9]*)',
-        r'количество[:\s]+([0-9]+[.,]?[0-9]*)',
-        r'qty[:\s]+([0-9]+[.,]?[0-9]*)',
-        r'(\d+[.,]?\d*)\s*(шт|ед|units)'
-    ]
-    for pattern in quantity_patterns:
-        match = re.search(pattern, text_lower)
-        if match:
-            quantity = float(match.group(1).replace(',', '.'))
-            break
-    
-    # Парсинг цены за единицу (цена/ед, цена за, price/unit)
-    price_patterns = [
-        r'цена[:\s/]+([0-9]+[.,]?[0-9]*)',
-        r'price[:\s/]+([0-9]+[.,]?[0-9]*)',
-        r'([0-9]+[.,]?[0-9]*)\s*(за\s*единицу|/ед|/unit)'
-    ]
-    for pattern in price_patterns:
-        match = re.search(pattern, text_lower)
-        if match:
-            unit_price = float(match.group(1).replace(',', '.'))
-            break
-    
-    # Парсинг расходов (расход, расходы, expense)
-    cost_patterns = [
-        r'расход[=:\s]+([0-9]+[.,]?[0-9]*)',
-        r'расходы[=:\s]+([0-9]+[.,]?[0-9]*)',
-        r'expense[=:\s]+([0-9]+[.,]?[0-9]*)',
-        r'себест[=:\s]+([0-9]+[.,]?[0-9]*)',  # оставляем для совместимости
-        r'cost[=:\s]+([0-9]+[.,]?[0-9]*)'
-    ]
-    for pattern in cost_patterns:
-        match = re.search(pattern, text_lower)
-        if match:
-            cost = float(match.group(1).replace(',', '.'))
-            break
-    
-    return quantity, unit_price, cost
-
-
 @router.message(TransactionStates.waiting_for_operation_amount)
 async def process_operation_amount(message: Message, state: FSMContext):
     """Обработка введенной суммы для операции"""
-    text = message.text.strip()
-    
-    # Парсинг основной суммы (первое число в тексте)
-    numbers = re.findall(r'\d+[.,]?\d*', text)
-    if not numbers:
+    # Основная сумма (первое число в тексте) и юнит-данные за один разбор
+    parsed = parse_text(message.text)
+    if parsed.amount is None:
         await message.answer("❌ Неверный формат суммы. Введите число, например: 1000 или 500.50")
         return
     
-    try:
-        amount = float(numbers[0].replace(',', '.'))
-        if amount <= 0:
-            await message.answer("❌ Сумма должна быть больше нуля. Попробуйте еще раз.")
-            return
-    except ValueError:
-        await message.answer("❌ Неверный формат суммы. Введите число, например: 1000 или 500.50")
+    amount = parsed.amount
+    if amount <= 0:
+        await message.answer("❌ Сумма должна быть больше нуля. Попробуйте еще раз.")
         return
     
-    # Парсинг юнит-данных
-    quantity, unit_price, cost = parse_unit_data(text)
+    quantity, unit_price, cost = parsed.quantity, parsed.unit_price, parsed.cost
     
     # Если указано количество и цена, пересчитываем сумму
     if quantity and unit_price:
@@ -414,7 +708,7 @@ async def process_operation_amount(message: Message, state: FSMContext):
     await message.answer(response, reply_markup=get_main_keyboard())
     
     # Показываем обновленный баланс
-    await show_balance(message.chat.id, message)
+    await show_updated_balance(message)
     
     await state.clear()
 
@@ -457,7 +751,7 @@ async def process_transaction(message: Message, state: FSMContext):
     )
     
     # Показываем обновленный баланс
-    await show_balance(message.chat.id, message)
+    await show_updated_balance(message)
     
     await state.clear()
 
@@ -513,7 +807,8 @@ async def handle_text_message(message: Message, state: FSMContext):
     if current_state in [
         TransactionStates.waiting_for_category_name,
         TransactionStates.waiting_for_operation_amount,
-        TransactionStates.waiting_for_payment_type
+        TransactionStates.waiting_for_payment_type,
+        TransactionStates.waiting_for_import_file
     ]:
         return
     
@@ -548,7 +843,7 @@ async def handle_text_message(message: Message, state: FSMContext):
             )
         
         # Показываем обновленный баланс
-        await show_balance(message.chat.id, message)
+        await show_updated_balance(message)
     else:
         # Если сообщение не распознано, показываем подсказку в личных чатах
         if message.chat.type == 'private':
@@ -594,6 +889,23 @@ async def callback_history(callback: CallbackQuery):
     await show_history(callback.message.chat.id, callback)
 
 
+@router.callback_query(F.data.startswith("hist:"))
+async def callback_history_page(callback: CallbackQuery):
+    """Листание и фильтры истории"""
+    try:
+        older, filters, cursor = _parse_history_data(callback.data)
+    except (ValueError, IndexError):
+        await callback.answer("❌ Кнопка устарела", show_alert=True)
+        return
+    try:
+        await show_history(callback.message.chat.id, callback, filters, cursor, older)
+    except TelegramBadRequest as e:
+        # Та же страница (например, новых транзакций нет) - текст не изменился
+        if "message is not modified" not in e.message:
+            raise
+        await callback.answer()
+
+
 @router.callback_query(F.data == "refresh")
 async def callback_refresh(callback: CallbackQuery):
     """Обновление главного меню"""
@@ -693,8 +1005,7 @@ async def callback_select_category(callback: CallbackQuery, state: FSMContext):
     category_id = int(callback.data.split("_")[-1])
     await state.update_data(category_id=category_id)
     
-    categories = await db.get_categories(callback.message.chat.id)
-    category = next((c for c in categories if c[0] == category_id), None)
+    category = await db.get_category(callback.message.chat.id, category_id)
     category_name = category[1] if category else "Неизвестная"
     
     data = await state.get_data()
@@ -899,21 +1210,61 @@ async def callback_category_create(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
+# Готовые тексты и клавиатуры отчетов по (chat_id, отчет, параметры, версия данных,
+# версия пересчета). Повторный просмотр без изменений в чате не строит отчет заново:
+# любая запись в чат меняет его версию данных, а пересчет балансов или агрегатов
+# (в том числе через maintenance.py) - версию пересчета в БД. Отчеты старых версий
+# больше не запрашиваются и вытесняются из LRU
+_report_cache = LRUCache(config.REPORT_CACHE_SIZE)
+
+
+async def cached_report(chat_id: int, report: str, params: tuple, build):
+    """Отчет из кэша, если данные чата не менялись с его построения, иначе build()"""
+    # Версия берется до чтения данных: запись во время построения сменит версию,
+    # и следующий просмотр построит отчет заново
+    versions = (db.get_data_version(chat_id), await db.get_rebuild_version(chat_id))
+    key = (chat_id, report, params, versions)
+    result = _report_cache.get(key)
+    if result is None:
+        result = await build()
+        _report_cache.set(key, result)
+    return result
+
+
+def get_report_cache_stats() -> dict:
+    """Размер кэша отчетов и счетчики попаданий/промахов"""
+    return _report_cache.stats()
+
+
+def _report_day() -> str:
+    """Текущий день (UTC): отчеты за период меняются с его сменой"""
+    return datetime.now(timezone.utc).date().isoformat()
+
+
 @router.callback_query(F.data.startswith("cat_view_"))
 async def callback_category_view(callback: CallbackQuery):
     """Просмотр категории"""
+    chat_id = callback.message.chat.id
     category_id = int(callback.data.split("_")[-1])
-    categories = await db.get_categories(callback.message.chat.id)
-    category = next((c for c in categories if c[0] == category_id), None)
+    category = await db.get_category(chat_id, category_id)
     
     if not category:
         await callback.answer("❌ Категория не найдена", show_alert=True)
         return
     
-    cat_id, name, description, cat_type, created_at = category
+    text, keyboard = await cached_report(
+        chat_id, "category_view", (category_id, _report_day()),
+        lambda: _build_category_view(chat_id, category)
+    )
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+
+async def _build_category_view(chat_id: int, category: tuple):
+    category_id, name, description, cat_type, created_at = category
     
     # Получаем статистику по категории
-    stats = await db.get_unit_economics_by_category(callback.message.chat.id, category_id, 30)
+    stats = await db.get_unit_economics_by_category(chat_id, category_id, 30)
     
     category_type_text = "Источник дохода" if cat_type == "income_source" else "Категория расхода"
     back_menu = "income_sources_menu" if cat_type == "income_source" else "expense_categories_menu"
@@ -943,6 +1294,7 @@ async def callback_category_view(callback: CallbackQuery):
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
+            InlineKeyboardButton(text="📋 История", callback_data=_history_data("o", f"--{category_id}")),
             InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_cat_{category_id}")
         ],
         [
@@ -952,9 +1304,7 @@ async def callback_category_view(callback: CallbackQuery):
             InlineKeyboardButton(text="🏠 На главную", callback_data="main_menu")
         ]
     ])
-    
-    await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
+    return text, keyboard
 
 
 @router.callback_query(F.data.startswith("delete_cat_"))
@@ -963,8 +1313,7 @@ async def callback_delete_category(callback: CallbackQuery):
     category_id = int(callback.data.split("_")[-1])
     
     # Получаем информацию о категории
-    categories = await db.get_categories(callback.message.chat.id)
-    category = next((c for c in categories if c[0] == category_id), None)
+    category = await db.get_category(callback.message.chat.id, category_id)
     
     if not category:
         await callback.answer("❌ Категория не найдена", show_alert=True)
@@ -999,8 +1348,7 @@ async def callback_confirm_delete(callback: CallbackQuery):
     category_id = int(callback.data.split("_")[-1])
     
     # Получаем информацию о категории для возврата в правильное меню (до удаления)
-    categories = await db.get_categories(callback.message.chat.id)
-    category = next((c for c in categories if c[0] == category_id), None)
+    category = await db.get_category(callback.message.chat.id, category_id)
     
     if not category:
         # Категория уже удалена, возвращаемся в общее меню категорий
@@ -1020,9 +1368,6 @@ async def callback_confirm_delete(callback: CallbackQuery):
     # Удаляем категорию
     await db.delete_category(callback.message.chat.id, category_id)
     
-    # Удаляем категорию
-    await db.delete_category(callback.message.chat.id, category_id)
-    
     await callback.answer(f"✅ {category_type_text.capitalize()} '{name}' удален(а)", show_alert=True)
     
     # Возвращаемся в соответствующее меню, создав новый callback
@@ -1041,7 +1386,16 @@ async def callback_confirm_delete(callback: CallbackQuery):
 @router.callback_query(F.data == "summary_table")
 async def callback_summary_table(callback: CallbackQuery):
     """Сводная таблица доходов и расходов по категориям с процентами"""
-    summary = await db.get_summary_by_categories(callback.message.chat.id, 30)
+    chat_id = callback.message.chat.id
+    text, keyboard = await cached_report(
+        chat_id, "summary_table", (_report_day(),), lambda: _build_summary_table(chat_id)
+    )
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+
+async def _build_summary_table(chat_id: int):
+    summary = await db.get_summary_by_categories(chat_id, 30)
     
     text = f"📊 Сводная таблица за {summary['days']} дней\n\n"
     text += "━━━━━━━━━━━━━━━━━━━━\n\n"
@@ -1083,17 +1437,24 @@ async def callback_summary_table(callback: CallbackQuery):
         [InlineKeyboardButton(text="🔙 Назад к категориям", callback_data="categories_menu")],
         [InlineKeyboardButton(text="🏠 На главную", callback_data="main_menu")]
     ])
-    
-    await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
+    return text, keyboard
 
 
 # Обработчики для юнит-экономики
 @router.callback_query(F.data == "unit_economics")
 async def callback_unit_economics(callback: CallbackQuery):
     """Показать юнит-экономику"""
-    summary = await db.get_unit_economics_summary(callback.message.chat.id, 30)
-    categories_stats = await db.get_unit_economics_by_category(callback.message.chat.id, None, 30)
+    chat_id = callback.message.chat.id
+    text, keyboard = await cached_report(
+        chat_id, "unit_economics", (_report_day(),), lambda: _build_unit_economics(chat_id)
+    )
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+
+async def _build_unit_economics(chat_id: int):
+    summary = await db.get_unit_economics_summary(chat_id, 30)
+    categories_stats = await db.get_unit_economics_by_category(chat_id, None, 30)
     
     text = "📊 Юнит-экономика за 30 дней\n\n"
     
@@ -1131,9 +1492,7 @@ async def callback_unit_economics(callback: CallbackQuery):
         [InlineKeyboardButton(text="📁 По категориям", callback_data="categories_menu")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")]
     ])
-    
-    await callback.message.edit_text(text, reply_markup=keyboard)
-    await callback.answer()
+    return text, keyboard
 
 
 @router.message(Command("unit"))
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import weakref
+from typing import Dict, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+
+import config
+import database as db
+import sender
+
+logger = logging.getLogger(__name__)
+
+# Чаты с запланированным обновлением: chat_id -> (бот, задача ожидания)
+_pending: Dict[int, Tuple[Bot, asyncio.Task]] = {}
+# Не даем двум обновлениям одного чата одновременно отправить новое сообщение
+_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def format_balance(cash: float, card: float) -> str:
+    """Текст сообщения с балансом кассы"""
+    total = cash + card
+    return (
+        f"💰 Баланс кассы:\n\n"
+        f"💵 Наличные: {cash:.2f} ₽\n"
+        f"💳 Безналичные: {card:.2f} ₽\n"
+        f"━━━━━━━━━━━━━━━━━━━━\n"
+        f"📊 Итого: {total:.2f} ₽"
+    )
+
+
+def _lock(chat_id: int) -> asyncio.Lock:
+    lock = _locks.get(chat_id)
+    if lock is None:
+        lock = _locks[chat_id] = asyncio.Lock()
+    return lock
+
+
+async def refresh(bot: Bot, chat_id: int):
+    """Обновление закрепленного сообщения с балансом. Если сообщения нет
+    или его удалили, отправляется и закрепляется новое"""
+    async with _lock(chat_id):
+        settings = await db.get_chat_settings(chat_id)
+        if not settings['live_balance']:
+            return
+        cash, card = await db.get_balance(chat_id)
+        text = format_balance(cash, card)
+        message_id = settings['balance_message_id']
+
+        with sender.informational():
+            if message_id is not None:
+                try:
+                    await bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
+                    return
+                except TelegramBadRequest as e:
+                    if "message is not modified" in e.message:
+                        return
+                    logger.info(f"Сообщение с балансом в чате {chat_id} недоступно ({e.message}), "
+                                f"отправляем новое")
+
+            message = await bot.send_message(chat_id, text, disable_notification=True)
+            await db.update_chat_settings(chat_id, balance_message_id=message.message_id)
+            try:
+                await bot.pin_chat_message(chat_id, message.message_id, disable_notification=True)
+            except TelegramAPIError as e:
+                # Без прав на закрепление сообщение все равно обновляется
+                logger.warning(f"Не удалось закрепить баланс в чате {chat_id}: {e}")
+
+
+async def _refresh_safely(bot: Bot, chat_id: int):
+    try:
+        await refresh(bot, chat_id)
+    except Exception as e:
+        logger.error(f"Ошибка обновления баланса в чате {chat_id}: {e}", exc_info=True)
+
+
+async def _delayed_refresh(bot: Bot, chat_id: int):
+    await asyncio.sleep(config.LIVE_BALANCE_DEBOUNCE)
+    # Операции, пришедшие во время обновления, запланируют следующее
+    _pending.pop(chat_id, None)
+    await _refresh_safely(bot, chat_id)
+
+
+def schedule(bot: Bot, chat_id: int):
+    """Отложенное обновление баланса: серия операций за LIVE_BALANCE_DEBOUNCE
+    секунд дает одно редактирование с итоговыми цифрами"""
+    if chat_id in _pending:
+        return
+    task = asyncio.create_task(_delayed_refresh(bot, chat_id))
+    _pending[chat_id] = (bot, task)
+
+
+async def flush():
+    """Немедленное выполнение всех отложенных обновлений (при остановке бота)"""
+    pending = list(_pending.items())
+    _pending.clear()
+    for _, (_, task) in pending:
+        task.cancel()
+    await asyncio.gather(*(_refresh_safely(bot, chat_id) for chat_id, (bot, _) in pending))
@@ -1,11 +1,23 @@
+import argparse
 import asyncio
 import logging
+import signal
+from typing import Optional, Tuple
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiohttp import web
 import config
 import database as db
 import handlers
+import live_balance
+import metrics
+import querylog
+import sharding
+import zreport
+from sender import SendScheduler
+from storage import SQLiteStorage
+from webhook import run_webhook
 
 logging.basicConfig(
     level=logging.INFO,
@@ -14,30 +26,139 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-async def main():
+async def migrate_money():
+    """Фоновый перевод сумм в копейки"""
+    logger.info("Перевод сумм в копейки запущен в фоне...")
+    try:
+        await db.migrate_money_to_kopecks()
+    except Exception as e:
+        logger.error(f"Ошибка перевода сумм в копейки (продолжится при следующем запуске): {e}",
+                     exc_info=True)
+    else:
+        logger.info("Суммы переведены в копейки")
+
+
+async def archive_loop():
+    """Периодический перенос старых транзакций в архив"""
+    while True:
+        # До перевода в копейки архив не ведется
+        if not db.money_migration_pending():
+            try:
+                moved = await db.archive_old_transactions(config.ARCHIVE_AFTER_DAYS)
+            except Exception as e:
+                logger.error(f"Ошибка переноса транзакций в архив: {e}", exc_info=True)
+            else:
+                if moved:
+                    logger.info(f"В архив перенесено транзакций: {moved}")
+        await asyncio.sleep(config.ARCHIVE_INTERVAL)
+
+
+def log_query_report():
+    """Сводка по SQL-запросам с наибольшим суммарным временем"""
+    logger.info(querylog.format_report(config.QUERY_REPORT_TOP))
+
+
+def create_bot(global_rate: float = config.SEND_GLOBAL_RATE) -> Tuple[Bot, SendScheduler]:
+    """Бот, все исходящие вызовы которого проходят через планировщик с учетом лимитов Telegram"""
+    bot = Bot(
+        token=config.BOT_TOKEN,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+    scheduler = SendScheduler(
+        group_rate=config.SEND_GROUP_RATE_PER_MINUTE / 60,
+        group_burst=config.SEND_GROUP_BURST,
+        private_rate=config.SEND_PRIVATE_RATE,
+        private_burst=config.SEND_PRIVATE_BURST,
+        global_rate=global_rate,
+        max_retries=config.SEND_MAX_RETRIES
+    )
+    bot.session.middleware(scheduler)
+    # Внутри планировщика: замеряется сам запрос, без ожидания очереди
+    bot.session.middleware(metrics.RequestMetrics())
+    return bot, scheduler
+
+
+def create_dispatcher(storage: SQLiteStorage) -> Dispatcher:
+    """Диспетчер с роутерами бота и замером обработчиков"""
+    dp = Dispatcher(storage=storage)
+    dp.include_router(handlers.router)
+    # Внутренний middleware диспетчера действует на обработчики всех роутеров
+    handler_metrics = metrics.HandlerMetrics()
+    dp.message.middleware(handler_metrics)
+    dp.callback_query.middleware(handler_metrics)
+    # Отложенные обновления живого баланса отправляются до закрытия сессии бота
+    dp.shutdown.register(live_balance.flush)
+    return dp
+
+
+async def start_monitoring(storage: SQLiteStorage, scheduler: SendScheduler,
+                           metrics_port: int) -> Tuple[list, Optional[web.AppRunner]]:
+    """Сбор метрик, сводка SQL по SIGUSR1 и сервер /metrics (если задан порт).
+    Возвращает фоновые задачи и сервер метрик для остановки"""
+    metrics.register_runtime_collectors(storage, scheduler, handlers.get_report_cache_stats)
+    background = [asyncio.create_task(metrics.monitor_loop_lag())]
+    # kill -USR1 <pid> - сводка по SQL-запросам в журнал
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, log_query_report)
+    metrics_server = None
+    if metrics_port:
+        metrics_server = await metrics.start_server(
+            config.METRICS_HOST, metrics_port, query_top=config.QUERY_REPORT_TOP
+        )
+    return background, metrics_server
+
+
+async def main(mode: str = "polling", workers: int = 1):
     """Основная функция запуска бота"""
+    migration = None
+    background = []
+    metrics_server = None
     try:
         # Проверка токена
         if not config.BOT_TOKEN:
             logger.error("BOT_TOKEN не найден в переменных окружения")
             raise ValueError("BOT_TOKEN не найден")
         
+        # Замер вызовов БД включается до первого обращения к ней
+        metrics.instrument_module(db)
+        querylog.set_slow_threshold(config.SLOW_QUERY_MS / 1000)
+        
+        # Служебные команды, которым нужен остановленный бот, проверяют эту отметку
+        if not db.claim_database():
+            raise RuntimeError("Файл БД уже используется другим процессом (бот или maintenance.py)")
+        
         logger.info("Инициализация базы данных...")
-        # Инициализация базы данных
+        # Открываем пул соединений один раз на всё время работы бота
+        await db.open_pool()
         await db.init_db()
         logger.info("База данных инициализирована")
+        if workers > 1:
+            # Чаты обрабатывают процессы-исполнители, здесь только прием обновлений.
+            # Перевод в копейки меняет формат сумм для всех процессов сразу,
+            # поэтому завершается до их запуска
+            if db.money_migration_pending():
+                logger.info("Перевод сумм в копейки перед запуском исполнителей...")
+                await db.migrate_money_to_kopecks()
+            await db.close_pool()
+            await sharding.run_sharded(mode, workers)
+            return
+        if db.money_migration_pending():
+            # Старая БД с суммами в рублях: переводим в копейки, не останавливая бота
+            migration = asyncio.create_task(migrate_money())
         
         # Создание бота и диспетчера
         logger.info("Создание бота и диспетчера...")
-        bot = Bot(
-            token=config.BOT_TOKEN,
-            default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-        )
-        dp = Dispatcher()
-        
-        # Регистрация роутеров
-        dp.include_router(handlers.router)
+        bot, scheduler = create_bot()
+        # Состояния диалогов хранятся в SQLite и переживают перезапуск
+        storage = SQLiteStorage(ttl=config.FSM_STATE_TTL, cache_size=config.FSM_CACHE_SIZE)
+        storage.start()
+        dp = create_dispatcher(storage)
         logger.info("Роутеры зарегистрированы")
+        background, metrics_server = await start_monitoring(storage, scheduler, config.METRICS_PORT)
+        if config.ARCHIVE_AFTER_DAYS:
+            background.append(asyncio.create_task(archive_loop()))
+        # Ежедневные Z-отчеты по расписанию чатов
+        background.append(asyncio.create_task(zreport.run(bot)))
         
         # Проверка подключения к Telegram API
         logger.info("Проверка подключения к Telegram API...")
@@ -45,16 +166,61 @@ async def main():
         logger.info(f"Бот подключен: @{bot_info.username} ({bot_info.first_name})")
         
         # Запуск бота
-        logger.info("Запуск polling...")
-        await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
+        if mode == "webhook":
+            logger.info("Запуск в режиме вебхука...")
+            await run_webhook(
+                bot, dp,
+                url=config.WEBHOOK_URL,
+                path=config.WEBHOOK_PATH,
+                secret_token=config.WEBHOOK_SECRET,
+                host=config.WEBAPP_HOST,
+                port=config.WEBAPP_PORT,
+                max_concurrency=config.MAX_CONCURRENT_UPDATES,
+                drain_timeout=config.WEBHOOK_DRAIN_TIMEOUT
+            )
+        else:
+            logger.info("Запуск polling...")
+            # Telegram не отдает обновления через getUpdates, пока установлен вебхук
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}", exc_info=True)
         raise
+    finally:
+        for task in background:
+            task.cancel()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        if migration is not None and not migration.done():
+            # Прерванная миграция продолжится с сохраненной позиции
+            migration.cancel()
+            await asyncio.gather(migration, return_exceptions=True)
+        await db.close_pool()
+        db.release_database()
+        logger.info("Соединения с базой данных закрыты")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бот для подсчета кассы")
+    parser.add_argument(
+        "--mode",
+        choices=["polling", "webhook"],
+        default="polling",
+        help="способ получения обновлений от Telegram (по умолчанию polling)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=config.SHARD_WORKERS,
+        help="число процессов, между которыми распределяются чаты (по умолчанию SHARD_WORKERS, 1)"
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
+    args = parse_args()
     try:
-        asyncio.run(main())
+        asyncio.run(main(args.mode, args.workers))
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
     except Exception as e:
@@ -0,0 +1,178 @@
+"""
+Служебные команды для обслуживания базы данных
+Используйте: python maintenance.py rebuild-balances [chat_id] для пересчета балансов
+Используйте: python maintenance.py rebuild-rollups [chat_id] для пересчета дневных агрегатов
+Используйте: python maintenance.py check-plans [путь] для проверки планов запросов
+Используйте: python maintenance.py migrate-money для перевода сумм в копейки
+Используйте: python maintenance.py split-db chat|buckets N для разделения БД на файлы по чатам
+Используйте: python maintenance.py archive DAYS для переноса в архив транзакций старше DAYS дней
+Используйте: python maintenance.py vacuum для перевода файлов БД на постраничный возврат места
+"""
+import os
+import sys
+import asyncio
+import database as db
+
+
+def bot_stopped() -> bool:
+    """Для команд, которым нужен остановленный бот: отметка файла БД на время
+    команды, чтобы бот не запустился посреди нее. False - бот работает"""
+    if db.claim_database():
+        return True
+    print("Бот запущен: остановите его и повторите команду")
+    return False
+
+
+async def rebuild_balances(chat_id=None):
+    """Пересчет таблицы балансов из истории транзакций"""
+    await db.open_pool()
+    try:
+        await db.init_db()
+        await db.rebuild_balances(chat_id)
+    finally:
+        await db.close_pool()
+    target = f"чата {chat_id}" if chat_id is not None else "всех чатов"
+    print(f"Балансы {target} пересчитаны")
+
+
+async def rebuild_rollups(chat_id=None):
+    """Заполнение дневных агрегатов по истории транзакций"""
+    await db.open_pool()
+    try:
+        await db.init_db()
+        await db.rebuild_rollups(chat_id)
+    finally:
+        await db.close_pool()
+    target = f"чата {chat_id}" if chat_id is not None else "всех чатов"
+    print(f"Дневные агрегаты {target} пересчитаны")
+
+
+async def check_plans(path: str = db.DB_NAME) -> bool:
+    """Проверка, что запросы горячих путей не делают полный проход по таблицам.
+    Проверяется существующий файл БД: пустой файл на его месте не создается"""
+    if not os.path.exists(path):
+        print(f"Файл БД {path} не найден")
+        return False
+    await db.open_pool(path)
+    try:
+        await db.init_db()
+        plans = await db.explain_hot_queries()
+    finally:
+        await db.close_pool()
+
+    ok = True
+    for name, lines in plans.items():
+        print(f"{name}:")
+        for line in lines:
+            # SEARCH - поиск по индексу, SCAN - проход по всей таблице или индексу
+            full_scan = line.startswith("SCAN ")
+            marker = "❌" if full_scan else "  "
+            print(f"  {marker} {line}")
+            if full_scan:
+                ok = False
+    print("Планы запросов в порядке" if ok else "Обнаружен полный проход по таблице")
+    return ok
+
+
+async def migrate_money():
+    """Перевод сумм старой БД из рублей (REAL) в копейки (INTEGER)"""
+    await db.open_pool()
+    try:
+        await db.init_db()
+        if not db.money_migration_pending():
+            print("Суммы уже хранятся в копейках")
+            return
+        await db.migrate_money_to_kopecks(
+            progress=lambda position: print(f"Перенесены транзакции до id {position}")
+        )
+    finally:
+        await db.close_pool()
+    print("Суммы переведены в копейки")
+
+
+async def split_db(per_chat: bool, buckets: int = 0):
+    """Разделение БД на файлы по чатам или корзинам чатов"""
+    await db.open_pool()
+    try:
+        await db.init_db()
+        if db.money_migration_pending():
+            print("Сначала суммы переводятся в копейки...")
+            await db.migrate_money_to_kopecks()
+        chats = await db.split_into_partitions(
+            per_chat, buckets,
+            progress=lambda name, count: print(f"{name}: перенесено чатов {count}")
+        )
+    finally:
+        await db.close_pool()
+    print(f"Данные {chats} чатов перенесены в файлы-разделы")
+
+
+async def archive(days: int):
+    """Перенос старых транзакций в архив и возврат освободившегося места"""
+    await db.open_pool()
+    try:
+        await db.init_db()
+        moved = await db.archive_old_transactions(
+            days, progress=lambda chat_id, count: print(f"Чат {chat_id}: в архив перенесено {count}")
+        )
+        incremental = await db.incremental_vacuum_enabled()
+    finally:
+        await db.close_pool()
+    print(f"В архив перенесено транзакций: {moved}")
+    if not incremental:
+        print("Место в файле БД не возвращается: выполните python maintenance.py vacuum")
+
+
+async def vacuum():
+    """Полный VACUUM с переводом файлов БД на постраничный возврат места"""
+    await db.open_pool()
+    try:
+        await db.init_db()
+        await db.enable_incremental_vacuum()
+    finally:
+        await db.close_pool()
+    print("Файлы БД сжаты, освобождаемое место возвращается без остановки бота")
+
+
+def print_usage():
+    print("Использование:")
+    print("  python maintenance.py rebuild-balances [chat_id] - пересчитать балансы")
+    print("  python maintenance.py rebuild-rollups [chat_id] - пересчитать дневные агрегаты")
+    print("  python maintenance.py check-plans [путь] - проверить планы запросов")
+    print("  python maintenance.py migrate-money - перевести суммы в копейки")
+    print("  python maintenance.py split-db chat - разделить БД: отдельный файл на каждый чат")
+    print("  python maintenance.py split-db buckets N - разделить БД на N файлов по chat_id")
+    print("  python maintenance.py archive DAYS - перенести в архив транзакции старше DAYS дней")
+    print("  python maintenance.py vacuum - сжать файлы БД (бот должен быть остановлен)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print_usage()
+        sys.exit(1)
+
+    command = sys.argv[1].lower()
+    args = sys.argv[2:]
+
+    if command == "rebuild-balances":
+        asyncio.run(rebuild_balances(int(args[0]) if args else None))
+    elif command == "rebuild-rollups":
+        asyncio.run(rebuild_rollups(int(args[0]) if args else None))
+    elif command == "check-plans":
+        sys.exit(0 if asyncio.run(check_plans(*args[:1])) else 1)
+    elif command in ("migrate-money", "split-db", "vacuum") and not bot_stopped():
+        sys.exit(1)
+    elif command == "migrate-money":
+        asyncio.run(migrate_money())
+    elif command == "split-db" and args[:1] == ["chat"]:
+        asyncio.run(split_db(per_chat=True))
+    elif command == "split-db" and args[:1] == ["buckets"] and len(args) == 2:
+        asyncio.run(split_db(per_chat=False, buckets=int(args[1])))
+    elif command == "archive" and len(args) == 1:
+        asyncio.run(archive(int(args[0])))
+    elif command == "vacuum":
+        asyncio.run(vacuum())
+    else:
+        print(f"Неизвестная команда: {command}")
+        print_usage()
+        sys.exit(1)
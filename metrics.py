@@ -0,0 +1,344 @@
+"""
+Метрики в формате Prometheus: задержки обработчиков, вызовов database и
+Telegram API, активные диалоги FSM, задержка цикла событий
+Наблюдение - поиск корзины гистограммы и пара сложений, поэтому сбор
+включен всегда; HTTP-сервер с /metrics запускается, если задан METRICS_PORT
+"""
+import asyncio
+import bisect
+import contextvars
+import inspect
+import logging
+import time
+from functools import wraps
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiohttp import web
+
+import database as db
+import querylog
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, секунд
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Как часто измерять задержку цикла событий, секунд
+LOOP_LAG_INTERVAL = 0.5
+
+_metrics: list = []
+# Функции, обновляющие метрики-снимки (размеры очередей, состояния FSM) перед выдачей
+_collectors: List[Callable[[], Awaitable[None]]] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: Dict[tuple, object] = {}
+        _metrics.append(self)
+
+    def clear(self):
+        self._values.clear()
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Счетчик, который только растет"""
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set_total(self, value: float, *labels):
+        """Значение счетчика, который ведет другой объект (планировщик, кэш)"""
+        self._values[labels] = value
+
+
+class Gauge(_Metric):
+    """Текущее значение"""
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """Распределение значений по корзинам"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            # Счетчики корзин (последняя - выше всех границ), сумма, количество
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+HANDLER_DURATION = Histogram(
+    "bot_handler_duration_seconds", "Время работы обработчиков обновлений", ("handler",)
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Исключения в обработчиках обновлений", ("handler",)
+)
+DB_CALL_DURATION = Histogram(
+    "bot_db_call_duration_seconds", "Время вызовов функций database", ("function",)
+)
+DB_CALL_ERRORS = Counter(
+    "bot_db_call_errors_total", "Исключения в функциях database", ("function",)
+)
+TELEGRAM_REQUEST_DURATION = Histogram(
+    "bot_telegram_request_duration_seconds",
+    "Время запросов к Telegram API (без ожидания в очереди отправки)", ("method",)
+)
+TELEGRAM_REQUEST_ERRORS = Counter(
+    "bot_telegram_request_errors_total", "Ошибки запросов к Telegram API", ("method", "error")
+)
+EVENT_LOOP_LAG = Histogram(
+    "bot_event_loop_lag_seconds", "Опоздание цикла событий относительно запланированного времени"
+)
+FSM_ACTIVE_STATES = Gauge(
+    "bot_fsm_active_states", "Незавершенные диалоги по состояниям FSM", ("state",)
+)
+
+SEND_QUEUE_DEPTH = Gauge("bot_send_queue_depth", "Сообщения, ожидающие отправки")
+SEND_MESSAGES = Counter("bot_send_messages_total", "Отправленные сообщения")
+SEND_THROTTLED = Counter("bot_send_throttled_total", "Сообщения, ждавшие своей очереди из-за лимитов")
+SEND_RETRY_AFTER = Counter("bot_send_retry_after_total", "Ответы Telegram RetryAfter")
+DB_WRITE_QUEUE_DEPTH = Gauge("bot_db_write_queue_depth", "Транзакции в очереди групповой записи")
+DB_WRITE_BATCHES = Counter("bot_db_write_batches_total", "Пачки групповой записи транзакций")
+DB_WRITE_ROWS = Counter("bot_db_write_rows_total", "Транзакции, записанные пачками")
+CACHE_HITS = Counter("bot_cache_hits_total", "Попадания в кэш", ("cache",))
+CACHE_MISSES = Counter("bot_cache_misses_total", "Промахи кэша", ("cache",))
+
+
+def register_collector(collector: Callable[[], Awaitable[None]]):
+    """Функция, обновляющая метрики-снимки перед каждой выдачей /metrics"""
+    _collectors.append(collector)
+
+
+async def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    for collector in _collectors:
+        try:
+            await collector()
+        except Exception as e:
+            logger.error(f"Ошибка сбора метрик: {e}", exc_info=True)
+    return "\n".join(metric.render() for metric in _metrics) + "\n"
+
+
+def register_runtime_collectors(storage, scheduler, report_cache_stats: Callable[[], dict]):
+    """Снимки состояния бота: диалоги FSM, очередь отправки, групповая запись, кэши.
+    report_cache_stats - статистика кэша отчетов (handlers.get_report_cache_stats)"""
+
+    async def collect_fsm():
+        FSM_ACTIVE_STATES.clear()
+        for state, count in (await storage.count_states()).items():
+            FSM_ACTIVE_STATES.set(count, state)
+
+    async def collect_queues():
+        send = scheduler.stats()
+        SEND_QUEUE_DEPTH.set(send['queue_depth'])
+        SEND_MESSAGES.set_total(send['sent'])
+        SEND_THROTTLED.set_total(send['throttled'])
+        SEND_RETRY_AFTER.set_total(send['retry_after'])
+        write = db.get_write_queue_stats()
+        DB_WRITE_QUEUE_DEPTH.set(write['depth'])
+        DB_WRITE_BATCHES.set_total(write['batches'])
+        DB_WRITE_ROWS.set_total(write['rows'])
+        categories = db.get_category_cache_stats()
+        CACHE_HITS.set_total(categories['hits'], 'categories')
+        CACHE_MISSES.set_total(categories['misses'], 'categories')
+        reports = report_cache_stats()
+        CACHE_HITS.set_total(reports['hits'], 'reports')
+        CACHE_MISSES.set_total(reports['misses'], 'reports')
+
+    register_collector(collect_fsm)
+    register_collector(collect_queues)
+
+
+class HandlerMetrics:
+    """Внутренний middleware Dispatcher: время и ошибки каждого обработчика"""
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_DURATION.observe(time.perf_counter() - started, name)
+
+
+class RequestMetrics(BaseRequestMiddleware):
+    """Middleware сессии бота: время и ошибки запросов к Telegram API"""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_REQUEST_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_REQUEST_DURATION.observe(time.perf_counter() - started, name)
+
+
+# Идет ли уже замеряемый вызов database: вложенные вызовы (get_income_sources ->
+# get_categories) входят во время внешнего и отдельно не замеряются
+_in_db_call: contextvars.ContextVar[bool] = contextvars.ContextVar("in_db_call", default=False)
+
+
+def _timed(name: str, func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if _in_db_call.get():
+            return await func(*args, **kwargs)
+        token = _in_db_call.set(True)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            DB_CALL_ERRORS.inc(name)
+            raise
+        finally:
+            DB_CALL_DURATION.observe(time.perf_counter() - started, name)
+            _in_db_call.reset(token)
+    return wrapper
+
+
+async def _timed_iteration(name: str, gen):
+    """Проход по асинхронному генератору: замеряется только время внутри
+    генератора, без обработки строк вызывающим кодом"""
+    elapsed = 0.0
+    try:
+        while True:
+            token = _in_db_call.set(True)
+            started = time.perf_counter()
+            try:
+                item = await gen.__anext__()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                DB_CALL_ERRORS.inc(name)
+                raise
+            finally:
+                elapsed += time.perf_counter() - started
+                _in_db_call.reset(token)
+            yield item
+    finally:
+        await gen.aclose()
+        DB_CALL_DURATION.observe(elapsed, name)
+
+
+def _timed_generator(name: str, func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        gen = func(*args, **kwargs)
+        if _in_db_call.get():
+            return gen
+        return _timed_iteration(name, gen)
+    return wrapper
+
+
+def instrument_module(module):
+    """Замер всех публичных асинхронных функций и генераторов модуля (database).
+    Функции заменяются в самом модуле; вызовы изнутри уже замеряемого вызова
+    входят в его время и отдельно не учитываются"""
+    for name in dir(module):
+        func = getattr(module, name)
+        if name.startswith("_") or getattr(func, "__wrapped__", None) is not None:
+            continue
+        if inspect.isasyncgenfunction(func):
+            setattr(module, name, _timed_generator(name, func))
+        elif asyncio.iscoroutinefunction(func):
+            setattr(module, name, _timed(name, func))
+
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """Фоновая задача: насколько позже запланированного просыпается цикл событий"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - expected))
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        body=(await render()).encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+async def _handle_queries(request: web.Request) -> web.Response:
+    try:
+        top = int(request.query.get("top", request.app["query_top"]))
+    except ValueError:
+        raise web.HTTPBadRequest(text="top должен быть числом")
+    return web.Response(text=querylog.format_report(top) + "\n")
+
+
+async def start_server(host: str, port: int, query_top: int = 20) -> web.AppRunner:
+    """HTTP-сервер с /metrics и сводкой по SQL-запросам /queries?top=N"""
+    app = web.Application()
+    app["query_top"] = query_top
+    app.router.add_get("/metrics", _handle_metrics)
+    app.router.add_get("/queries", _handle_queries)
+    runner = web.AppRunner(app, handle_signals=False, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
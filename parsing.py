@@ -0,0 +1,172 @@
+import re
+from typing import NamedTuple, Optional, Tuple
+
+# Грамматика текста операции. Текст просматривается одним регулярным выражением,
+# каждое совпадение - смысловая единица: ключевое слово со значением, число
+# (возможно, с единицами измерения), тип оплаты, признак вычитания. Остальные
+# слова пропускаются внутри движка регулярных выражений.
+# Ключевые слова узнаются по началу слова ("наличными", "картой", "расходы"),
+# в том числе сразу после числа ("1000нал")
+_QUANTITY_WORDS = ('кол-во', 'колво', 'кол', 'qty')
+_QUANTITY_PREFIXES = ('количеств',)
+_PRICE_WORDS = ('цена', 'цену', 'цене', 'price')
+_COST_PREFIXES = ('расход', 'expense', 'себест', 'cost')
+# "безнал" и "cashless" - карта, хотя начинаются как "нал" и "cash"
+_CARD_PREFIXES = ('безнал', 'cashless', 'карт', 'card')
+_CASH_WORDS = ('нал', 'нала', 'налом', 'налу', 'налик', 'налика', 'наликом')
+_CASH_PREFIXES = ('налич', 'cash')
+_SUBTRACT_PREFIXES = ('минус', 'вычесть', 'вычти')
+# Единицы после числа: "5 шт", "3 ед", "10 units"
+_UNIT_PREFIXES = ('шт', 'ед', 'единиц', 'unit')
+
+_NUMBER = r"(\d+(?:[.,]\d*)?)"
+_WORD_START = r"(?<![^\W\d_])"
+_WORD_END = r"(?![^\W\d_])"
+_WORD_REST = r"[^\W\d_]*"
+
+
+def _words(words=(), prefixes=()) -> str:
+    """Альтернатива из целых слов и начал слов"""
+    parts = [f"(?:{'|'.join(words)}){_WORD_END}"] if words else []
+    if prefixes:
+        parts.append(f"(?:{'|'.join(prefixes)}){_WORD_REST}")
+    return "|".join(parts)
+
+
+# Количество: "кол 5", "кол-во: 3", "количество 4", "qty 10"
+_QUANTITY_TOKEN = rf"(?:{_words(_QUANTITY_WORDS, _QUANTITY_PREFIXES)})[\s:=-]*{_NUMBER}"
+# Цена за единицу: "цена 100", "цена/50", "цена за единицу 200", "price: 12.5"
+# Промежуточное слово всегда берется целиком, иначе "единицу" можно разбить
+# на "ед" + "иницу" множеством способов и перебор растет экспоненциально
+_PRICE_TOKEN = (
+    rf"(?:{_words(_PRICE_WORDS)})"
+    rf"(?:[\s:=/]|(?=за{_WORD_END}|{'|'.join(_UNIT_PREFIXES)}){_WORD_REST}{_WORD_END})*{_NUMBER}"
+)
+# Расходы: "расход 50", "расходы: 30", "себест 40", "cost=25"
+_COST_TOKEN = rf"(?:{_words(prefixes=_COST_PREFIXES)})[\s:=]*{_NUMBER}"
+# Число с единицами: "100/ед" и "150 за единицу" - цена, "5 шт" - количество
+_NUMBER_TOKEN = (
+    rf"{_NUMBER}(?:\s*(?:/|за(?=\s))\s*({_words(prefixes=_UNIT_PREFIXES)})"
+    rf"|\s*({_words(prefixes=_UNIT_PREFIXES)}))?"
+)
+_CARD_TOKEN = f"({_words(prefixes=_CARD_PREFIXES)})"
+_CASH_TOKEN = f"({_words(_CASH_WORDS, _CASH_PREFIXES)})"
+_SUBTRACT_TOKEN = f"({_words(prefixes=_SUBTRACT_PREFIXES)})"
+
+
+def _grammar(keywords: tuple, tokens: tuple) -> re.Pattern:
+    """Сборка грамматики. Позиции, с которых не может начаться ни одна
+    альтернатива (середина слова, буквы не из начала ключевых слов),
+    отсеиваются одной проверкой до перебора альтернатив"""
+    first_letters = "".join(sorted({word[0] for word in keywords}))
+    return re.compile(
+        rf"(?:(?=\d)|{_WORD_START}(?=[{first_letters}]))(?:{'|'.join(tokens)})"
+    )
+
+
+_PAYMENT_KEYWORDS = _CARD_PREFIXES + _CASH_WORDS + _CASH_PREFIXES + _SUBTRACT_PREFIXES
+
+# Полный разбор: сумма, вычитание, тип оплаты и юнит-данные
+_OPERATION_RE = _grammar(
+    _QUANTITY_WORDS + _QUANTITY_PREFIXES + _PRICE_WORDS + _COST_PREFIXES + _PAYMENT_KEYWORDS,
+    (_QUANTITY_TOKEN, _PRICE_TOKEN, _COST_TOKEN, _NUMBER_TOKEN,
+     _CARD_TOKEN, _CASH_TOKEN, _SUBTRACT_TOKEN)
+)
+# Номера групп (match.lastindex - последняя совпавшая группа)
+_QUANTITY, _PRICE, _COST, _AMOUNT, _PER_UNIT, _UNIT, _CARD, _CASH, _SUBTRACT = range(1, 10)
+
+# Та же грамматика без юнит-данных для быстрого ввода, через который проходит
+# каждое сообщение в группе. Сумма - первое число и так, и так
+_AMOUNT_RE = _grammar(_PAYMENT_KEYWORDS, (_NUMBER, _CARD_TOKEN, _CASH_TOKEN, _SUBTRACT_TOKEN))
+
+_HAS_DIGIT_RE = re.compile(r"\d")
+
+# Знаки, которыми начинается операция вычитания
+_MINUS_SIGNS = ('-', '−')
+
+
+class ParsedText(NamedTuple):
+    """Все, что удалось извлечь из текста операции"""
+    amount: Optional[float]        # первое число в тексте
+    subtract: bool                 # "-" в начале, "минус", "вычесть"
+    payment_type: Optional[str]    # 'cash', 'card' или None
+    quantity: Optional[float]
+    unit_price: Optional[float]
+    cost: Optional[float]
+
+
+_NOTHING = ParsedText(None, False, None, None, None, None)
+
+
+def _payment_type(has_cash: bool, has_card: bool) -> Optional[str]:
+    # Наличные важнее: "нал, не карта" - наличные
+    return 'cash' if has_cash else 'card' if has_card else None
+
+
+def parse_text(text: str) -> ParsedText:
+    """Разбор текста операции за один проход"""
+    # Без чисел разбирать нечего - так отсеивается большая часть сообщений в группах
+    if not _HAS_DIGIT_RE.search(text):
+        return _NOTHING
+    text = text.lower()
+    subtract = text.lstrip().startswith(_MINUS_SIGNS)
+    amount = quantity = unit_price = cost = None
+    has_cash = has_card = False
+
+    for match in _OPERATION_RE.finditer(text):
+        group = match.lastindex
+        if group <= _UNIT:
+            # У числа с единицами последняя группа - единицы, само число - в _AMOUNT
+            value = match.group(_AMOUNT if group >= _AMOUNT else group)
+            value = float(value.replace(',', '.'))
+            if amount is None:
+                amount = value
+            if group == _QUANTITY or group == _UNIT:
+                if quantity is None:
+                    quantity = value
+            elif group == _PRICE or group == _PER_UNIT:
+                if unit_price is None:
+                    unit_price = value
+            elif group == _COST:
+                if cost is None:
+                    cost = value
+        elif group == _CARD:
+            has_card = True
+        elif group == _CASH:
+            has_cash = True
+        else:
+            subtract = True
+
+    return ParsedText(amount, subtract, _payment_type(has_cash, has_card),
+                      quantity, unit_price, cost)
+
+
+def parse_amount(text: str) -> Tuple[Optional[float], Optional[str]]:
+    """Парсинг суммы и типа операции из текста"""
+    if not _HAS_DIGIT_RE.search(text):
+        return None, None
+    text = text.lower()
+    subtract = text.lstrip().startswith(_MINUS_SIGNS)
+    amount = None
+    has_cash = has_card = False
+
+    for number, card, cash, minus in _AMOUNT_RE.findall(text):
+        if number:
+            if amount is None:
+                amount = float(number.replace(',', '.'))
+        elif card:
+            has_card = True
+        elif cash:
+            has_cash = True
+        else:
+            subtract = True
+
+    if subtract:
+        amount = -amount
+    return amount, _payment_type(has_cash, has_card)
+
+
+def parse_unit_data(text: str) -> Tuple[Optional[float], Optional[float], Optional[float]]:
+    """Парсинг юнит-данных: количество, цена за единицу, расходы"""
+    parsed = parse_text(text)
+    return parsed.quantity, parsed.unit_price, parsed.cost
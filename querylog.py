@@ -0,0 +1,235 @@
+"""
+Замер SQL-запросов database.py: время каждого выражения, журнал медленных
+запросов с планом выполнения и сводка по видам запросов
+Соединения пула оборачиваются InstrumentedConnection, поэтому замеряется
+все, что выполняется через пул, без правки мест вызова
+"""
+import logging
+import re
+import time
+from typing import Dict, List, Optional
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Порог медленного запроса, секунд (0 - не писать в журнал)
+SLOW_QUERY_THRESHOLD = 0.1
+# Сколько разных текстов SQL помнить разобранными
+SHAPE_CACHE_SIZE = 1024
+# Сколько видов запросов держать в сводке
+MAX_STATS_SHAPES = 1000
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# Строки и числа в тексте запроса заменяются на ?, списки ? - на один
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+_CHAT_ID_RE = re.compile(r"\bchat_id\s*=\s*\?")
+# Выражения, строки которых читаются через fetch*
+_ROW_STATEMENTS = ('SELECT', 'WITH', 'PRAGMA', 'EXPLAIN')
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+class _Shape:
+    """Разобранный текст запроса"""
+    __slots__ = ('sql', 'normalized', 'returns_rows', 'explainable', 'chat_param')
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        normalized = _WHITESPACE_RE.sub(" ", sql).strip()
+        keyword = normalized.split(" ", 1)[0].upper()
+        self.returns_rows = keyword in _ROW_STATEMENTS
+        self.explainable = keyword in _EXPLAINABLE
+        # Номер параметра с chat_id: в журнал попадает только он
+        match = _CHAT_ID_RE.search(normalized)
+        self.chat_param = normalized.count("?", 0, match.start()) if match else None
+        normalized = _LITERAL_RE.sub("?", normalized)
+        self.normalized = _PLACEHOLDER_LIST_RE.sub("?, ...", normalized)
+
+
+class _ShapeStats:
+    __slots__ = ('count', 'total', 'max', 'rows', 'slow', 'explained')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.slow = 0
+        self.explained = False
+
+
+_shapes = LRUCache(SHAPE_CACHE_SIZE)
+_stats: Dict[str, _ShapeStats] = {}
+
+
+def set_slow_threshold(seconds: float):
+    """Порог медленного запроса (0 - журнал медленных запросов выключен)"""
+    global SLOW_QUERY_THRESHOLD
+    SLOW_QUERY_THRESHOLD = seconds
+
+
+def _shape(sql: str) -> _Shape:
+    shape = _shapes.get(sql)
+    if shape is None:
+        shape = _Shape(sql)
+        _shapes.set(sql, shape)
+    return shape
+
+
+def _chat_id(shape: _Shape, params) -> Optional[int]:
+    if shape.chat_param is None or not isinstance(params, (list, tuple)):
+        return None
+    if shape.chat_param < len(params):
+        return params[shape.chat_param]
+    return None
+
+
+async def _record(conn, shape: _Shape, elapsed: float, rows: int, params):
+    # У DDL и PRAGMA rowcount равен -1
+    rows = max(rows, 0)
+    stats = _stats.get(shape.normalized)
+    if stats is None:
+        if len(_stats) >= MAX_STATS_SHAPES:
+            return
+        stats = _stats[shape.normalized] = _ShapeStats()
+    stats.count += 1
+    stats.total += elapsed
+    stats.rows += rows
+    if elapsed > stats.max:
+        stats.max = elapsed
+
+    if not SLOW_QUERY_THRESHOLD or elapsed < SLOW_QUERY_THRESHOLD:
+        return
+    stats.slow += 1
+    logger.warning(
+        f"Медленный запрос: {elapsed * 1000:.1f} мс, строк {rows}, "
+        f"chat_id={_chat_id(shape, params)}: {shape.normalized}"
+    )
+    if stats.explained or not shape.explainable or params is None:
+        return
+    # План снимается один раз на вид запроса, на том же соединении
+    stats.explained = True
+    try:
+        cursor = await conn.execute(f"EXPLAIN QUERY PLAN {shape.sql}", params)
+        plan = [row[3] for row in await cursor.fetchall()]
+        await cursor.close()
+    except Exception as e:
+        logger.warning(f"Не удалось получить план запроса: {e}")
+        return
+    logger.warning("План запроса:\n" + "\n".join(f"  {line}" for line in plan))
+
+
+class InstrumentedCursor:
+    """Курсор, который досчитывает время и строки при чтении результата"""
+
+    def __init__(self, cursor, conn, shape: _Shape, params, elapsed: float):
+        self._cursor = cursor
+        self._conn = conn
+        self._shape = shape
+        self._params = params
+        self._elapsed = elapsed
+        self._rows = 0
+        self._done = False
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    async def _finish(self):
+        if not self._done:
+            self._done = True
+            await _record(self._conn, self._shape, self._elapsed, self._rows, self._params)
+
+    async def fetchone(self):
+        started = time.perf_counter()
+        row = await self._cursor.fetchone()
+        self._elapsed += time.perf_counter() - started
+        self._rows += row is not None
+        await self._finish()
+        return row
+
+    async def fetchall(self):
+        started = time.perf_counter()
+        rows = await self._cursor.fetchall()
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        await self._finish()
+        return rows
+
+    async def fetchmany(self, size: Optional[int] = None):
+        started = time.perf_counter()
+        rows = await (self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany())
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        if not rows or (size is not None and len(rows) < size):
+            await self._finish()
+        return rows
+
+    async def close(self):
+        await self._finish()
+        await self._cursor.close()
+
+
+class InstrumentedConnection:
+    """Соединение aiosqlite, замеряющее каждое выражение.
+    Остальные методы (commit, rollback, close) передаются соединению как есть"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def execute(self, sql: str, parameters=None):
+        shape = _shape(sql)
+        started = time.perf_counter()
+        cursor = await self._conn.execute(sql, parameters)
+        elapsed = time.perf_counter() - started
+        if shape.returns_rows:
+            return InstrumentedCursor(cursor, self._conn, shape, parameters, elapsed)
+        await _record(self._conn, shape, elapsed, cursor.rowcount, parameters)
+        return cursor
+
+    async def executemany(self, sql: str, parameters):
+        shape = _shape(sql)
+        started = time.perf_counter()
+        cursor = await self._conn.executemany(sql, parameters)
+        elapsed = time.perf_counter() - started
+        # Для плана хватает первого набора параметров
+        first = parameters[0] if isinstance(parameters, (list, tuple)) and parameters else None
+        await _record(self._conn, shape, elapsed, cursor.rowcount, first)
+        return cursor
+
+
+def get_report(top: int = 20) -> List[dict]:
+    """Виды запросов с наибольшим суммарным временем"""
+    ordered = sorted(_stats.items(), key=lambda item: item[1].total, reverse=True)
+    return [
+        {
+            'sql': sql,
+            'count': stats.count,
+            'total': stats.total,
+            'avg': stats.total / stats.count,
+            'max': stats.max,
+            'rows': stats.rows,
+            'slow': stats.slow,
+        }
+        for sql, stats in ordered[:top]
+    ]
+
+
+def format_report(top: int = 20) -> str:
+    """Сводка по запросам текстом"""
+    lines = [f"Запросы с наибольшим суммарным временем (видов запросов: {len(_stats)}):"]
+    for item in get_report(top):
+        lines.append(
+            f"{item['total'] * 1000:10.1f} мс всего, {item['count']:7} раз, "
+            f"в среднем {item['avg'] * 1000:.2f} мс, максимум {item['max'] * 1000:.1f} мс, "
+            f"строк {item['rows']}, медленных {item['slow']}\n    {item['sql']}"
+        )
+    return "\n".join(lines)
+
+
+def reset():
+    """Очистка сводки"""
+    _stats.clear()
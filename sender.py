@@ -0,0 +1,182 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Hashable, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих сообщений: чем меньше число, тем раньше отправка
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+_priority: ContextVar[int] = ContextVar("send_priority", default=PRIORITY_NORMAL)
+
+# Методы, которые отправляют или меняют сообщения в чате и попадают под лимиты
+_THROTTLED_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+
+# Сколько простаивающих корзин чатов хранить, прежде чем чистить
+MAX_IDLE_BUCKETS = 10000
+
+
+@contextmanager
+def informational():
+    """Сообщения внутри блока отправляются после подтверждений и ответов"""
+    token = _priority.set(PRIORITY_LOW)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity про запас.
+    Ожидающие получают токены в порядке приоритета, затем в порядке очереди"""
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return not self._waiters and self._tokens >= self.capacity
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL):
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._schedule()
+        await future
+
+    def penalize(self, seconds: float):
+        """Не выдавать токены ближайшие seconds секунд (после RetryAfter)"""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        if self._waiters:
+            self._schedule()
+
+    def _schedule(self):
+        if self._wakeup is not None:
+            return
+        delay = max(0.0, (1 - self._tokens) / self.rate)
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._release)
+
+    def _release(self):
+        self._wakeup = None
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                # Ожидающий отменен, токен не тратим
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+        if self._waiters:
+            self._schedule()
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """Планировщик исходящих сообщений с учетом лимитов Telegram:
+    корзина токенов на каждый чат и общая на бота, повтор после RetryAfter"""
+
+    def __init__(self, group_rate: float, group_burst: float, private_rate: float,
+                 private_burst: float, global_rate: float, max_retries: int = 3):
+        self._group = (group_rate, group_burst)
+        self._private = (private_rate, private_burst)
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[Hashable, TokenBucket] = {}
+        self.max_retries = max_retries
+        # Метрики
+        self.sent = 0
+        self.throttled = 0
+        self.retry_after = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def _chat_bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_IDLE_BUCKETS:
+                self._chats = {key: b for key, b in self._chats.items() if not b.idle}
+            is_private = isinstance(chat_id, int) and chat_id > 0
+            rate, burst = self._private if is_private else self._group
+            bucket = self._chats[chat_id] = TokenBucket(rate, burst)
+        return bucket
+
+    @property
+    def queue_depth(self) -> int:
+        """Количество сообщений, ожидающих своей очереди на отправку"""
+        return self._global.waiting + sum(bucket.waiting for bucket in self._chats.values())
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.queue_depth,
+            'sent': self.sent,
+            'throttled': self.throttled,
+            'retry_after': self.retry_after,
+            'wait_time_total': self.wait_time_total,
+            'wait_time_max': self.wait_time_max,
+        }
+
+    async def _wait_turn(self, bucket: TokenBucket, priority: int):
+        started = time.monotonic()
+        await bucket.acquire(priority)
+        await self._global.acquire(priority)
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            self.throttled += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(_THROTTLED_PREFIXES):
+            return await make_request(bot, method)
+
+        bucket = self._chat_bucket(chat_id)
+        priority = _priority.get()
+        for attempt in range(self.max_retries + 1):
+            await self._wait_turn(bucket, priority)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(
+                    f"Лимит Telegram в чате {chat_id}, повтор {type(method).__name__} "
+                    f"через {e.retry_after} с"
+                )
+                bucket.penalize(e.retry_after)
+                continue
+            self.sent += 1
+            return response
@@ -0,0 +1,319 @@
+"""
+Распределение чатов по процессам-исполнителям (python main.py --workers N)
+Принимающий процесс (polling или вебхук) не разбирает обновления, а по chat_id
+отправляет сырой JSON одному из исполнителей. Исполнитель - обычный бот
+с handlers.router на своем цикле событий. Чат всегда попадает в один и тот же
+процесс, поэтому кэши категорий, отчетов и состояний FSM в памяти остаются
+верными, а обновления одного чата обрабатываются строго по очереди
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+import config
+import database as db
+import metrics
+import querylog
+import zreport
+from storage import SQLiteStorage
+from webhook import serve
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+# Длинный опрос getUpdates, секунд, и пауза после ошибки
+POLL_TIMEOUT = 30
+POLL_RETRY_DELAY = 5
+# Пауза принимающего процесса, пока очередь исполнителя заполнена
+ROUTE_BACKOFF = 0.01
+
+
+def update_chat_id(update: Dict[str, Any]) -> int:
+    """Чат, к которому относится сырое обновление"""
+    message = update.get("message")
+    if message is not None:
+        return message["chat"]["id"]
+    query = update.get("callback_query")
+    if query is not None:
+        if query.get("message"):
+            return query["message"]["chat"]["id"]
+        return query["from"]["id"]
+    return 0
+
+
+def shard_of(chat_id: int, shards: int) -> int:
+    """Номер исполнителя для чата: не зависит от запуска, в отличие от hash()"""
+    return chat_id % shards
+
+
+class ChatSequencer:
+    """Обновления одного чата - строго по очереди, разных чатов - параллельно,
+    не больше max_concurrency одновременно"""
+
+    def __init__(self, handle: Callable[[Dict[str, Any]], Awaitable[Any]], max_concurrency: int):
+        self._handle = handle
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._queues: Dict[int, deque] = {}
+        self._tasks: set = set()
+
+    @property
+    def pending(self) -> int:
+        """Принятые, но еще не обработанные обновления"""
+        return sum(len(chat_queue) for chat_queue in self._queues.values())
+
+    def submit(self, chat_id: int, update: Dict[str, Any]):
+        chat_queue = self._queues.get(chat_id)
+        if chat_queue is not None:
+            chat_queue.append(update)
+            return
+        self._queues[chat_id] = deque((update,))
+        task = asyncio.create_task(self._run_chat(chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_chat(self, chat_id: int):
+        chat_queue = self._queues[chat_id]
+        try:
+            while chat_queue:
+                # Семафор берется на каждое обновление: чат с длинной очередью
+                # не задерживает остальные
+                async with self._semaphore:
+                    try:
+                        await self._handle(chat_queue[0])
+                    except Exception as e:
+                        logger.error(f"Ошибка обработки обновления чата {chat_id}: {e}", exc_info=True)
+                chat_queue.popleft()
+        finally:
+            del self._queues[chat_id]
+
+    async def drain(self, timeout: float):
+        """Ожидание обработки уже принятых обновлений"""
+        tasks = set(self._tasks)
+        if not tasks:
+            return
+        logger.info(f"Ожидание обработки {self.pending} обновлений...")
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logger.warning(f"Не дождались обработки {self.pending} обновлений, прерываем")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def _worker_process(index: int, shards: int, updates: multiprocessing.Queue):
+    """Точка входа процесса-исполнителя"""
+    # Остановка - только по команде принимающего процесса, после обработки принятого
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s - shard-{index} - %(name)s - %(levelname)s - %(message)s',
+        # Журнал уже настроен при импорте main.py в новом процессе
+        force=True
+    )
+    asyncio.run(_run_worker(index, shards, updates))
+
+
+async def _run_worker(index: int, shards: int, updates: multiprocessing.Queue):
+    # Сборка бота - та же, что и без шардирования
+    import main as app
+
+    metrics.instrument_module(db)
+    querylog.set_slow_threshold(config.SLOW_QUERY_MS / 1000)
+    db.set_shard(index, shards)
+    await db.open_pool()
+    await db.init_db()
+    # Общий лимит отправки бота делится между исполнителями; лимиты чатов
+    # соблюдаются как есть, ведь каждый чат живет в одном процессе
+    bot, scheduler = app.create_bot(global_rate=config.SEND_GLOBAL_RATE / shards)
+    storage = SQLiteStorage(ttl=config.FSM_STATE_TTL, cache_size=config.FSM_CACHE_SIZE)
+    storage.start()
+    dp = app.create_dispatcher(storage)
+    # Исполнитель i отдает метрики на METRICS_PORT + i + 1
+    metrics_port = config.METRICS_PORT + index + 1 if config.METRICS_PORT else 0
+    background, metrics_server = await app.start_monitoring(storage, scheduler, metrics_port)
+    # Архив ведет один исполнитель за все чаты: перенос не меняет ни балансы,
+    # ни дневные агрегаты, поэтому кэши отчетов остальных исполнителей верны
+    if index == 0 and config.ARCHIVE_AFTER_DAYS:
+        background.append(asyncio.create_task(app.archive_loop()))
+    # Z-отчеты своих чатов каждый исполнитель отправляет сам
+    background.append(asyncio.create_task(zreport.run(bot, index, shards)))
+
+    sequencer = ChatSequencer(lambda update: dp.feed_raw_update(bot, update),
+                              config.MAX_CONCURRENT_UPDATES)
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+
+    def read_updates():
+        # Очередь multiprocessing блокирующая, поэтому читается в отдельном потоке
+        while True:
+            update = updates.get()
+            if update is None:
+                loop.call_soon_threadsafe(stopped.set)
+                return
+            loop.call_soon_threadsafe(sequencer.submit, update_chat_id(update), update)
+
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    threading.Thread(target=read_updates, name="shard-reader", daemon=True).start()
+    logger.info(f"Исполнитель {index + 1}/{shards} запущен")
+    try:
+        await stopped.wait()
+        await sequencer.drain(config.WEBHOOK_DRAIN_TIMEOUT)
+    finally:
+        # Диспетчер закрывает хранилище FSM и отправляет отложенные живые балансы
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        for task in background:
+            task.cancel()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        await bot.session.close()
+        await db.close_pool()
+        logger.info(f"Исполнитель {index + 1}/{shards} остановлен")
+
+
+class ShardRouter:
+    """Процессы-исполнители и отправка им обновлений по chat_id"""
+
+    def __init__(self, shards: int, queue_size: int = config.SHARD_QUEUE_SIZE):
+        context = multiprocessing.get_context("spawn")
+        self._queues: List[multiprocessing.Queue] = [context.Queue(queue_size) for _ in range(shards)]
+        self._processes = [
+            context.Process(target=_worker_process, args=(index, shards, self._queues[index]),
+                            name=f"shard-{index}")
+            for index in range(shards)
+        ]
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+
+    async def route(self, update: Dict[str, Any]):
+        """Передача обновления исполнителю его чата. Пока очередь исполнителя
+        заполнена, прием новых обновлений ждет"""
+        target = self._queues[shard_of(update_chat_id(update), len(self._queues))]
+        while True:
+            try:
+                target.put_nowait(update)
+                return
+            except queue.Full:
+                await asyncio.sleep(ROUTE_BACKOFF)
+
+    async def stop(self, timeout: float):
+        """Остановка исполнителей после обработки уже переданных обновлений"""
+        for shard_queue in self._queues:
+            shard_queue.put(None)
+        for process in self._processes:
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Исполнитель {process.name} не остановился, завершаем принудительно")
+                process.terminate()
+                await asyncio.to_thread(process.join)
+
+
+async def _api_call(session: aiohttp.ClientSession, method: str,
+                    request_timeout: float = 60, **params):
+    """Вызов Bot API без разбора ответа в модели aiogram"""
+    url = f"{TELEGRAM_API_URL}/bot{config.BOT_TOKEN}/{method}"
+    timeout = aiohttp.ClientTimeout(total=request_timeout)
+    async with session.post(url, json=params, timeout=timeout) as response:
+        payload = await response.json()
+    if not payload.get("ok"):
+        raise RuntimeError(f"{method}: {payload.get('description')}")
+    return payload["result"]
+
+
+async def _poll(session: aiohttp.ClientSession, router: ShardRouter):
+    """Длинный опрос getUpdates; обновления передаются исполнителям как есть"""
+    # Telegram не отдает обновления через getUpdates, пока установлен вебхук
+    await _api_call(session, "deleteWebhook")
+    offset: Optional[int] = None
+    while True:
+        try:
+            updates = await _api_call(
+                session, "getUpdates", request_timeout=POLL_TIMEOUT + 10,
+                offset=offset, timeout=POLL_TIMEOUT, allowed_updates=ALLOWED_UPDATES
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(POLL_RETRY_DELAY)
+            continue
+        for update in updates:
+            await router.route(update)
+            offset = update["update_id"] + 1
+
+
+async def _run_polling(session: aiohttp.ClientSession, router: ShardRouter):
+    """Polling до получения SIGTERM/SIGINT"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остановка только через KeyboardInterrupt
+            pass
+    poller = asyncio.create_task(_poll(session, router))
+    stopper = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait((poller, stopper), return_when=asyncio.FIRST_COMPLETED)
+        if poller.done():
+            # Ошибка запуска опроса (например, неверный токен)
+            poller.result()
+        logger.info("Получен сигнал остановки, завершаем обработку...")
+    finally:
+        # Непереданные обновления Telegram отдаст повторно при следующем запуске
+        poller.cancel()
+        stopper.cancel()
+        await asyncio.gather(poller, stopper, return_exceptions=True)
+
+
+def _build_webhook_app(router: ShardRouter) -> web.Application:
+    """Прием вебхука: проверка секрета и передача JSON исполнителю"""
+
+    async def receive(request: web.Request) -> web.Response:
+        if config.WEBHOOK_SECRET and \
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token") != config.WEBHOOK_SECRET:
+            return web.Response(status=401)
+        await router.route(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(config.WEBHOOK_PATH, receive)
+    return app
+
+
+async def run_sharded(mode: str, workers: int):
+    """Работа бота с обработкой чатов в workers процессах"""
+    logger.info(f"Запуск {workers} исполнителей...")
+    router = ShardRouter(workers)
+    router.start()
+    try:
+        async with aiohttp.ClientSession() as session:
+            if mode == "webhook":
+                if config.WEBHOOK_URL:
+                    url = config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH
+                    params = {"url": url, "allowed_updates": ALLOWED_UPDATES,
+                              "max_connections": min(config.MAX_CONCURRENT_UPDATES, 100)}
+                    if config.WEBHOOK_SECRET:
+                        params["secret_token"] = config.WEBHOOK_SECRET
+                    await _api_call(session, "setWebhook", **params)
+                    logger.info(f"Вебхук зарегистрирован: {url}")
+                else:
+                    logger.info("WEBHOOK_URL не задан, вебхук должен быть зарегистрирован заранее")
+                await serve(_build_webhook_app(router), config.WEBAPP_HOST, config.WEBAPP_PORT)
+            else:
+                logger.info("Запуск polling...")
+                await _run_polling(session, router)
+    finally:
+        await router.stop(config.WEBHOOK_DRAIN_TIMEOUT + 10)
+        logger.info("Исполнители остановлены")
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+import database as db
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 0.5
+SWEEP_INTERVAL = 300
+
+
+@dataclass
+class _Record:
+    chat_id: int
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    updated_at: float = 0.0
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and not self.data
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище состояний FSM в SQLite.
+
+    Недавно использованные записи живут в LRU-кэше, изменения пишутся в БД
+    пачками раз в FLUSH_INTERVAL секунд. Диалоги без изменений дольше ttl
+    секунд считаются брошенными и удаляются фоновой очисткой."""
+
+    def __init__(self, ttl: int, cache_size: int,
+                 flush_interval: float = FLUSH_INTERVAL, sweep_interval: float = SWEEP_INTERVAL):
+        self.ttl = ttl
+        self._flush_interval = flush_interval
+        self._sweep_interval = sweep_interval
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = LRUCache(cache_size)
+        # Измененные записи, ожидающие записи в БД (None - удалить)
+        self._dirty: Dict[str, Optional[_Record]] = {}
+        self._tasks: list = []
+
+    def start(self):
+        """Запуск фоновой записи изменений и очистки устаревших состояний"""
+        self._tasks = [
+            asyncio.create_task(self._flush_loop()),
+            asyncio.create_task(self._sweep_loop()),
+        ]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    def _expired(self, record: _Record, now: float) -> bool:
+        return now - record.updated_at > self.ttl
+
+    async def _get(self, key: StorageKey) -> _Record:
+        name = self._key_builder.build(key)
+        now = time.time()
+        if name in self._dirty:
+            record = self._dirty[name]
+        else:
+            record = self._cache.get(name)
+            if record is None:
+                row = await db.load_fsm_record(name)
+                if row is not None:
+                    state, data, updated_at = row
+                    record = _Record(key.chat_id, state, json.loads(data), updated_at)
+                else:
+                    # Запоминаем и отсутствие состояния, чтобы не ходить в БД повторно
+                    record = _Record(key.chat_id, updated_at=now)
+                self._cache.set(name, record)
+        if record is None or self._expired(record, now):
+            return _Record(key.chat_id)
+        return record
+
+    async def _put(self, key: StorageKey, record: _Record):
+        name = self._key_builder.build(key)
+        record.updated_at = time.time()
+        self._cache.set(name, record)
+        self._dirty[name] = None if record.empty else record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        current = await self._get(key)
+        state = state.state if isinstance(state, State) else state
+        await self._put(key, _Record(key.chat_id, state, current.data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        current = await self._get(key)
+        await self._put(key, _Record(key.chat_id, current.state, data.copy()))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._get(key)).data.copy()
+
+    async def flush(self):
+        """Запись накопленных изменений в БД одной транзакцией"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        upserts = [
+            (name, record.chat_id, record.state, json.dumps(record.data, ensure_ascii=False),
+             record.updated_at)
+            for name, record in dirty.items() if record is not None
+        ]
+        deletes = [name for name, record in dirty.items() if record is None]
+        try:
+            await db.save_fsm_records(upserts, deletes)
+        except Exception:
+            # Не теряем изменения: вернем их в очередь, если их не перезаписали
+            for name, record in dirty.items():
+                self._dirty.setdefault(name, record)
+            raise
+
+    async def count_states(self) -> Dict[str, int]:
+        """Количество незавершенных диалогов по состояниям (для метрик).
+        Еще не записанные изменения берутся из памяти, остальные - из БД,
+        поэтому сбор метрик не вызывает записи"""
+        since = time.time() - self.ttl
+        dirty = dict(self._dirty)
+        counts = await db.count_fsm_states(since, exclude=dirty)
+        for record in dirty.values():
+            if record is not None and record.state is not None and record.updated_at >= since:
+                counts[record.state] = counts.get(record.state, 0) + 1
+        return counts
+
+    async def sweep(self):
+        """Удаление брошенных диалогов из кэша и БД"""
+        before = time.time() - self.ttl
+        for name, record in self._cache.items():
+            if record.updated_at < before and name not in self._dirty:
+                self._cache.pop(name)
+        removed = await db.delete_expired_fsm_records(before)
+        if removed:
+            logger.info(f"Удалено устаревших состояний FSM: {removed}")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи состояний FSM: {e}", exc_info=True)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self._sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Ошибка очистки состояний FSM: {e}", exc_info=True)
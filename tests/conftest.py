@@ -0,0 +1,26 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# config требует токен при импорте; в тестах к Telegram не обращаются
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+
+import database as db  # noqa: E402
+
+
+@pytest.fixture
+def run_db(tmp_path):
+    """Выполнение async-функции с пулом соединений на временной БД"""
+    def run(func):
+        async def main():
+            await db.open_pool(str(tmp_path / "casse.db"))
+            try:
+                await db.init_db()
+                return await func()
+            finally:
+                await db.close_pool()
+        return asyncio.run(main())
+    return run
@@ -0,0 +1,78 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import config
+import handlers
+from cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class FakeBot:
+    def __init__(self, admin_ids):
+        self.admin_ids = admin_ids
+        self.calls = 0
+
+    async def get_chat_administrators(self, chat_id):
+        self.calls += 1
+        return [SimpleNamespace(user=SimpleNamespace(id=user_id)) for user_id in self.admin_ids]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(handlers, "_admin_cache", TTLCache(maxsize=100, clock=clock))
+    monkeypatch.setattr(handlers, "_chat_admins", TTLCache(maxsize=100, clock=clock))
+    return clock
+
+
+def test_private_chat_skips_api(clock):
+    bot = FakeBot([])
+    assert asyncio.run(handlers.check_admin(bot, 42, 42))
+    assert bot.calls == 0
+
+
+def test_admin_cached_until_ttl(clock):
+    bot = FakeBot([1])
+    assert asyncio.run(handlers.check_admin(bot, -100, 1))
+    assert asyncio.run(handlers.check_admin(bot, -100, 1))
+    assert bot.calls == 1
+
+    clock.now += config.ADMIN_CACHE_TTL - 1
+    assert asyncio.run(handlers.check_admin(bot, -100, 1))
+    assert bot.calls == 1
+
+    # После истечения срока список запрашивается заново
+    bot.admin_ids = []
+    clock.now += 2
+    assert not asyncio.run(handlers.check_admin(bot, -100, 1))
+    assert bot.calls == 2
+
+
+def test_non_admin_cached_for_negative_ttl(clock):
+    bot = FakeBot([1])
+    assert not asyncio.run(handlers.check_admin(bot, -100, 2))
+    # Одного запроса хватает и на других участников чата
+    assert not asyncio.run(handlers.check_admin(bot, -100, 3))
+    assert bot.calls == 1
+
+    bot.admin_ids = [1, 2]
+    clock.now += config.ADMIN_CACHE_NEGATIVE_TTL + 1
+    assert asyncio.run(handlers.check_admin(bot, -100, 2))
+    assert bot.calls == 2
+
+
+def test_api_error_allows(clock):
+    class BrokenBot:
+        async def get_chat_administrators(self, chat_id):
+            raise RuntimeError("нет доступа")
+
+    assert asyncio.run(handlers.check_admin(BrokenBot(), -100, 1))
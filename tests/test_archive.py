@@ -0,0 +1,55 @@
+import database as db
+
+
+def _old_rows(chat_id: int, category_id: int, count: int):
+    # Продажи 2020 года: по 10.01 ₽, с количеством и ценой; каждая пятая - расход
+    rows = []
+    for i in range(count):
+        operation_type = 'subtract' if i % 5 == 4 else 'add'
+        rows.append((chat_id, 10.01, 'card' if i % 3 else 'cash', operation_type, None, None, None,
+                     category_id if operation_type == 'add' else None, 2, 5.005, 1.5,
+                     f"2020-03-{i % 28 + 1:02d} 12:00:00"))
+    return rows
+
+
+async def _state(chat_id: int):
+    exported = 0
+    async for chunk in db.iter_transactions(chat_id):
+        exported += len(chunk)
+    return (
+        await db.get_balance(chat_id),
+        await db.get_unit_economics_summary(chat_id, days=10000),
+        await db.get_unit_economics_by_category(chat_id, days=10000),
+        exported,
+    )
+
+
+def test_archive_keeps_totals_across_rebuilds(run_db):
+    async def scenario():
+        category_id = await db.create_category(-1, "Кофе")
+        await db.add_transactions(_old_rows(-1, category_id, 23))
+        await db.add_transaction(-1, 99.99, 'cash', 'add', category_id=category_id,
+                                 quantity=1, unit_price=99.99)
+        before = await _state(-1)
+        progress = []
+        moved = await db.archive_old_transactions(
+            30, chunk_size=5, pause=0, progress=lambda chat_id, count: progress.append((chat_id, count))
+        )
+        archived = await _state(-1)
+        page, has_older, _ = await db.get_transactions_page(-1, limit=100)
+        await db.rebuild_balances(-1)
+        await db.rebuild_rollups(-1)
+        rebuilt = await _state(-1)
+        return before, moved, progress, archived, page, has_older, rebuilt, \
+            await db.has_archived_transactions(-1)
+
+    before, moved, progress, archived, page, has_older, rebuilt, has_archive = run_db(scenario)
+    assert moved == 23
+    assert progress == [(-1, 23)]
+    assert archived == before
+    assert rebuilt == before
+    assert before[3] == 24
+    # История показывает только оставшиеся транзакции
+    assert [row[1] for row in page] == [99.99]
+    assert not has_older
+    assert has_archive
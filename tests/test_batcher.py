@@ -0,0 +1,86 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+import database as db
+
+
+def _row(chat_id: int, amount: float, payment_type='cash'):
+    return (chat_id, amount, payment_type, 'add', None, None, None, None, None, None, None,
+            "2024-01-05 10:00:00")
+
+
+def _batcher(delay: float, max_batch: int) -> db.TransactionBatcher:
+    batcher = db.TransactionBatcher(db._get_pool(), delay=delay, max_batch=max_batch)
+    batcher.start()
+    return batcher
+
+
+def test_flush_on_size(run_db):
+    async def scenario():
+        batcher = _batcher(delay=0.01, max_batch=3)
+        try:
+            await asyncio.gather(*(batcher.submit(_row(-1, 1)) for _ in range(7)))
+        finally:
+            await batcher.close()
+        return batcher.batches, batcher.rows, await db.get_balance(-1)
+
+    assert run_db(scenario) == (3, 7, (7, 0))
+
+
+def test_flush_on_timeout(run_db):
+    async def scenario():
+        batcher = _batcher(delay=0.05, max_batch=100)
+        try:
+            # Одиночная запись не ждет окна
+            started = time.perf_counter()
+            await batcher.submit(_row(-1, 1))
+            single = time.perf_counter() - started
+            # Несколько подряд - одна пачка по истечении окна
+            await asyncio.gather(*(batcher.submit(_row(-1, 1)) for _ in range(5)))
+        finally:
+            await batcher.close()
+        return single, batcher.batches, batcher.last_batch_size
+
+    single, batches, last_batch_size = run_db(scenario)
+    assert single < 0.05
+    assert (batches, last_batch_size) == (2, 5)
+
+
+def test_failed_batch_fails_every_waiter(run_db):
+    async def scenario():
+        batcher = _batcher(delay=0.01, max_batch=100)
+        try:
+            results = await asyncio.gather(
+                batcher.submit(_row(-1, 1)),
+                batcher.submit(_row(-1, 2, payment_type=None)),  # NOT NULL
+                batcher.submit(_row(-1, 3)),
+                return_exceptions=True,
+            )
+            # Очередь продолжает работать после ошибки
+            await batcher.submit(_row(-1, 4))
+        finally:
+            await batcher.close()
+        return results, batcher.batches, await db.get_balance(-1)
+
+    results, batches, balance = run_db(scenario)
+    assert all(isinstance(result, sqlite3.IntegrityError) for result in results)
+    assert batches == 1
+    # Пачка откатилась целиком
+    assert balance == (4, 0)
+
+
+def test_close_flushes_queue(run_db):
+    async def scenario():
+        batcher = _batcher(delay=0.2, max_batch=100)
+        waiters = [asyncio.create_task(batcher.submit(_row(-1, 1))) for _ in range(5)]
+        await asyncio.sleep(0)
+        await batcher.close()
+        await asyncio.gather(*waiters)
+        with pytest.raises(RuntimeError):
+            await batcher.submit(_row(-1, 1))
+        return batcher.rows, await db.get_balance(-1)
+
+    assert run_db(scenario) == (5, (5, 0))
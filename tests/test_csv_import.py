@@ -0,0 +1,47 @@
+import database as db
+from csv_io import import_transactions
+
+
+async def _stored(chat_id: int):
+    async with db._read(chat_id) as conn:
+        cursor = await conn.execute(
+            "SELECT created_at, amount FROM transactions WHERE chat_id = ? ORDER BY id", (chat_id,)
+        )
+        transactions = await cursor.fetchall()
+        cursor = await conn.execute(
+            "SELECT day, SUM(amount_sum) FROM daily_rollups WHERE chat_id = ? GROUP BY day ORDER BY day",
+            (chat_id,)
+        )
+        rollups = await cursor.fetchall()
+    return transactions, rollups
+
+
+def test_import_normalizes_every_date_format(run_db, tmp_path):
+    path = tmp_path / "import.csv"
+    path.write_text(
+        "дата;операция;оплата;сумма\n"
+        "2024-01-05 10:00:00;+;нал;1\n"          # формат хранения (/export)
+        "05.01.2024 10:00:00;+;нал;2\n"          # %d.%m.%Y %H:%M:%S
+        "05.01.2024 11:30;+;безнал;4\n"          # %d.%m.%Y %H:%M
+        "06.01.2024;-;нал;8\n"                   # %d.%m.%Y
+        "2024-01-07T01:30:00+03:00;+;карта;16\n"  # со смещением: 2024-01-06 22:30 UTC
+        "2024-01-07T10:00:00;+;нал;32\n",         # ISO без пояса
+        encoding="utf-8",
+    )
+
+    async def scenario():
+        result = await import_transactions(str(path), -1)
+        return result, await _stored(-1), await db.get_balance(-1)
+
+    result, (transactions, rollups), balance = run_db(scenario)
+    assert result.imported == 6
+    assert [created_at for created_at, _ in transactions] == [
+        "2024-01-05 10:00:00",
+        "2024-01-05 10:00:00",
+        "2024-01-05 11:30:00",
+        "2024-01-06 00:00:00",
+        "2024-01-06 22:30:00",
+        "2024-01-07 10:00:00",
+    ]
+    assert rollups == [("2024-01-05", 700), ("2024-01-06", 2400), ("2024-01-07", 3200)]
+    assert balance == (1 + 2 - 8 + 32, 4 + 16)
@@ -0,0 +1,18 @@
+import database as db
+
+
+def test_export_pages_release_reader(run_db):
+    # Пачка записи получает одно время created_at: продолжение идет по (created_at, id)
+    async def scenario():
+        for amount in range(1, 8):
+            await db.add_transaction(-1, amount, 'cash', 'add')
+        idle = []
+        amounts = []
+        async for chunk in db.iter_transactions(-1, chunk_size=3):
+            idle.append(db._get_pool()._idle.qsize())
+            amounts.extend(row[3] for row in chunk)
+        return idle, amounts
+
+    idle, amounts = run_db(scenario)
+    assert amounts == [1, 2, 3, 4, 5, 6, 7]
+    assert idle == [db.READER_POOL_SIZE] * 3
@@ -0,0 +1,25 @@
+from aiogram.fsm.storage.base import StorageKey
+
+import database as db
+from storage import SQLiteStorage
+
+
+def test_count_states_does_not_flush(run_db):
+    async def scenario():
+        storage = SQLiteStorage(ttl=3600, cache_size=100)
+        first = StorageKey(bot_id=1, chat_id=-10, user_id=1)
+        second = StorageKey(bot_id=1, chat_id=-10, user_id=2)
+        await storage.set_state(first, "Form:amount")
+        await storage.set_state(second, "Form:amount")
+        await storage.flush()
+
+        await storage.set_state(first, None)
+        await storage.set_state(second, "Form:category")
+        counts = await storage.count_states()
+        # Изменения остались в памяти, в БД - прежние состояния
+        stored = await db.load_fsm_record(storage._key_builder.build(second))
+        return counts, stored
+
+    counts, stored = run_db(scenario)
+    assert counts == {"Form:category": 1}
+    assert stored[0] == "Form:amount"
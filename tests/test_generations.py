@@ -0,0 +1,130 @@
+import asyncio
+
+import database as db
+
+
+def _rows(chat_id: int, count: int, amount: float = 1):
+    return [(chat_id, amount, 'cash', 'add', None, None, None, None, None, None, None,
+             f"2024-01-05 10:{i // 60 % 60:02d}:{i % 60:02d}") for i in range(count)]
+
+
+async def _stored_rows(chat_id: int) -> int:
+    async with db._read(chat_id) as conn:
+        cursor = await conn.execute("SELECT COUNT(*) FROM transactions WHERE chat_id = ?", (chat_id,))
+        return (await cursor.fetchone())[0]
+
+
+async def _purge_pending(chat_id: int) -> int:
+    async with db._read(chat_id) as conn:
+        cursor = await conn.execute(
+            "SELECT purge_pending FROM chat_generations WHERE chat_id = ?", (chat_id,)
+        )
+        return (await cursor.fetchone())[0]
+
+
+async def _exported(chat_id: int) -> list:
+    rows = []
+    async for chunk in db.iter_transactions(chat_id):
+        rows.extend(chunk)
+    return rows
+
+
+def test_reset_with_queued_writes(run_db):
+    async def scenario():
+        await db.add_transaction(-1, 1000, 'cash', 'add')
+        before = [db.add_transaction(-1, 1, 'cash', 'add') for _ in range(10)]
+        after = [db.add_transaction(-1, 2, 'card', 'add') for _ in range(10)]
+        # Сброс попадает между пачками очереди записи
+        await asyncio.gather(*before, db.reset_balance(-1), *after)
+        balance = await db.get_balance(-1)
+        page, _, _ = await db.get_transactions_page(-1, limit=100)
+        exported = await _exported(-1)
+        await db.rebuild_balances(-1)
+        return balance, page, exported, await db.get_balance(-1)
+
+    balance, page, exported, rebuilt = run_db(scenario)
+    # Строка до сброса скрыта; баланс сходится с видимыми транзакциями
+    assert 1000 not in [row[1] for row in page]
+    assert sum(balance) == sum(row[1] for row in page) == sum(row[3] for row in exported)
+    assert balance == rebuilt
+    assert len(page) == len(exported)
+
+
+def test_reads_right_after_reset(run_db):
+    async def scenario():
+        category_id = await db.create_category(-1, "Кофе")
+        await db.add_transaction(-1, 100, 'cash', 'add', category_id=category_id, quantity=1,
+                                 unit_price=100)
+        await db.add_transaction(-1, 40, 'card', 'subtract', cost=40)
+        await db.reset_balance(-1)
+        cleared = (
+            await db.get_balance(-1),
+            await db.get_transactions_page(-1),
+            await _exported(-1),
+            await db.get_unit_economics_summary(-1),
+        )
+        await db.add_transaction(-1, 7, 'cash', 'add', category_id=category_id)
+        after = (await db.get_balance(-1), await db.get_transactions_page(-1), await _exported(-1))
+        return cleared, after
+
+    (balance, page, exported, summary), (new_balance, new_page, new_exported) = run_db(scenario)
+    assert balance == (0, 0)
+    assert page == ([], False, False)
+    assert exported == []
+    assert (summary['transactions'], summary['revenue'], summary['cost']) == (0, 0, 0)
+    assert new_balance == (7, 0)
+    assert [row[1] for row in new_page[0]] == [7]
+    assert len(new_exported) == 1
+
+
+def test_purge_completes(run_db):
+    async def scenario():
+        await db.add_transactions(_rows(-1, 450) + _rows(-2, 5))
+        await db.reset_balance(-1)
+        await db.add_transaction(-1, 3, 'cash', 'add')
+        await db._purge_task
+        return await _stored_rows(-1), await _purge_pending(-1), await _stored_rows(-2)
+
+    assert run_db(scenario) == (1, 0, 5)
+
+
+def test_restart_mid_purge_resumes_in_own_shard(tmp_path):
+    path = str(tmp_path / "casse.db")
+    chat_id = -3  # -3 % 2 == 1
+
+    async def start(shard: int):
+        db.set_shard(shard, 2)
+        await db.open_pool(path)
+        await db.init_db()
+
+    async def scenario():
+        await start(1)
+        try:
+            await db.add_transactions(_rows(chat_id, 500))
+            await db.reset_balance(chat_id)
+        finally:
+            # Остановка до первой пачки очистки
+            await db.close_pool()
+
+        await start(0)
+        try:
+            # Чужой шард не трогает чат
+            assert db._purge_task is None
+            left = await _stored_rows(chat_id), await _purge_pending(chat_id)
+        finally:
+            await db.close_pool()
+
+        await start(1)
+        try:
+            await db._purge_task
+            purged = await _stored_rows(chat_id), await _purge_pending(chat_id)
+        finally:
+            await db.close_pool()
+        return left, purged
+
+    try:
+        left, purged = asyncio.run(scenario())
+    finally:
+        db.set_shard(0, 1)
+    assert left == (500, 1)
+    assert purged == (0, 0)
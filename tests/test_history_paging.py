@@ -0,0 +1,75 @@
+import database as db
+
+
+def _rows(chat_id: int, stamps):
+    return [(chat_id, i + 1, 'cash', 'add', None, None, None, None, None, None, None, created_at)
+            for i, created_at in enumerate(stamps)]
+
+
+# 25 транзакций: 20 записаны в одну секунду (пачка импорта), по краям - другие секунды
+STAMPS = ["2024-01-05 09:00:00"] * 3 + ["2024-01-05 10:00:00"] * 20 + ["2024-01-05 11:00:00"] * 2
+
+
+async def _walk_older(chat_id: int, limit: int):
+    pages = []
+    cursor = None
+    while True:
+        rows, has_older, has_newer = await db.get_transactions_page(chat_id, cursor, True, limit)
+        pages.append((rows, has_older, has_newer))
+        if not has_older:
+            return pages
+        cursor = (rows[-1][5], rows[-1][0])
+
+
+def test_pages_are_stable_with_equal_timestamps(run_db):
+    async def scenario():
+        await db.add_transactions(_rows(-1, STAMPS))
+        older = await _walk_older(-1, 10)
+        # Обратно от последней страницы к первой
+        newer = []
+        rows = older[-1][0]
+        while True:
+            rows, has_older, has_newer = await db.get_transactions_page(
+                -1, (rows[0][5], rows[0][0]), False, 10
+            )
+            newer.append((rows, has_older, has_newer))
+            if not has_newer:
+                return older, newer
+
+    older, newer = run_db(scenario)
+    ids = [row[0] for rows, _, _ in older for row in rows]
+    assert len(ids) == len(set(ids)) == 25
+    keys = [(row[5], row[0]) for rows, _, _ in older for row in rows]
+    assert keys == sorted(keys, reverse=True)
+    # Первая страница: новее ничего нет; последняя: старее ничего нет
+    assert [(len(rows), has_older, has_newer) for rows, has_older, has_newer in older] == [
+        (10, True, False), (10, True, True), (5, False, True)
+    ]
+    # Назад - те же страницы, что и вперед
+    assert [rows for rows, _, _ in newer] == [rows for rows, _, _ in older[-2::-1]]
+    assert newer[-1][2] is False
+
+
+def test_empty_history(run_db):
+    async def scenario():
+        return await db.get_transactions_page(-1)
+
+    assert run_db(scenario) == ([], False, False)
+
+
+def test_stale_cursor_after_reset(run_db):
+    async def scenario():
+        await db.add_transactions(_rows(-1, STAMPS))
+        first, _, _ = await db.get_transactions_page(-1, limit=10)
+        stale = (first[-1][5], first[-1][0])
+        await db.reset_balance(-1)
+        await db.add_transaction(-1, 7, 'card', 'add')
+        return (
+            await db.get_transactions_page(-1, stale, True, 10),
+            await db.get_transactions_page(-1, stale, False, 10),
+        )
+
+    (older_rows, has_older, _), (newer_rows, _, has_newer) = run_db(scenario)
+    # Кнопка старого сообщения не показывает транзакции до сброса
+    assert older_rows == [] and not has_older
+    assert [row[1] for row in newer_rows] == [7] and not has_newer
@@ -0,0 +1,69 @@
+import asyncio
+import random
+
+import database as db
+
+
+async def _mixed_writes(chat_ids):
+    """Операции всех видов: по одной через очередь записи и пачками, как импорт"""
+    rng = random.Random(7)
+    categories = {chat_id: [await db.create_category(chat_id, f"Источник {i}") for i in range(3)]
+                  for chat_id in chat_ids}
+    batch = []
+    single = []
+    for i in range(120):
+        chat_id = rng.choice(chat_ids)
+        operation_type = rng.choice(('add', 'subtract'))
+        payment_type = rng.choice(('cash', 'card'))
+        amount = round(rng.uniform(0.01, 500), 2)
+        category_id = rng.choice(categories[chat_id] + [None])
+        quantity = rng.choice((None, 0, 1, 2.5))
+        unit_price = round(amount / quantity, 2) if quantity else None
+        cost = round(amount * 0.3, 2) if operation_type == 'subtract' else None
+        if i % 3:
+            single.append(db.add_transaction(chat_id, amount, payment_type, operation_type,
+                                             category_id=category_id, quantity=quantity,
+                                             unit_price=unit_price, cost=cost))
+        else:
+            batch.append((chat_id, amount, payment_type, operation_type, None, None, None,
+                          category_id, quantity, unit_price, cost,
+                          f"2024-01-{i % 28 + 1:02d} 1{i % 10}:00:00"))
+    await asyncio.gather(*single)
+    await db.add_transactions(batch)
+
+
+async def _table(sql: str) -> list:
+    async with db._read() as conn:
+        cursor = await conn.execute(sql)
+        return await cursor.fetchall()
+
+
+def test_balances_match_rebuild(run_db):
+    async def scenario():
+        await _mixed_writes([-1, -2, -3])
+        await db.reset_balance(-3)
+        await db.add_transaction(-3, 12.34, 'card', 'subtract')
+        incremental = await _table("SELECT * FROM balances ORDER BY chat_id")
+        await db.rebuild_balances()
+        return incremental, await _table("SELECT * FROM balances ORDER BY chat_id")
+
+    incremental, rebuilt = run_db(scenario)
+    assert len(incremental) == 3
+    assert incremental == rebuilt
+
+
+def test_rollups_match_rebuild(run_db):
+    sql = """
+        SELECT * FROM daily_rollups
+        ORDER BY chat_id, day, category_id, payment_type, operation_type
+    """
+
+    async def scenario():
+        await _mixed_writes([-1, -2])
+        incremental = await _table(sql)
+        await db.rebuild_rollups()
+        return incremental, await _table(sql)
+
+    incremental, rebuilt = run_db(scenario)
+    assert incremental
+    assert incremental == rebuilt
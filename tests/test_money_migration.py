@@ -0,0 +1,168 @@
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import database as db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Суммы, которые в двоичной записи не точны: 0.29 * 100 = 28.999999999999996
+AMOUNTS = [0.29, 10.1, 1.005, 99.99, 0.07, 1234.56, 0.01, 5.5] * 4
+
+
+def _legacy_db(path: str):
+    """БД первых версий бота: суммы в рублях (REAL), без юнит-экономики"""
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            payment_type TEXT NOT NULL,
+            operation_type TEXT NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            user_id INTEGER,
+            username TEXT
+        )
+    """)
+    conn.executemany(
+        "INSERT INTO transactions (chat_id, amount, payment_type, operation_type) VALUES (-1, ?, ?, 'add')",
+        [(amount, 'cash' if i % 2 else 'card') for i, amount in enumerate(AMOUNTS)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def _expected_kopecks(amounts) -> int:
+    return sum(round(amount * 100) for amount in amounts)
+
+
+async def _stored_amounts(chat_id: int) -> list:
+    async with db._read(chat_id) as conn:
+        cursor = await conn.execute(
+            "SELECT amount FROM transactions WHERE chat_id = ? ORDER BY id", (chat_id,)
+        )
+        return [row[0] for row in await cursor.fetchall()]
+
+
+async def _has_table(name: str) -> bool:
+    async with db._read() as conn:
+        return await db._table_exists(conn, name)
+
+
+def test_migration_with_concurrent_writes(tmp_path):
+    path = str(tmp_path / "casse.db")
+    _legacy_db(path)
+    written = []
+
+    async def writer(done: asyncio.Event):
+        # Операции бота идут, пока копируются пачки
+        while not done.is_set():
+            if len(written) == 3:
+                # Изменение уже скопированной строки переносится триггером
+                async with db._write() as conn:
+                    await conn.execute("UPDATE transactions SET amount = 0.5 WHERE id = 1")
+            amount = 0.13 + len(written)
+            await db.add_transaction(-1, amount, 'cash', 'add')
+            written.append(amount)
+            await asyncio.sleep(0)
+
+    async def scenario():
+        await db.open_pool(path)
+        try:
+            await db.init_db()
+            assert db.money_migration_pending()
+            assert db._money_scale == 1
+            done = asyncio.Event()
+            task = asyncio.create_task(writer(done))
+            try:
+                await db.migrate_money_to_kopecks(chunk_size=5, pause=0)
+            finally:
+                done.set()
+                await task
+            await db.add_transaction(-1, 0.29, 'card', 'add')
+            balance = await db.get_balance(-1)
+            amounts = await _stored_amounts(-1)
+            legacy_left = await _has_table('transactions_legacy')
+            await db.rebuild_balances(-1)
+            return balance, amounts, legacy_left, await db.get_balance(-1)
+        finally:
+            await db.close_pool()
+
+    balance, amounts, legacy_left, rebuilt = asyncio.run(scenario())
+    all_amounts = [0.5] + AMOUNTS[1:] + written + [0.29]
+    assert written
+    assert db._money_scale == db.KOPECKS_PER_RUBLE
+    assert not db.money_migration_pending()
+    assert not legacy_left
+    assert amounts == [round(amount * 100) for amount in all_amounts]
+    assert all(isinstance(amount, int) for amount in amounts)
+    assert round((sum(balance)) * 100) == _expected_kopecks(all_amounts)
+    assert balance == rebuilt
+
+
+def test_interrupted_migration_resumes(tmp_path):
+    path = str(tmp_path / "casse.db")
+    _legacy_db(path)
+
+    class Stop(Exception):
+        pass
+
+    def stop_after_first_chunk(position):
+        raise Stop
+
+    async def scenario():
+        await db.open_pool(path)
+        try:
+            await db.init_db()
+            with pytest.raises(Stop):
+                await db.migrate_money_to_kopecks(chunk_size=10, pause=0, progress=stop_after_first_chunk)
+            # Запись после остановки - еще в рублях, ее перенесет триггер
+            await db.add_transaction(-1, 0.29, 'cash', 'add')
+        finally:
+            await db.close_pool()
+
+        await db.open_pool(path)
+        try:
+            await db.init_db()
+            resumed = db.money_migration_pending(), db._money_scale
+            positions = []
+            await db.migrate_money_to_kopecks(chunk_size=10, pause=0, progress=positions.append)
+            return resumed, positions, await _stored_amounts(-1), await db.get_balance(-1)
+        finally:
+            await db.close_pool()
+
+    resumed, positions, amounts, balance = asyncio.run(scenario())
+    assert resumed == (True, 1)
+    # Продолжение с сохраненной позиции: первая пачка не копируется заново
+    assert positions[0] > 10
+    assert amounts == [round(amount * 100) for amount in AMOUNTS + [0.29]]
+    assert round(sum(balance) * 100) == _expected_kopecks(AMOUNTS + [0.29])
+
+
+def test_migrate_money_refuses_while_bot_runs(tmp_path):
+    _legacy_db(str(tmp_path / "casse.db"))
+
+    def migrate():
+        return subprocess.run(
+            [sys.executable, os.path.join(ROOT, "maintenance.py"), "migrate-money"],
+            cwd=tmp_path, capture_output=True, text=True, env={**os.environ, "PYTHONPATH": ROOT},
+        )
+
+    # Отметка запущенного бота
+    assert db.claim_database(str(tmp_path / "casse.db"))
+    try:
+        refused = migrate()
+    finally:
+        db.release_database()
+    assert refused.returncode == 1
+    assert "Бот запущен" in refused.stdout
+
+    migrated = migrate()
+    assert migrated.returncode == 0, migrated.stdout + migrated.stderr
+    assert "Суммы переведены в копейки" in migrated.stdout
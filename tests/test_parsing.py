@@ -0,0 +1,217 @@
+"""
+Разбор текста операций (parsing.py) на корпусе реальных форматов сообщений:
+результаты должны совпадать с ожидаемыми, а с прежней реализацией - везде,
+кроме отмеченных улучшений распознавания. Корпус и прежняя реализация
+используются и в замерах bench_parser.py
+"""
+import re
+import time
+from typing import Optional, Tuple
+
+import pytest
+
+from parsing import parse_amount, parse_text, parse_unit_data
+
+# Текст, сумма, тип оплаты, количество, цена за единицу, расходы и отличается ли
+# результат от прежней реализации (намеренно: прежняя ошибалась)
+OPERATIONS = [
+    ('+1000 нал', 1000.0, 'cash', None, None, None, False),
+    ('-500 карт', -500.0, 'card', None, None, None, False),
+    ('2000 нал', 2000.0, 'cash', None, None, None, False),
+    ('минус 300 карт', -300.0, 'card', None, None, None, False),
+    ('1500 наличными', 1500.0, 'cash', None, None, None, False),
+    ('+2500 картой', 2500.0, 'card', None, None, None, False),
+    ('-700 безнал', -700.0, 'card', None, None, None, True),
+    ('300 безналичными', 300.0, 'card', None, None, None, True),
+    ('вычесть 200 нал', -200.0, 'cash', None, None, None, False),
+    ('1000нал', 1000.0, 'cash', None, None, None, False),
+    ('-1000карт', -1000.0, 'card', None, None, None, False),
+    ('+350,50 нал', 350.5, 'cash', None, None, None, False),
+    ('99.99 карта', 99.99, 'card', None, None, None, False),
+    ('500 cash', 500.0, 'cash', None, None, None, False),
+    ('-120 card', -120.0, 'card', None, None, None, False),
+    ('+1000 cashless', 1000.0, 'card', None, None, None, True),
+    ('5000', 5000.0, None, None, None, None, False),
+    ('привет', None, None, None, None, None, False),
+    ('купил 2 кофе по 150 нал', 2.0, 'cash', None, None, None, False),
+    ('оплата 4500 по карте', 4500.0, 'card', None, None, None, False),
+    ('+12000 нал выручка за смену', 12000.0, 'cash', None, None, None, False),
+    ('-800 нал такси', -800.0, 'cash', None, None, None, False),
+    ('1 500 нал', 1.0, 'cash', None, None, None, False),
+    ('−300 нал', -300.0, 'cash', None, None, None, True),
+    ('Минус 450 КАРТ', -450.0, 'card', None, None, None, False),
+    ('1000 налом', 1000.0, 'cash', None, None, None, False),
+    ('500 наликом', 500.0, 'cash', None, None, None, False),
+    ('+700 на карту', 700.0, 'card', None, None, None, False),
+    ('200 кол 2 цена 100', 200.0, None, 2.0, 100.0, None, False),
+    ('500 кол 5 цена 100', 500.0, None, 5.0, 100.0, None, False),
+    ('кол 5 цена 100', 5.0, None, 5.0, 100.0, None, False),
+    ('кол-во 3 цена 250', 3.0, None, 3.0, 250.0, None, True),
+    ('количество: 4 цена: 50', 4.0, None, 4.0, 50.0, None, False),
+    ('qty: 10 price: 12.5', 10.0, None, 10.0, 12.5, None, False),
+    ('5 шт по 100', 5.0, None, 5.0, None, None, False),
+    ('3 ед', 3.0, None, 3.0, None, None, False),
+    ('10 units', 10.0, None, 10.0, None, None, False),
+    ('100/ед', 100.0, None, None, 100.0, None, False),
+    ('150 за единицу', 150.0, None, None, 150.0, None, False),
+    ('цена 200 расход 50', 200.0, None, None, 200.0, 50.0, False),
+    ('расходы: 30', 30.0, None, None, None, 30.0, False),
+    ('себест 40', 40.0, None, None, None, 40.0, False),
+    ('cost 25', 25.0, None, None, None, 25.0, False),
+    ('expense: 15', 15.0, None, None, None, 15.0, False),
+    ('1000 кол 10 цена 100 расход 200', 1000.0, None, 10.0, 100.0, 200.0, False),
+    ('расход=75 кол 2', 75.0, None, 2.0, None, 75.0, False),
+    ('250 кол-5 цена/50', 250.0, None, 5.0, 50.0, None, False),
+    ('600 кол 3 цена за единицу 200', 600.0, None, 3.0, 200.0, None, True),
+    ('школ 5', 5.0, None, None, None, None, True),
+    ('колбаса 500 нал', 500.0, 'cash', None, None, None, False),
+    ('налог 1500 карт', 1500.0, 'card', None, None, None, True),
+    ('финал 300', 300.0, None, None, None, None, True),
+    ('канал 100', 100.0, None, None, None, None, True),
+    ('2,5 кол 4', 2.5, None, 4.0, None, None, False),
+    ('700 цена 100 за шт', 700.0, None, None, 100.0, None, False),
+    ('+100500 карт', 100500.0, 'card', None, None, None, False),
+    ('-0.5 нал', -0.5, 'cash', None, None, None, False),
+]
+
+# Обычная переписка в группе: через разбор суммы проходит каждое сообщение
+CHATTER = [
+    ('привет всем', None, None, None, None, None, False),
+    ('ок', None, None, None, None, None, False),
+    ('спасибо!', None, None, None, None, None, False),
+    ('кто сегодня на кассе?', None, None, None, None, None, False),
+    ('закрываемся пораньше', None, None, None, None, None, False),
+    ('не забудьте сдать отчет', None, None, None, None, None, False),
+    ('Принято 👍', None, None, None, None, None, False),
+    ('завтра смена с 9', 9.0, None, None, None, None, False),
+    ('буду через 15 минут', 15.0, None, None, None, None, False),
+    ('касса сходится', None, None, None, None, None, False),
+    ('перевел на карту, проверь', None, None, None, None, None, False),
+    ('наличку сдал в банк', None, None, None, None, None, False),
+    ('а где чек?', None, None, None, None, None, False),
+    ('в 18:30 инкассация', 18.0, None, None, None, None, False),
+    ('ну что, работаем', None, None, None, None, None, False),
+]
+
+CORPUS = OPERATIONS + CHATTER
+
+# Прежняя реализация (до однопроходного разбора), для сравнения
+
+
+def legacy_parse_amount(text: str) -> Tuple[Optional[float], Optional[str]]:
+    """Парсинг суммы и типа операции из текста"""
+    text = text.strip()
+    
+    # Проверка на операцию вычитания
+    is_subtract = text.startswith('-') or 'минус' in text.lower() or 'вычесть' in text.lower()
+    
+    # Извлечение числа
+    numbers = re.findall(r'\d+[.,]?\d*', text)
+    if not numbers:
+        return None, None
+    
+    amount = float(numbers[0].replace(',', '.'))
+    if is_subtract:
+        amount = -amount
+    
+    # Определение типа оплаты
+    payment_type = None
+    if any(word in text.lower() for word in ['нал', 'налич', 'cash']):
+        payment_type = 'cash'
+    elif any(word in text.lower() for word in ['безнал', 'карт', 'card']):
+        payment_type = 'card'
+    
+    return amount, payment_type
+
+
+def legacy_parse_unit_data(text: str) -> Tuple[Optional[float], Optional[float], Optional[float]]:
+    """Парсинг юнит-данных: количество, цена за единицу, расходы"""
+    quantity = None
+    unit_price = None
+    cost = None
+    
+    text_lower = text.lower()
+    
+    # Парсинг количества (кол-во, кол, qty, количество)
+    quantity_patterns = [
+        r'кол[-\s]?([0-9]+[.,]?[0-9]*)',
+        r'количество[:\s]+([0-9]+[.,]?[0-9]*)',
+        r'qty[:\s]+([0-9]+[.,]?[0-9]*)',
+        r'(\d+[.,]?\d*)\s*(шт|ед|units)'
+    ]
+    for pattern in quantity_patterns:
+        match = re.search(pattern, text_lower)
+        if match:
+            quantity = float(match.group(1).replace(',', '.'))
+            break
+    
+    # Парсинг цены за единицу (цена/ед, цена за, price/unit)
+    price_patterns = [
+        r'цена[:\s/]+([0-9]+[.,]?[0-9]*)',
+        r'price[:\s/]+([0-9]+[.,]?[0-9]*)',
+        r'([0-9]+[.,]?[0-9]*)\s*(за\s*единицу|/ед|/unit)'
+    ]
+    for pattern in price_patterns:
+        match = re.search(pattern, text_lower)
+        if match:
+            unit_price = float(match.group(1).replace(',', '.'))
+            break
+    
+    # Парсинг расходов (расход, расходы, expense)
+    cost_patterns = [
+        r'расход[=:\s]+([0-9]+[.,]?[0-9]*)',
+        r'расходы[=:\s]+([0-9]+[.,]?[0-9]*)',
+        r'expense[=:\s]+([0-9]+[.,]?[0-9]*)',
+        r'себест[=:\s]+([0-9]+[.,]?[0-9]*)',  # оставляем для совместимости
+        r'cost[=:\s]+([0-9]+[.,]?[0-9]*)'
+    ]
+    for pattern in cost_patterns:
+        match = re.search(pattern, text_lower)
+        if match:
+            cost = float(match.group(1).replace(',', '.'))
+            break
+    
+    return quantity, unit_price, cost
+
+
+@pytest.mark.parametrize("text, amount, payment_type, quantity, unit_price, cost, legacy_differs", CORPUS)
+def test_corpus(text, amount, payment_type, quantity, unit_price, cost, legacy_differs):
+    expected = ((amount, payment_type), (quantity, unit_price, cost))
+    actual = (parse_amount(text), parse_unit_data(text))
+    assert actual == expected
+    legacy = (legacy_parse_amount(text), legacy_parse_unit_data(text))
+    if legacy_differs:
+        assert legacy != actual
+    else:
+        assert legacy == actual
+
+
+@pytest.mark.parametrize("text", [row[0] for row in OPERATIONS])
+def test_parse_text_matches_separate_parsers(text):
+    parsed = parse_text(text)
+    assert (parsed.quantity, parsed.unit_price, parsed.cost) == parse_unit_data(text)
+
+
+# Сообщения на пределе длины Telegram (4096 символов), на которых неудачная
+# грамматика уходит в экспоненциальный или квадратичный перебор
+WORST_CASE = [
+    "цена " + "за единицу шт " * 290 + "!5",
+    "5 " + " " * 2000 + "за" + " " * 2000 + "x",
+    "кол" + " " * 4000 + "x 1",
+    "цена " + "ед " * 1300 + "x5",
+    "5 шт за " * 500,
+    "1" * 4096,
+]
+WORST_CASE_LIMIT = 0.05
+
+
+@pytest.mark.parametrize("text", WORST_CASE, ids=range(len(WORST_CASE)))
+def test_worst_case_is_fast(text):
+    # Лучшая из нескольких попыток: единичный замер сбивают паузы планировщика
+    elapsed = []
+    for _ in range(3):
+        started = time.perf_counter()
+        parse_amount(text)
+        parse_text(text)
+        elapsed.append(time.perf_counter() - started)
+    assert min(elapsed) < WORST_CASE_LIMIT
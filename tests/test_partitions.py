@@ -0,0 +1,45 @@
+import asyncio
+
+import database as db
+
+
+async def _last_transaction_id(chat_id: int) -> int:
+    async with db._read(chat_id) as conn:
+        cursor = await conn.execute("SELECT MAX(id) FROM transactions WHERE chat_id = ?", (chat_id,))
+        return (await cursor.fetchone())[0]
+
+
+def test_reset_all_keeps_ids_in_chat_partition(tmp_path):
+    path = str(tmp_path / "casse.db")
+
+    async def scenario():
+        await db.open_pool(path)
+        try:
+            await db.init_db()
+            for name in ("Кофе", "Чай", "Выпечка"):
+                await db.create_category(-1, name)
+            await db.add_transaction(-1, 100, 'cash', 'add')
+            await db.add_transaction(-1, 200, 'cash', 'add')
+            await db.split_into_partitions(per_chat=True)
+        finally:
+            await db.close_pool()
+
+        await db.open_pool(path)
+        try:
+            await db.init_db()
+            old_category = await db.create_category(-1, "Сок")
+            await db.add_transaction(-1, 300, 'cash', 'add')
+            old_transaction = await _last_transaction_id(-1)
+            await db.reset_all_data(-1)
+            new_category = await db.create_category(-1, "Кофе")
+            await db.add_transaction(-1, 50, 'card', 'add')
+            new_transaction = await _last_transaction_id(-1)
+            balance = await db.get_balance(-1)
+        finally:
+            await db.close_pool()
+        return old_category, new_category, old_transaction, new_transaction, balance
+
+    old_category, new_category, old_transaction, new_transaction, balance = asyncio.run(scenario())
+    assert new_category > old_category
+    assert new_transaction > old_transaction
+    assert balance == (0, 50)
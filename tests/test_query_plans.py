@@ -0,0 +1,18 @@
+import asyncio
+
+import database as db
+import maintenance
+
+
+def test_hot_queries_use_indexes(run_db):
+    plans = run_db(db.explain_hot_queries)
+    assert plans
+    scans = [f"{name}: {line}" for name, lines in plans.items()
+             for line in lines if line.startswith("SCAN ")]
+    assert scans == []
+
+
+def test_check_plans_does_not_create_database(tmp_path):
+    path = tmp_path / "casse.db"
+    assert asyncio.run(maintenance.check_plans(str(path))) is False
+    assert not path.exists()
@@ -0,0 +1,45 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import database as db
+import handlers
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_cached_report_invalidated_by_write_and_rebuild(run_db, tmp_path):
+    builds = []
+
+    async def build():
+        builds.append(await db.get_balance(-1))
+        return builds[-1]
+
+    def rebuild_in_other_process():
+        # Как maintenance.py при запущенном боте: отдельный процесс, тот же файл
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, "maintenance.py"), "rebuild-balances", "-1"],
+            cwd=tmp_path, check=True, capture_output=True,
+            env={**os.environ, "PYTHONPATH": ROOT},
+        )
+
+    async def scenario():
+        await db.add_transaction(-1, 10, 'cash', 'add')
+        first = await handlers.cached_report(-1, 'balance', (), build)
+        assert await handlers.cached_report(-1, 'balance', (), build) == first
+        assert len(builds) == 1
+
+        await db.add_transaction(-1, 5, 'cash', 'add')
+        assert await handlers.cached_report(-1, 'balance', (), build) == (15, 0)
+        assert len(builds) == 2
+
+        # Баланс, испорченный мимо бота, исправляется пересчетом в другом процессе
+        async with db._write(-1) as conn:
+            await conn.execute("UPDATE balances SET cash = 0 WHERE chat_id = -1")
+        assert await handlers.cached_report(-1, 'balance', (), build) == (15, 0)
+        await asyncio.to_thread(rebuild_in_other_process)
+        assert await handlers.cached_report(-1, 'balance', (), build) == (15, 0)
+        return len(builds)
+
+    assert run_db(scenario) == 3
@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from sender import PRIORITY_LOW, SendScheduler, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+async def _pending(bucket: TokenBucket, priority: int = 1) -> asyncio.Task:
+    """Запрос токена; задача остается незавершенной, если токена нет"""
+    task = asyncio.ensure_future(bucket.acquire(priority))
+    await asyncio.sleep(0)
+    return task
+
+
+def _fire(bucket: TokenBucket):
+    """Срабатывание таймера корзины по фиктивным часам"""
+    bucket._wakeup.cancel()
+    bucket._release()
+
+
+def test_burst_then_rate():
+    async def scenario():
+        clock = FakeClock()
+        bucket = TokenBucket(rate=2, capacity=3, clock=clock)
+        for _ in range(3):
+            assert (await _pending(bucket)).done()
+
+        waiter = await _pending(bucket)
+        assert not waiter.done()
+        # Таймер заведен ровно на время появления одного токена
+        delay = bucket._wakeup.when() - asyncio.get_running_loop().time()
+        assert delay == pytest.approx(0.5, abs=0.05)
+
+        clock.now += 0.4
+        _fire(bucket)
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        clock.now += 0.1
+        _fire(bucket)
+        await asyncio.sleep(0)
+        assert waiter.done()
+        assert bucket.waiting == 0
+
+        # Запас не копится сверх capacity
+        clock.now += 100
+        assert bucket.idle
+        for _ in range(3):
+            assert (await _pending(bucket)).done()
+        assert not (await _pending(bucket)).done()
+
+    asyncio.run(scenario())
+
+
+def test_priority_served_first():
+    async def scenario():
+        clock = FakeClock()
+        bucket = TokenBucket(rate=1, capacity=1, clock=clock)
+        await bucket.acquire()
+        low = await _pending(bucket, PRIORITY_LOW)
+        normal = await _pending(bucket)
+
+        clock.now += 1
+        _fire(bucket)
+        await asyncio.sleep(0)
+        assert normal.done() and not low.done()
+
+        clock.now += 1
+        _fire(bucket)
+        await asyncio.sleep(0)
+        assert low.done()
+
+    asyncio.run(scenario())
+
+
+def test_penalize_blocks_for_retry_after():
+    async def scenario():
+        clock = FakeClock()
+        bucket = TokenBucket(rate=1, capacity=5, clock=clock)
+        bucket.penalize(3)
+        waiter = await _pending(bucket)
+
+        # Запас сгорает, токен появится через retry_after + 1/rate
+        clock.now += 3.9
+        _fire(bucket)
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        clock.now += 0.1
+        _fire(bucket)
+        await asyncio.sleep(0)
+        assert waiter.done()
+
+    asyncio.run(scenario())
+
+
+def _scheduler(max_retries: int = 3) -> SendScheduler:
+    return SendScheduler(group_rate=1000, group_burst=1000, private_rate=1000,
+                         private_burst=1000, global_rate=1000, max_retries=max_retries)
+
+
+def test_scheduler_retries_after_retry_after():
+    method = SendMessage(chat_id=-1, text="x")
+    calls = []
+
+    async def make_request(bot, method):
+        calls.append(method)
+        if len(calls) < 3:
+            raise TelegramRetryAfter(method, "Flood control", 0)
+        return "ok"
+
+    scheduler = _scheduler()
+    assert asyncio.run(scheduler(make_request, None, method)) == "ok"
+    assert len(calls) == 3
+    assert scheduler.retry_after == 2
+    assert scheduler.sent == 1
+
+
+def test_scheduler_gives_up_after_max_retries():
+    method = SendMessage(chat_id=-1, text="x")
+    calls = []
+
+    async def make_request(bot, method):
+        calls.append(method)
+        raise TelegramRetryAfter(method, "Flood control", 0)
+
+    scheduler = _scheduler(max_retries=2)
+    with pytest.raises(TelegramRetryAfter):
+        asyncio.run(scheduler(make_request, None, method))
+    assert len(calls) == 3
+    assert scheduler.sent == 0
@@ -0,0 +1,24 @@
+import pytest
+
+import database as db
+
+
+def test_averages_keep_fractional_kopecks(run_db):
+    # 10.03 + 10.04 + 10.04 = 3011 копеек на 3 транзакции: средний чек 10.0366... ₽
+    async def scenario():
+        category_id = await db.create_category(1, "Кофе")
+        for amount, unit_price in ((10.03, 1.01), (10.04, 1.02), (10.04, 1.02)):
+            await db.add_transaction(1, amount, 'cash', 'add', category_id=category_id,
+                                     quantity=1, unit_price=unit_price)
+        summary = await db.get_unit_economics_summary(1)
+        categories = await db.get_unit_economics_by_category(1)
+        return summary, categories
+
+    summary, categories = run_db(scenario)
+    assert summary['avg_check'] == pytest.approx(30.11 / 3)
+    assert f"{summary['avg_check']:.2f}" == "10.04"
+    assert summary['avg_unit_price'] == pytest.approx(3.05 / 3)
+    (_, _, _, _, avg_price, revenue, _, avg_amount), = categories
+    assert avg_price == pytest.approx(3.05 / 3)
+    assert avg_amount == pytest.approx(30.11 / 3)
+    assert revenue == pytest.approx(30.11)
@@ -0,0 +1,93 @@
+from datetime import date, datetime, timezone
+
+import pytest
+
+import config
+import database as db
+import zreport
+
+MSK = 180
+NEW_YORK = -300
+
+
+@pytest.fixture(autouse=True)
+def no_stagger(monkeypatch):
+    monkeypatch.setattr(config, "ZREPORT_WINDOW", 1)
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize("now, report_time, offset, expected", [
+    # 22:00 по Москве = 19:00 UTC
+    (utc(2024, 1, 5, 18, 59), "22:00", MSK, date(2024, 1, 4)),
+    (utc(2024, 1, 5, 19, 0), "22:00", MSK, date(2024, 1, 5)),
+    # 01:00 по Москве - уже следующие местные сутки, хотя в UTC еще 5 января
+    (utc(2024, 1, 5, 21, 59), "01:00", MSK, date(2024, 1, 5)),
+    (utc(2024, 1, 5, 22, 0), "01:00", MSK, date(2024, 1, 6)),
+    # 23:00 в UTC-5 = 04:00 UTC следующего дня
+    (utc(2024, 1, 6, 3, 59), "23:00", NEW_YORK, date(2024, 1, 4)),
+    (utc(2024, 1, 6, 4, 0), "23:00", NEW_YORK, date(2024, 1, 5)),
+    (utc(2024, 1, 5, 0, 0), "00:00", 0, date(2024, 1, 5)),
+])
+def test_due_day_boundaries(now, report_time, offset, expected):
+    assert zreport.due_day(now, 1, report_time, offset, None) == expected
+
+
+def test_due_day_after_sent_report():
+    now = utc(2024, 1, 5, 19, 30)
+    assert zreport.due_day(now, 1, "22:00", MSK, "2024-01-05") is None
+    # Пропущенные дни не досылаются: только последний
+    assert zreport.due_day(now, 1, "22:00", MSK, "2024-01-01") == date(2024, 1, 5)
+
+
+def test_due_day_staggers_chats(monkeypatch):
+    monkeypatch.setattr(config, "ZREPORT_WINDOW", 600)
+    now = utc(2024, 1, 5, 19, 5)
+    assert zreport.due_day(now, 299, "22:00", MSK, None) == date(2024, 1, 5)
+    assert zreport.due_day(now, 301, "22:00", MSK, None) == date(2024, 1, 4)
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def _row(amount, operation_type, created_at, category_id=None, cost=None):
+    return (-1, amount, 'cash', operation_type, None, None, None,
+            category_id, None, None, cost, created_at)
+
+
+@pytest.mark.parametrize("day, report_time, offset, inside, outside", [
+    # Отчет 06.01 в 01:00 по Москве: 01:00 05.01 - 01:00 06.01 = 22:00 04.01 - 22:00 05.01 UTC
+    (date(2024, 1, 6), "01:00", MSK, ("2024-01-04 22:00:00", "2024-01-05 21:59:59"),
+     ("2024-01-04 21:59:59", "2024-01-05 22:00:00")),
+    # Отчет 05.01 в 23:00 в UTC-5: 23:00 04.01 - 23:00 05.01 = 04:00 05.01 - 04:00 06.01 UTC
+    (date(2024, 1, 5), "23:00", NEW_YORK, ("2024-01-05 04:00:00", "2024-01-06 03:59:59"),
+     ("2024-01-05 03:59:59", "2024-01-06 04:00:00")),
+])
+def test_report_covers_local_day(run_db, day, report_time, offset, inside, outside):
+    async def scenario():
+        income = await db.create_category(-1, "Кофе")
+        await db.add_transactions(
+            [_row(100, 'add', created_at, category_id=income) for created_at in inside]
+            + [_row(1000, 'add', created_at, category_id=income) for created_at in outside]
+            + [_row(30, 'subtract', inside[1], cost=30)]
+        )
+        bot = FakeBot()
+        await zreport.send_report(bot, -1, day, report_time, offset)
+        return bot.sent
+
+    (chat_id, text), = run_db(scenario)
+    assert chat_id == -1
+    assert text.startswith(f"🧾 Z-отчет за {(day.replace(day=day.day - 1)):%d.%m} {report_time} - "
+                           f"{day:%d.%m.%Y} {report_time}\n")
+    assert "Продаж: 2\n" in text
+    assert "Выручка: 200.00 ₽" in text
+    assert "Расходы: 30.00 ₽" in text
+    assert "Прибыль: 170.00 ₽" in text
+    assert "• Кофе: 200.00 ₽ (2)" in text
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import signal
+from typing import Any, Dict, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class DrainingRequestHandler(SimpleRequestHandler):
+    """Обработчик вебхука с ограничением числа одновременно обрабатываемых
+    обновлений и ожиданием их завершения при остановке"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrency: int,
+                 drain_timeout: float, secret_token: Optional[str] = None, **data: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True,
+                         secret_token=secret_token, **data)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.drain_timeout = drain_timeout
+
+    @property
+    def pending(self) -> int:
+        """Количество принятых, но еще не обработанных обновлений"""
+        return len(self._background_feed_update_tasks)
+
+    async def _background_feed_update(self, bot: Bot, update: Dict[str, Any]) -> None:
+        async with self._semaphore:
+            await super()._background_feed_update(bot, update)
+
+    async def drain(self, *args: Any, **kwargs: Any):
+        """Ожидание обработки уже принятых обновлений"""
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        logger.info(f"Ожидание обработки {len(tasks)} обновлений...")
+        done, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+        if pending:
+            logger.warning(f"Не дождались обработки {len(pending)} обновлений, прерываем")
+            for task in pending:
+                task.cancel()
+
+
+def build_app(bot: Bot, dp: Dispatcher, path: str, secret_token: Optional[str],
+              max_concurrency: int, drain_timeout: float) -> web.Application:
+    """Создание aiohttp-приложения, принимающего обновления по вебхуку"""
+    app = web.Application()
+    handler = DrainingRequestHandler(
+        dp, bot,
+        max_concurrency=max_concurrency,
+        drain_timeout=drain_timeout,
+        secret_token=secret_token
+    )
+    # Порядок остановки: дождаться обработчиков, затем остановить диспетчер
+    # (закрывает хранилище FSM), и только потом закрыть сессию бота
+    app.on_shutdown.append(handler.drain)
+    setup_application(app, dp, bot=bot)
+    handler.register(app, path=path)
+    app["webhook_handler"] = handler
+    return app
+
+
+async def serve(app: web.Application, host: str, port: int):
+    """Запуск HTTP-сервера до получения SIGTERM/SIGINT с мягкой остановкой"""
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"Вебхук слушает {host}:{port}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: остановка только через KeyboardInterrupt
+            pass
+    try:
+        await stop.wait()
+        logger.info("Получен сигнал остановки, завершаем обработку...")
+    finally:
+        # Сначала перестаем принимать запросы, затем выполняем on_shutdown
+        await runner.cleanup()
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, *, url: Optional[str], path: str,
+                      secret_token: Optional[str], host: str, port: int,
+                      max_concurrency: int, drain_timeout: float):
+    """Работа бота в режиме вебхука"""
+    app = build_app(bot, dp, path, secret_token, max_concurrency, drain_timeout)
+    if url:
+        await bot.set_webhook(
+            url=url.rstrip("/") + path,
+            secret_token=secret_token,
+            allowed_updates=["message", "callback_query"],
+            max_connections=min(max_concurrency, 100)
+        )
+        logger.info(f"Вебхук зарегистрирован: {url.rstrip('/')}{path}")
+    else:
+        logger.info("WEBHOOK_URL не задан, вебхук должен быть зарегистрирован заранее")
+    await serve(app, host, port)
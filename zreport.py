@@ -0,0 +1,163 @@
+"""
+Ежедневный Z-отчет (/zreport 22:00): баланс, выручка, расходы, прибыль, маржа
+и лучшие источники дохода за сутки, закрывающиеся в настроенное местное время чата.
+Отчеты считаются по транзакциям суток, по одному за раз и не чаще ZREPORT_RATE
+в секунду; отчеты чатов с одинаковым временем разнесены по окну ZREPORT_WINDOW.
+День последнего отчета хранится в настройках чата, поэтому отчет, время
+которого пришлось на остановку бота, отправляется после запуска
+"""
+import asyncio
+import logging
+import re
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Optional, Tuple
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramNetworkError
+
+import config
+import database as db
+import sender
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять, не пора ли отправить отчеты, секунд
+CHECK_INTERVAL = 60
+# Сколько источников дохода показывать в отчете
+TOP_CATEGORIES = 5
+
+_TIME_RE = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)$")
+_OFFSET_RE = re.compile(r"^(?:UTC)?([+-])(\d{1,2})(?::([0-5]\d))?$", re.IGNORECASE)
+
+
+def parse_time(text: str) -> Optional[str]:
+    """'9:30' -> '09:30'; None, если это не время"""
+    match = _TIME_RE.match(text.strip())
+    if not match:
+        return None
+    return f"{int(match.group(1)):02d}:{match.group(2)}"
+
+
+def parse_offset(text: str) -> Optional[int]:
+    """'+3', '-5', 'UTC+5:30' -> смещение от UTC в минутах; None, если это не смещение"""
+    match = _OFFSET_RE.match(text.strip())
+    if not match:
+        return None
+    minutes = int(match.group(2)) * 60 + int(match.group(3) or 0)
+    if minutes > 14 * 60:
+        return None
+    return -minutes if match.group(1) == "-" else minutes
+
+
+def format_offset(minutes: int) -> str:
+    sign = "-" if minutes < 0 else "+"
+    hours, rest = divmod(abs(minutes), 60)
+    return f"UTC{sign}{hours}" + (f":{rest:02d}" if rest else "")
+
+
+def due_day(now: datetime, chat_id: int, report_time: str, utc_offset: int,
+            last_report_day: Optional[str]) -> Optional[date]:
+    """Местный день, отчет которого пора отправить, или None. Отчет дня
+    охватывает сутки, закрывающиеся в его время отправки (report_window).
+    Время отправки чата сдвигается на chat_id % ZREPORT_WINDOW секунд, чтобы
+    чаты с одинаковым временем не считали отчеты в одну минуту. Если бот
+    пропустил несколько дней, отправляется только отчет за последний"""
+    local_now = now + timedelta(minutes=utc_offset)
+    hours, minutes = map(int, report_time.split(":"))
+    scheduled = datetime.combine(local_now.date(), time(hours, minutes), tzinfo=local_now.tzinfo)
+    scheduled += timedelta(seconds=chat_id % max(config.ZREPORT_WINDOW, 1))
+    day = local_now.date() if local_now >= scheduled else local_now.date() - timedelta(days=1)
+    if last_report_day is not None and last_report_day >= day.isoformat():
+        return None
+    return day
+
+
+def report_window(day: date, report_time: str) -> Tuple[datetime, datetime]:
+    """Местные начало и конец суток, которые закрывает отчет дня day:
+    24 часа до времени отчета (при 00:00 - календарный день накануне)"""
+    hours, minutes = map(int, report_time.split(":"))
+    end = datetime.combine(day, time(hours, minutes))
+    return end - timedelta(days=1), end
+
+
+def format_period(start: datetime, end: datetime) -> str:
+    if start.time() == time(0, 0):
+        return start.strftime('%d.%m.%Y')
+    return f"{start.strftime('%d.%m %H:%M')} - {end.strftime('%d.%m.%Y %H:%M')}"
+
+
+def format_report(report: dict, cash: float, card: float, period: str) -> str:
+    """Текст Z-отчета за период period (местное время чата)"""
+    text = (
+        f"🧾 Z-отчет за {period}\n\n"
+        f"💰 Баланс кассы: {cash + card:.2f} ₽\n"
+        f"💵 Наличные: {cash:.2f} ₽\n"
+        f"💳 Безналичные: {card:.2f} ₽\n"
+        f"━━━━━━━━━━━━━━━━━━━━\n"
+    )
+    if report['transactions']:
+        text += (
+            f"Продаж: {report['transactions']}\n"
+            f"Выручка: {report['revenue']:.2f} ₽\n"
+            f"Расходы: {report['cost']:.2f} ₽\n"
+            f"Прибыль: {report['profit']:.2f} ₽\n"
+            f"Маржа: {report['margin']:.1f}%\n"
+        )
+    else:
+        text += "Продаж за день не было\n"
+    if report['categories']:
+        text += "\n📁 Лучшие источники дохода:\n"
+        for name, revenue, count in report['categories'][:TOP_CATEGORIES]:
+            text += f"• {name}: {revenue:.2f} ₽ ({count})\n"
+    return text.rstrip("\n")
+
+
+async def send_report(bot: Bot, chat_id: int, day: date, report_time: str, utc_offset: int):
+    """Расчет и отправка Z-отчета чата за сутки, которые закрывает время
+    отчета дня day. Границы суток переводятся из местного времени в UTC"""
+    start, end = report_window(day, report_time)
+    shift = timedelta(minutes=utc_offset)
+    report = await db.get_period_report(
+        chat_id, (start - shift).strftime(db.TIMESTAMP_FORMAT), (end - shift).strftime(db.TIMESTAMP_FORMAT)
+    )
+    cash, card = await db.get_balance(chat_id)
+    with sender.informational():
+        await bot.send_message(chat_id, format_report(report, cash, card, format_period(start, end)))
+
+
+async def _send_due(bot: Bot, shard: int, shards: int):
+    """Отправка всех отчетов, время которых наступило, по одному за раз"""
+    for chat_id, report_time, utc_offset, last_report_day in await db.get_report_schedules():
+        # Чат обслуживает тот же процесс, что и его обновления (sharding.shard_of)
+        if chat_id % shards != shard:
+            continue
+        day = due_day(datetime.now(timezone.utc), chat_id, report_time, utc_offset, last_report_day)
+        if day is None:
+            continue
+        try:
+            await send_report(bot, chat_id, day, report_time, utc_offset)
+        except TelegramForbiddenError:
+            # Бота удалили из чата: отчеты больше не отправляются
+            logger.info(f"Чат {chat_id} недоступен, Z-отчет выключен")
+            await db.update_chat_settings(chat_id, report_time=None)
+            continue
+        except TelegramNetworkError as e:
+            # Отчет отправится при следующей проверке
+            logger.warning(f"Сеть недоступна, Z-отчет чата {chat_id} отложен: {e}")
+            continue
+        except TelegramAPIError as e:
+            # Повтор не поможет (например, нет прав писать в чат): день пропускается
+            logger.warning(f"Не удалось отправить Z-отчет в чат {chat_id}: {e}")
+        await db.update_chat_settings(chat_id, last_report_day=day.isoformat())
+        # Отчеты считаются равномерно, без всплеска запросов к БД
+        await asyncio.sleep(1 / config.ZREPORT_RATE)
+
+
+async def run(bot: Bot, shard: int = 0, shards: int = 1):
+    """Фоновая отправка Z-отчетов чатов этого процесса (shard из shards)"""
+    while True:
+        try:
+            await _send_due(bot, shard, shards)
+        except Exception as e:
+            logger.error(f"Ошибка отправки Z-отчетов: {e}", exc_info=True)
+        await asyncio.sleep(CHECK_INTERVAL)